@@ -1,7 +1,7 @@
-import numpy as np, pandas as pd, sys, os, copy, argparse, re
-from numba import jit
+import numpy as np, pandas as pd, sys, os, copy, argparse, re, shutil, tempfile
+from numba import jit, prange, config, get_num_threads, set_num_threads
 from time import time
-import functools, datetime
+import datetime
 from multiprocessing import Pool
 try:
     xrange(2)
@@ -12,13 +12,43 @@ try:
 except :
     from .configure import uopen
 
-def _iter_branch_measure(obj, arg) :
-    return obj.iter_branch_measure(arg)
-
-def _iter_viterbi(obj, arg) :
-    return obj.viterbi(arg)    
-
-@jit(nopython=True, fastmath=True)
+def _iter_viterbi(data) :
+    store, brId, n_a, params = data
+    hmm = recHMM(None)
+    hmm.n_a = n_a
+    return dict(sketches=hmm.viterbi([attach_observations(store, brId), params])['sketches'])
+
+def flatten_observations(observations) :
+    '''observations of all branches in one array, with the boundaries of blocks, and of branches in blocks. 
+    The blocks in observations are replaced in place by views of that array, so the data is held only once'''
+    blocks = [ obs for observation in observations for obs in observation ]
+    obs = np.vstack(blocks).astype(np.int64)
+    block_ptr = np.concatenate([[0], np.cumsum([ o.shape[0] for o in blocks ])]).astype(np.int64)
+    branch_ptr = np.concatenate([[0], np.cumsum([ len(observation) for observation in observations ])]).astype(np.int64)
+    del blocks
+    for brId, observation in enumerate(observations) :
+        for k, blkId in enumerate(range(branch_ptr[brId], branch_ptr[brId+1])) :
+            observation[k] = obs[block_ptr[blkId]:block_ptr[blkId+1]]
+    return obs, block_ptr, branch_ptr
+
+def share_observations(prefix, flat_observations) :
+    '''write flattened observations into a folder of npy files that workers memory-map'''
+    store = tempfile.mkdtemp(prefix=os.path.basename(prefix)+'.', dir=os.path.dirname(os.path.abspath(prefix)))
+    for key, arr in zip(('obs', 'block_ptr', 'branch_ptr'), flat_observations) :
+        np.save(os.path.join(store, key + '.npy'), arr)
+    return store
+
+shared_observations = {}
+def attach_observations(store, brId) :
+    '''blocks of a branch, from the memory-mapped observations that are attached once per worker'''
+    if store not in shared_observations :
+        shared_observations.clear()
+        shared_observations[store] = [ np.load(os.path.join(store, key + '.npy'), mmap_mode='r') for key in ('obs', 'block_ptr', 'branch_ptr') ]
+    obs, block_ptr, branch_ptr = shared_observations[store]
+    ptr = block_ptr[branch_ptr[brId]:branch_ptr[brId+1]+1]
+    return [ np.asarray(obs[s:e]) for s, e in zip(ptr[:-1], ptr[1:]) ]
+
+@jit(nopython=True, fastmath=True, cache=True)
 def update_distant_transition(transition, emission, dist_transition, dist_transition_adj) :
     interval = dist_transition.shape[0]
     dist_transition[0] = transition
@@ -38,6 +68,131 @@ def update_distant_transition(transition, emission, dist_transition, dist_transi
             break
     return dist_transition, dist_transition_adj, saturate_id
 
+@jit(nopython=True, fastmath=True, cache=True)
+def block_measure(obs, pi, transition, emission, tr2, tr2_adj, saturate_id, a2, b2, gamma, gammaOnly) :
+    n_obs, n_a = obs.shape[0], transition.shape[0]
+    e0 = emission[:, 0].copy()
+    alpha, beta = np.zeros((n_obs, n_a)), np.zeros((n_obs, n_a))
+
+    # scaled forward
+    for j in range(n_a) :
+        for i in range(n_a) :
+            alpha[0, j] += pi[i] * tr2[0, i, j]
+        alpha[0, j] *= emission[j, obs[0, 3]]
+    s = np.sum(alpha[0])
+    alpha[0] /= s
+    probability = np.log(s)
+    for id in range(1, n_obs) :
+        k = obs[id, 4] - 1
+        for j in range(n_a) :
+            for i in range(n_a) :
+                alpha[id, j] += alpha[id-1, i] * tr2[k, i, j]
+            alpha[id, j] *= emission[j, obs[id, 3]]
+        s = np.sum(alpha[id])
+        alpha[id] /= s
+        probability += np.log(s) + tr2_adj[k]
+
+    # scaled backward
+    for j in range(n_a) :
+        for i in range(n_a) :
+            beta[-1, j] += pi[i] * tr2[0, j, i]
+    for id in range(n_obs-1, 0, -1) :
+        k = obs[id, 4] - 1
+        for i in range(n_a) :
+            for j in range(n_a) :
+                beta[id-1, i] += beta[id, j] * emission[j, obs[id, 3]] * tr2[k, i, j]
+        beta[id-1] /= np.sum(beta[id-1])
+
+    for id in range(n_obs) :
+        g = alpha[id] * beta[id]
+        gamma[id] = g/np.sum(g)
+        b2[:, obs[id, 3]] += gamma[id]
+
+    # expected transitions and emissions over the conserved sites between observations
+    na, nb = np.zeros(n_a), np.zeros(n_a)
+    for i in range(n_a) :
+        for j in range(n_a) :
+            na[j] += alpha[0, i] * tr2[saturate_id, i, j]
+            nb[i] += beta[0, j] * tr2[saturate_id, i, j]
+    na *= e0
+    ng = na*nb/np.sum(na*nb)
+    ne = np.zeros((n_a, n_a))
+    for i in range(n_a) :
+        for j in range(n_a) :
+            ne[i, j] = na[i] * nb[j] * e0[j] * transition[i, j]
+    ne /= np.sum(ne)
+
+    fa, fb = np.zeros((max(2*saturate_id, 1), n_a)), np.zeros((max(2*saturate_id, 1), n_a))
+    t = np.zeros((n_a, n_a))
+    for id in range(1, n_obs) :
+        d = obs[id, 4] - 1
+        if d > 2*saturate_id :
+            a2 += (d - 2*saturate_id)*ne
+            b2[:, 0] += (d - 2*saturate_id)*ng
+            d = 2*saturate_id
+        sa, sb = alpha[id-1], beta[id] * emission[:, obs[id, 3]]
+        if d > saturate_id :
+            fa[:d], fb[:d] = na, nb
+        for k in range(min(d, saturate_id)) :
+            for i in range(n_a) :
+                fa[k, i], fb[d-1-k, i] = 0., 0.
+            for i in range(n_a) :
+                for j in range(n_a) :
+                    fa[k, j] += sa[i] * tr2[k, i, j]
+                    fb[d-1-k, i] += sb[j] * tr2[k, i, j]
+            for i in range(n_a) :
+                fa[k, i] *= e0[i]
+        for k in range(d) :
+            c = 0.
+            for i in range(n_a) :
+                c += fa[k, i] * fb[k, i]
+            for i in range(n_a) :
+                b2[i, 0] += fa[k, i] * fb[k, i] / c
+        if not gammaOnly :
+            for k in range(d+1) :
+                c = 0.
+                for i in range(n_a) :
+                    s1 = sa[i] if k == 0 else fa[k-1, i]
+                    for j in range(n_a) :
+                        t[i, j] = s1 * (sb[j] if k == d else fb[k, j]*e0[j]) * transition[i, j]
+                        c += t[i, j]
+                for i in range(n_a) :
+                    for j in range(n_a) :
+                        a2[i, j] += t[i, j] / c
+    a2[0] += gamma[0]
+    a2[:, 0] += gamma[-1]
+    return probability
+
+@jit(nopython=True, parallel=True, cache=True)
+def branch_measure(obs, block_ptr, branch_ptr, groups, group_ptr, pi, transition, emission, gammaOnly) :
+    '''forward-backward over all blocks of all branches, each group of branches in one thread. 
+    Returns the expected transitions, emissions and log-likelihood of each block and the posteriors of each observation'''
+    n_a, n_b, n_block = transition.shape[1], emission.shape[2], block_ptr.size - 1
+    a2, b2 = np.zeros((n_block, n_a, n_a)), np.zeros((n_block, n_a, n_b))
+    probability, gamma = np.zeros(n_block), np.zeros((obs.shape[0], n_a))
+    for g in prange(group_ptr.size - 1) :
+        for br in groups[group_ptr[g]:group_ptr[g+1]] :
+            interval = 50
+            for blk in range(branch_ptr[br], branch_ptr[br+1]) :
+                interval = max(interval, np.max(obs[block_ptr[blk]:block_ptr[blk+1], 4]))
+            tr2, tr2_adj, saturate_id = update_distant_transition(transition[br], emission[br].T, np.zeros((interval, n_a, n_a)), np.zeros(interval))
+            for blk in range(branch_ptr[br], branch_ptr[br+1]) :
+                s, e = block_ptr[blk], block_ptr[blk+1]
+                probability[blk] = block_measure(obs[s:e], pi[br], transition[br], emission[br], tr2, tr2_adj, saturate_id, a2[blk], b2[blk], gamma[s:e], gammaOnly)
+    return a2, b2, probability, gamma
+
+def branch_groups(block_ptr, branch_ptr, n_group) :
+    '''assign branches to groups of similar numbers of observations, largest first'''
+    sizes = block_ptr[branch_ptr[1:]] - block_ptr[branch_ptr[:-1]]
+    loads, members = np.zeros(n_group), [ [] for g in range(n_group) ]
+    for br in np.argsort(-sizes, kind='stable') :
+        g = np.argmin(loads)
+        loads[g] += sizes[br]
+        members[g].append(br)
+    groups = np.array([ br for m in members for br in m ], dtype=np.int64)
+    group_ptr = np.concatenate([[0], np.cumsum([ len(m) for m in members ])]).astype(np.int64)
+    return groups, group_ptr
+
 
 class recHMM(object) :
     def __init__(self, prefix, mode=1) :
@@ -49,6 +204,7 @@ class recHMM(object) :
 
     def fit(self, mutations, branches=None, sequences=None, missing=[], categories=None, init=None, cool_down=5) :
         self.observations = self.prepare_branches(mutations, sequences, missing)
+        self.flat_observations = flatten_observations(self.observations)
         self.branches = branches if branches is not None else np.arange(len(self.observations)).astype(str)
         self.categories = { 'noRec':{} }
         for c, assigns in categories.items() :
@@ -185,7 +341,7 @@ class recHMM(object) :
                     self.screen_out('Assess', model)
                     #t = time()
                     branch_params = self.update_branch_parameters(model)
-                    branch_measures = self.get_branch_measures(branch_params, self.observations)
+                    branch_measures = self.get_branch_measures(branch_params)
                     #print(time() - t)
                     prediction = self.estimation(model, branch_measures)
                     prediction['diff'] = -prediction['probability'] if not model['probability'] else prediction['probability'] - model['probability']
@@ -377,109 +533,24 @@ class recHMM(object) :
             ))
         return branch_params
 
-    def iter_branch_measure(self, data) :
-        obs, param, gammaOnly = data
-        interval = np.max([np.max(o.T[4]) for o in obs] + [50])
-        dist_transition = np.zeros(shape=[interval, param['a'].shape[0], param['a'].shape[1]] )
-        dist_transition_adj = np.zeros(shape=[interval] )
-        
-        a2, a2x, saturate_id = update_distant_transition( param['a'], param['b'].T, dist_transition, dist_transition_adj )
-        new_params = []
-        for o in obs :
-            alpha_Pr, alpha, beta = self.forward_backward(o, pi=param['pi'], a2s=[a2, a2x], b=param['b'])
-            new_param = self.estimate_params(param['a'], param['b'], o, alpha, beta, a2, saturate_id, gammaOnly)
-            new_param['probability'] = alpha_Pr
-            new_params.append(new_param)
-        new_param = {'a':[], 'b':[], 'probability':[], 'gamma':[]}
-        for k in new_param :
-            new_param[k] = np.sum(np.array([ p.get(k) for p in new_params if k in p ]), 0) if k != 'gamma' \
-                else [p.get(k) for p in new_params if k in p]
-        
-        return new_param
-
-    def get_branch_measures(self, params, observations, gammaOnly=False) :
-        branch_measures = pool.map(functools.partial(_iter_branch_measure, self), zip(observations, params, [gammaOnly for p in params]))
+    def get_branch_measures(self, params, gammaOnly=False) :
+        obs, block_ptr, branch_ptr = self.flat_observations
+        groups, group_ptr = branch_groups(block_ptr, branch_ptr, get_num_threads())
+        pi = np.array([ p['pi'] for p in params ])
+        a = np.array([ p['a'] for p in params ])
+        b = np.array([ p['b'] for p in params ])
+        a2, b2, probability, gamma = branch_measure(obs, block_ptr, branch_ptr, groups, group_ptr, pi, a, b, gammaOnly)
+
+        branch_measures = []
+        for s, e in zip(branch_ptr[:-1], branch_ptr[1:]) :
+            branch_measures.append(dict(
+                a = np.sum(a2[s:e], 0),
+                b = np.sum(b2[s:e], 0),
+                probability = np.sum(probability[s:e]),
+                gamma = [ gamma[block_ptr[i]:block_ptr[i+1]] for i in range(s, e) ] if gammaOnly else [],
+            ))
         return branch_measures
 
-    def estimate_params(self, transition, emission, obs, alpha, beta, tr2, saturate_id, gammaOnly=False) : # mode = accurate
-        n_a, n_b = self.n_a, self.n_b
-        gamma = alpha*beta
-        gamma = (gamma.T/np.sum(gamma, 1)).T
-    
-        na = np.dot(alpha[0], tr2[saturate_id])*emission.T[0]
-        nb = np.dot(beta[0], tr2[saturate_id].T)
-        ng = na*nb/np.sum(na*nb)
-        ne = np.array([na for i in xrange(n_a)]).T * np.array([nb*emission.T[0] for i in xrange(n_a)])*transition
-        ne /= np.sum(ne)
-    
-        a2 = np.zeros(shape=[n_a, n_a])
-        b2 = np.zeros(shape=[n_a, n_b])
-    
-        for o, g in zip(obs, gamma) :
-            b2[:, o[3]] += g
-        
-        for o, s, e in zip(obs[1:], alpha[:-1], beta[1:]) :
-            d = o[4] - 1
-            if d > 2*saturate_id :
-                a2 += (d - 2*saturate_id)*ne
-                b2[:, 0] += (d - 2*saturate_id)*ng
-                d = 2 * saturate_id
-    
-            if d > saturate_id :
-                a, b = np.zeros(shape=[2, d, n_a])
-                a[:], b[:] = na, nb
-                a[:saturate_id] = np.dot(s, tr2[:saturate_id])*emission.T[0]
-                b[-saturate_id:] = np.dot(e*emission.T[o[3]], tr2[:saturate_id].transpose((0, 2, 1)))[::-1]
-            else :
-                a = np.dot(s, tr2[:d])*emission.T[0]
-                b = np.dot(e*emission.T[o[3]], tr2[:d].transpose((0, 2, 1)))[::-1]
-    
-            g = a*b
-            g = g.T/np.sum(g, 1)
-    
-            b2[:, 0] += np.sum(g, 1)
-            if not gammaOnly :
-                s1 = np.zeros(shape=[d+1, n_a, 1])
-                s1[0, :, 0] = s
-                s1[1:, :, 0] = a
-            
-                s2 = np.zeros(shape=[d+1, 1, n_a])
-                s2[:-1, 0, :] = (b*emission.T[0])
-                s2[-1, 0, :] = e*emission.T[o[3]]
-    
-                t = np.matmul(s1, s2) * transition.reshape([1] + list(transition.shape))
-                a2 += np.sum(t.T/np.sum(t, axis=(1,2)), 2).T
-    
-        a2[0] += gamma[0]
-        a2.T[0] += gamma[-1]
-        if gammaOnly :
-            return dict(b=b2, gamma=gamma)
-        else :
-            return dict(a=a2, b=b2)
-
-    def forward_backward(self, obs, pi, a2s, b) :
-        bv = b.T
-        a2, a2x = a2s
-        alpha, alpha_Pr = np.zeros(shape=[obs.shape[0], self.n_a]), 0.
-        alpha[0] = np.dot(pi, a2[0]) * bv[obs[0, 3]]
-        alpha_Pr = np.sum(alpha[0])
-        alpha[0], alpha_Pr = alpha[0]/alpha_Pr, np.log(alpha_Pr)
-        for id, o in enumerate(obs[1:]) :
-            r = np.dot(alpha[id], a2[o[4]-1]) * bv[o[3]]
-            s = np.sum(r)
-            alpha[id+1] = r/s
-            alpha_Pr += np.log(s) + a2x[o[4]-1]
-
-        beta, beta_Pr = np.ones(shape=[obs.shape[0], self.n_a]), 0.
-        beta[-1] = np.dot(pi, a2[0].T)
-        for i, o in enumerate(obs[:0:-1]) :
-            id = obs.shape[0]-1-i
-            r = np.dot(beta[id] * bv[o[3]], a2[o[4]-1].T)
-            s = np.sum(r)
-            beta[id-1] = r/s
-            beta_Pr += np.log(s) + a2x[o[4]-1]
-        return alpha_Pr, alpha, beta
-
     def get_brLens(self, branches, n_base) :
         return np.array([ np.sum(branch.T[1] > 0)/float(n_base) for branch in branches ])
 
@@ -566,6 +637,7 @@ class recHMM(object) :
         prefix = self.prefix
         assert self.model, 'No model'
         self.observations = self.prepare_branches(mutations, sequences, missing)
+        self.flat_observations = flatten_observations(self.observations)
         self.branches = branches if branches is not None else np.arange(len(self.observations)).astype(str)
         self.sequences = sequences if sequences is not None else [[str(id), 0] for id, _ in enumerate(self.observations[0])]
 
@@ -596,8 +668,11 @@ class recHMM(object) :
     def map_predict(self) :
         self.screen_out('Predict recombination sketches using', self.model)
         branch_params = self.update_branch_parameters(self.model, lower_limit=True)
-        status = pool.map(functools.partial(_iter_viterbi, self), zip(self.observations, branch_params))
-        #status = list(map(functools.partial(_iter_viterbi, self), zip(self.observations, branch_params)))
+        store = share_observations(self.prefix, self.flat_observations)
+        try :
+            status = pool.map(_iter_viterbi, [ [store, brId, self.n_a, param] for brId, param in enumerate(branch_params) ])
+        finally :
+            shutil.rmtree(store, ignore_errors=True)
         res = {}
         for name, dm, dr, stat in zip(self.branches, self.model['posterior']['theta'], self.model['posterior']['R'], status) :
             rec_len = np.sum([ e1-s1+1 for c, s, e, t, s1, e1, p in stat['sketches'] ])
@@ -609,7 +684,7 @@ class recHMM(object) :
 
     def margin_predict(self, marginal=0.9) :
         branch_params = self.update_branch_parameters(self.model)
-        status = self.get_branch_measures(branch_params, self.observations, gammaOnly=True)
+        status = self.get_branch_measures(branch_params, gammaOnly=True)
         res = {}
         for name, dm, dr, observation, stat in zip(self.branches, self.model['posterior']['theta'], self.model['posterior']['R'], self.observations, status) :
             path = []
@@ -745,7 +820,7 @@ class recHMM(object) :
 
 def parse_arg(a) :
     parser = argparse.ArgumentParser(description='Parameters for RecHMM. ', formatter_class=argparse.RawTextHelpFormatter)
-    parser.add_argument('--data', '-d', help='A list of mutations generated by EnPhyl', required=True)
+    parser.add_argument('--data', '-d', help='A list of mutations generated by EnPhyl, or the npz written by "phylo --npz"', required=True)
     parser.add_argument('--model', '-m', help='Read a saved best model.', default='')
     parser.add_argument('--task', '-t', help='task to run. \n0: One rec category from external sources.\n1: Three rec categories considering internal, external and mixed sources [default].', default=1, type=int)
     parser.add_argument('--init', '-i', help='Initiate models with guesses of recombinant proportions. \nDefault: 0.05,0.5,0.95', default='0.05,0.5,0.95')
@@ -773,44 +848,64 @@ def parse_arg(a) :
             args.categories[variable] = {'*': 0}
     return args
 
+def read_mutation_npz(fname) :
+    '''read mutations from the npz written by "EToKi.py phylo --npz"; ids are assigned as for the text input'''
+    with np.load(fname) as data :
+        data = { k:data[k] for k in data.files }
+    mutations = data['mutations'][pd.Series(data['alleles']).str.match(r'^[ACGTacgt]->[ACGTacgt]$').values]
+    br_ids, branches = pd.factorize(data['branches'][mutations.T[0]])
+    n_seq = data['seq_lens'].size
+    seq_ids, contigs = pd.factorize(np.concatenate([data['contigs'][:n_seq], data['contigs'][mutations.T[1]]]))
+    seq_lens = np.concatenate([data['seq_lens'], np.zeros(contigs.size - n_seq, dtype=np.int64)])
+    np.maximum.at(seq_lens, seq_ids[n_seq:], mutations.T[2])
+    contig_ids = dict(zip(contigs, range(contigs.size)))
+    missing = np.array([ [contig_ids.get(data['contigs'][m[0]], -1) if m[0] >= 0 else -1, m[1], m[2]] for m in data['missing'] ])
+    sequences = [ [n, int(l)] for n, l in zip(contigs, seq_lens) ]
+    mutations = np.array([br_ids, seq_ids[n_seq:], mutations.T[2], mutations.T[3]]).T
+    return np.array(branches, dtype=str), mutations, sequences, missing
+
 def RecHMM(args) :
     args = parse_arg(args)
     global pool, verbose
     pool = Pool(args.n_proc)
+    set_num_threads(max(1, min(args.n_proc, config.NUMBA_NUM_THREADS)))
     verbose = not args.clean
 
     model = recHMM(prefix=args.prefix, mode=args.task)
     
     if not args.report or not args.model :
-        sequences, missing = [], []
-        with uopen(args.data) as fin :
-            for line in fin :
-                if line.startswith('##') :
-                    if line.startswith('## Sequence_length:') :
-                        part = line[2:].strip().split()
-                        sequences.append([part[1], int(part[2])])
-                    elif line.startswith('## Missing_region:') :
-                        part = line[2:].strip().split()
-                        missing.append([part[1], int(part[2]), int(part[3])])
-                else :
-                    break
-            data = pd.read_csv(fin, sep='\t', dtype=str, header=None).values
-        branches, mutations = {}, []
-        seqLens = {seqName:[seqId, seqLen] for seqId, (seqName, seqLen) in enumerate(sequences)}
-        for d in data :
-            if re.findall(r'^[ACGTacgt]->[ACGTacgt]$', d[4]) :
-                if d[1] not in seqLens :
-                    seqLens[d[1]] = [len(seqLens), int(d[2])]
-                if seqLens[d[1]][1] < int(d[2]) :
-                    seqLens[d[1]][1] = int(d[2])
-                if d[0] not in branches :
-                    branches[d[0]] = len(branches)
-                brId, seqId = branches[d[0]], seqLens[d[1]][0]
-                mutations.append([brId, seqId, int(d[2]), int(d[3])])
-        missing = np.array([ [seqLens.get(m[0], [-1])[0], m[1], m[2]] for m in missing ])
-        sequences = [ [n, i[1]] for n, i in sorted(seqLens.items(), key=lambda x:x[1][0])]
-        branches = np.array([ br for br, id in sorted(branches.items(), key=lambda x:x[1]) ])
-        mutations = np.array(mutations)
+        if args.data.lower().endswith('.npz') :
+            branches, mutations, sequences, missing = read_mutation_npz(args.data)
+        else :
+            sequences, missing = [], []
+            with uopen(args.data) as fin :
+                for line in fin :
+                    if line.startswith('##') :
+                        if line.startswith('## Sequence_length:') :
+                            part = line[2:].strip().split()
+                            sequences.append([part[1], int(part[2])])
+                        elif line.startswith('## Missing_region:') :
+                            part = line[2:].strip().split()
+                            missing.append([part[1], int(part[2]), int(part[3])])
+                    else :
+                        break
+                data = pd.read_csv(fin, sep='\t', dtype=str, header=None).values
+            branches, mutations = {}, []
+            seqLens = {seqName:[seqId, seqLen] for seqId, (seqName, seqLen) in enumerate(sequences)}
+            for d in data :
+                if re.findall(r'^[ACGTacgt]->[ACGTacgt]$', d[4]) :
+                    if d[1] not in seqLens :
+                        seqLens[d[1]] = [len(seqLens), int(d[2])]
+                    if seqLens[d[1]][1] < int(d[2]) :
+                        seqLens[d[1]][1] = int(d[2])
+                    if d[0] not in branches :
+                        branches[d[0]] = len(branches)
+                    brId, seqId = branches[d[0]], seqLens[d[1]][0]
+                    mutations.append([brId, seqId, int(d[2]), int(d[3])])
+            missing = np.array([ [seqLens.get(m[0], [-1])[0], m[1], m[2]] for m in missing ])
+            sequences = [ [n, i[1]] for n, i in sorted(seqLens.items(), key=lambda x:x[1][0])]
+            branches = np.array([ br for br, id in sorted(branches.items(), key=lambda x:x[1]) ])
+            mutations = np.array(mutations)
         reorder = np.argsort(-np.bincount(mutations.T[0]))
         branches = branches[reorder]
         reorder = np.array([i1 for i1, i2 in sorted(enumerate(reorder), key=lambda x:x[1])])
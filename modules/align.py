@@ -1,8 +1,12 @@
 # align multiple genomes onto a single reference, using minimap2
 # remove short repetitive regions
 # call SNPs and short indels
-import os, sys, numpy as np, argparse, subprocess, re, gzip
+import os, sys, numpy as np, argparse, subprocess, re, gzip, zlib, shutil, hashlib, glob, tempfile
 from multiprocessing import Pool
+try :
+    import queue
+except :
+    import Queue as queue
 try :
     from .configure import readFastq, readFasta, xrange
 except :
@@ -14,9 +18,11 @@ def parseArgs(argv) :
     parser.add_argument('-p', '--prefix', help='[OUTPUT] prefix for all outputs.', default='Enlign')
     parser.add_argument('-a', '--alignment', help='[OUTPUT] Generate core genomic alignments in FASTA format', default=False, action='store_true')
     parser.add_argument('-m', '--matrix', help='[OUTPUT] Do not generate core SNP matrix', default=True, action='store_false')
+    parser.add_argument('-g', '--gff', help='[OUTPUT] Also write the alignment of each genome in GFF format', default=False, action='store_true')
     parser.add_argument('-l', '--last', help='Activate to use LAST as aligner. [DEFAULT: minimap2]', default=False, action='store_true')
     parser.add_argument('-c', '--core', help='[PARAM] percentage of presences for core genome. [DEFAULT: 0.95]', type=float, default=0.95)
     parser.add_argument('-n', '--n_proc', help='[PARAM] number of processes to use. [DEFAULT: 5]', default=5, type=int)
+    parser.add_argument('--cache', help='[PARAM] folder for cached reference indices and alignments. References and genomes that were processed before with the same parameters are reused. [DEFAULT: no cache]', default=None)
     parser.add_argument('-q', '--lowq', help='[OPTIONAL; INPUT] Genome of low quality. [DEFAULT: ]', default=[], action='append')
     parser.add_argument('queries', metavar='queries', nargs='+', help='queried genomes. Use <Tag>:<Filename> format to feed in a tag for each genome. Otherwise filenames will be used as tags for genomes. ')
     args = parser.parse_args(argv)
@@ -26,10 +32,37 @@ def parseArgs(argv) :
     args.aligner = externals['minimap2'] if not args.last else [externals['lastdb'], externals['lastal']]
     return args
 
+def overlap_pairs(contigs, starts, ends, gap=0) :
+    '''Find all pairs of intervals on the same contig with max(starts) < min(ends) + gap, in a single sweep over the sorted starts. 
+    Returns index arrays (i, j), i < j, ordered by (i, j) as a nested loop over the inputs would visit them. '''
+    starts, ends = np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64)
+    if starts.size == 0 :
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    contigs = np.unique(contigs, return_inverse=True)[1].astype(np.int64)
+    base = min(starts.min(), ends.min())
+    span = max(starts.max(), ends.max()) - base + abs(gap) + 1
+    order = np.lexsort([starts, contigs])
+    key = contigs[order]*span + starts[order] - base
+    k = np.searchsorted(key, contigs[order]*span + ends[order] - base + gap, side='left')
+    n = np.maximum(k - np.arange(order.size) - 1, 0)
+    a = np.repeat(np.arange(order.size), n)
+    b = a + 1 + np.arange(a.size) - np.repeat(np.cumsum(n) - n, n)
+    a, b = order[a], order[b]
+    kept = np.maximum(starts[a], starts[b]) < np.minimum(ends[a], ends[b]) + gap
+    i, j = np.minimum(a[kept], b[kept]), np.maximum(a[kept], b[kept])
+    o = np.lexsort([j, i])
+    return i[o], j[o]
+
+minimap2_index = '-k15 -w5'
+trf_params = '2 4 7 80 10 60 2000 -d -h -ngs'
+minimap2_params = '-c --frag=yes -A1 -B14 -O24,60 -E2,1 -r100 -g1000 -P -N5000 -f1000,5000 -n2 -m50 -s200 -z200 -2K10m --heap-sort=yes --secondary=yes'
+
 class last_package(object) :
+    lastdb_params = '-cR01'
+    lastal_params = '-j4 -r1 -q2 -a7 -b1'
     @staticmethod
     def run_lastal( refdb, query, output, lastal ) :
-        cmd = '{0} -j4 -r1 -q2 -a7 -b1 {1} {2}'.format( lastal, refdb, query )
+        cmd = '{0} {3} {1} {2}'.format( lastal, refdb, query, last_package.lastal_params )
         lastal_run = subprocess.Popen( cmd.split(), stdout=subprocess.PIPE, universal_newlines=True )
         with open(output, 'w') as fout:
             fout.write(lastal_run.communicate()[0])
@@ -38,7 +71,7 @@ class last_package(object) :
             with open(output+'.qry', 'w') as fout :
                 for n, (s, q) in fastq.items() :
                     fout.write('@{0}\n{1}\n+\n{2}\n'.format(n, s, re.sub(r'[!"#$%&\']', '(', q)))
-            cmd = '{0} -Q1 -j4 -r1 -q2 -a7 -b1 {1} {2}'.format( lastal, refdb, output + '.qry' )
+            cmd = '{0} -Q1 {3} {1} {2}'.format( lastal, refdb, output + '.qry', last_package.lastal_params )
             lastal_run = subprocess.Popen( cmd.split(), stdout=subprocess.PIPE )
             with open(output, 'w') as fout:
                 fout.write(lastal_run.communicate()[0])
@@ -46,64 +79,61 @@ class last_package(object) :
         return output
     @staticmethod
     def call_mutation( comparison, rep_mask = 3 ) :
-        seq = [comparison[6], comparison[12]]
-        qual = comparison[13]
+        seq = [encodeSeq(comparison[6]), encodeSeq(comparison[12])]
+        qual = np.asarray(comparison[13], dtype=np.int8)
         direct = [1 if comparison[4] == '+' else -1, 1 if comparison[10] == '+' else -1]
-        coord = [comparison[2] *direct[0] -1, comparison[8]*direct[1] -1]
-        low_complexity = [[coord[0]-999, coord[0]]]
+        gaps = [seq[0] == 45, seq[1] == 45]
+        start = [comparison[2] *direct[0] -1, comparison[8]*direct[1] -1]
+        coord = [start[0] + np.cumsum(~gaps[0]), start[1] + np.cumsum(~gaps[1])]
+        end = coord[0][-1] if coord[0].size else start[0]
+
+        # low quality columns within 3 bases in the query are merged
+        idx = np.where(qual == 1)[0]
         low_qual = []
-        mutations = []
-        for id, s1 in enumerate(seq[0]) :
-            s2 = seq[1][id]
-            if s1 != '-' :
-                coord[0] += 1
-            if s2 != '-' :
-                coord[1] += 1
-            if qual[id] == 1 :
-                if len(low_qual) == 0 or low_qual[-1][3] + 3 < coord[1] :
-                    low_qual.append([coord[0], coord[0], coord[1], coord[1], 0])
-                else :
-                    low_qual[-1][1] = coord[0]
-                    low_qual[-1][3] = coord[1]
-            if s1.islower() or s2.islower() :
-                if len(low_complexity) == 0 or low_complexity[-1][1] < coord[0]-1 :
-                    low_complexity.append([coord[0], coord[0]])
-                else :
-                    low_complexity[-1][1] = coord[0]
-            if s1.upper() != s2.upper() : #and s1.upper() != 'N' and s2.upper() != 'N' :
-                ms1 = coord[0] 
-                ms2 = coord[1] 
-                if len(mutations) < 1 or ((ms1 != mutations[-1][0] or mutations[-1][4][-1] != '-') and (ms2 != mutations[-1][2] or mutations[-1][5][-1] != '-')) :
-                    mutations.append([ms1, ms1, ms2, ms2, s1.upper(), s2.upper()])
-                    if id == 0 :
-                        mutations[-1].append( max(qual[id:(id+2)]) )
-                    else :
-                        mutations[-1].append( max(qual[(id-1):(id+2)]) )
-                else :
-                    mutations[-1][1] = ms1
-                    mutations[-1][3] = ms2
-                    mutations[-1][4] += s1.upper()
-                    mutations[-1][5] += s2.upper()
-                    if id < len(seq[0]) -1 and mutations[-1][6] == 0 :
-                        mutations[-1][6] = qual[id+1]
-        low_complexity = [ reg for reg in low_complexity + [[coord[0]+1, coord[0]+1000]] if reg[1]-reg[0] +1 >= 50 ]
+        if idx.size :
+            runs = np.where(np.diff(coord[1][idx]) > 3)[0] + 1
+            s, e = idx[np.concatenate([[0], runs])], idx[np.concatenate([runs-1, [idx.size-1]])]
+            low_qual = np.vstack([coord[0][s], coord[0][e], coord[1][s], coord[1][e], np.zeros(s.size, dtype=int)]).T.tolist()
+
+        # lower case (low complexity) columns, merged if adjacent in the reference
+        lower = ((seq[0] >= 97) & (seq[0] <= 122)) | ((seq[1] >= 97) & (seq[1] <= 122))
+        sites = coord[0][lower]
+        runs = np.where(sites > np.concatenate([[start[0]], sites[:-1]]) + 1)[0]
+        bounds = np.concatenate([runs, [sites.size]])
+        low_complexity = [[start[0]-999, start[0] if bounds[0] == 0 else int(sites[bounds[0]-1])]] + \
+                         np.vstack([sites[bounds[:-1]], sites[bounds[1:]-1]]).T.tolist()
+        low_complexity = [ reg for reg in low_complexity + [[end+1, end+1000]] if reg[1]-reg[0] +1 >= 50 ]
         for lq in low_qual :
             if lq[0] > comparison[2] :
                 lq[0] -= 1
             if lq[1] < comparison[3] :
                 lq[1] += 1
         comparison[6] = low_qual + low_complexity[1:-1]
+
+        # mismatched columns; consecutive gaps of the same sequence form one indel
+        upper = [np.where((s >= 97) & (s <= 122), s - 32, s).astype(np.uint8) for s in seq]
+        k = np.where(upper[0] != upper[1])[0]
+        extend = np.concatenate([[False], (gaps[0][k[1:]] & gaps[0][k[:-1]] & (coord[0][k[1:]] == coord[0][k[:-1]])) | \
+                                          (gaps[1][k[1:]] & gaps[1][k[:-1]] & (coord[1][k[1:]] == coord[1][k[:-1]]))]) if k.size else np.zeros(0, dtype=bool)
+        firsts = np.where(~extend)[0]
+        f, l = k[firsts], k[np.concatenate([firsts[1:]-1, [k.size-1]])].astype(int)
+        qualSum = np.concatenate([[0], np.cumsum(qual)])
+        flags = (qualSum[np.minimum(l+2, qual.size)] - qualSum[np.maximum(f-1, 0)] > 0).astype(int)
+        alleles = [ np.split(u[k], firsts[1:]) for u in upper ]
+        mutations = [ [ms1, me1, ms2, me2, a1.tobytes().decode(), a2.tobytes().decode(), flag] for ms1, me1, ms2, me2, a1, a2, flag in \
+                      zip(coord[0][f].tolist(), coord[0][l].tolist(), coord[1][f].tolist(), coord[1][l].tolist(), alleles[0], alleles[1], flags.tolist()) ]
+
+        # mutations close to low complexity regions (and to the ends of the alignment) are not reliable
+        if len(mutations) :
+            regs = np.array(low_complexity)
+            mut = np.array([m[:2] for m in mutations])
+            p = np.searchsorted(regs.T[0] - rep_mask, mut.T[1], side='right')
+            masked = (p > 0) & (regs.T[1][np.maximum(p-1, 0)] + rep_mask >= mut.T[0])
+            for m, msk in zip(mutations, masked.tolist()) :
+                if msk :
+                    m[6] = 1
         comparison[12] = ''
-        comparison = comparison[:13]
-        if len(mutations) > 0 :
-            for mut in mutations :
-                if mut[6] == 0 :
-                    for reg in low_complexity :
-                        if mut[1] < reg[0]-rep_mask :
-                            break 
-                        elif mut[0] <= reg[1]+rep_mask :
-                            mut[6] = 1
-            comparison.extend(mutations)
+        comparison = comparison[:13] + mutations
         ref_ins = [len(mut[5]) for mut in mutations if mut[5][0] == '-']
         qry_ins = [len(mut[5]) for mut in mutations if mut[4][0] == '-']
         gap_open = len(ref_ins) + len(qry_ins)
@@ -198,13 +228,17 @@ class last_package(object) :
         return [score, comparison[1], abs(rc[0]), abs(rc[1]), comparison[4], comparison[5], comparison[6], comparison[7], abs(qc[0]), abs(qc[1]), comparison[10], comparison[11], comparison[12]] + mutations
 
     @staticmethod
-    def make_alignment( filename ) :
-        comparisons = []
+    def read_maf( filename ) :
+        '''Read lastal outputs block by block. 
+        Each alignment is followed by a uint8 mask of columns with N bases or low quality (<= 14) in either sequence. '''
         with open(filename, 'r') as fin:
-            for line in fin:
-                if line[0] == 'a' :
+            blocks = fin.read().split('\n\n')
+        for block in blocks[:-1] :
+            comparison = None
+            for line in block.split('\n') :
+                if line[:1] == 'a' :
                     comparison = [ int(line.split(' ', 2)[1][6:]) ]
-                elif line[0] == 's' :
+                elif line[:1] == 's' :
                     part = line.strip().split()[1:]
                     part[1:5] = [int(part[1]), int(part[2]), part[3], int(part[4])]
                     if part[3] == '+' :
@@ -213,13 +247,17 @@ class last_package(object) :
                         part[1:3] = [part[4]-part[1], part[4]-part[1]-part[2]+1]
                     comparison.extend(part)
                     if len(comparison) >= 13 :
-                        comparison.append([int((m in 'nN') or (n in 'Nn')) for m, n in zip(comparison[6], comparison[12])])
-                elif line[0] in 'pq' :
-                    part = line.strip().split()
-                    comparison[13] = [ max(comparison[13][id], int(b in '!"#$%&\'()*+,-./')) for id, b in enumerate(part[-1])]
-                elif len(line.strip()) == 0 :
-                    if comparison[0] >= 200 : 
-                        comparisons.append( last_package.call_mutation(comparison) )
+                        comparison.append(((encodeSeq(comparison[6]) | 32) == 110) | ((encodeSeq(comparison[12]) | 32) == 110))
+                elif line[:1] in ('p', 'q') :
+                    qual = encodeSeq(line.strip().split()[-1])
+                    comparison[13] = comparison[13][:qual.size] | ((qual >= 33) & (qual <= 47))
+            if comparison is not None and len(comparison) >= 14 :
+                comparison[13] = comparison[13].astype(np.uint8)
+                yield comparison
+
+    @staticmethod
+    def make_alignment( filename ) :
+        comparisons = [ last_package.call_mutation(comparison) for comparison in last_package.read_maf(filename) if comparison[0] >= 200 ]
         
         # remove significant low identity regions in query
         comparisons.sort(key=lambda x: min(x[8:10]) )
@@ -348,10 +386,11 @@ class last_package(object) :
         comparisons = sorted([x for x in comparisons if len(x) > 0 and x[12] != 'E'], key=lambda x: min(x[8:10]) )
         comparisons.sort(key=lambda x: x[7] )
         
+        pairs = overlap_pairs([c[7] for c in comparisons], [min(c[8:10]) for c in comparisons], [max(c[8:10]) for c in comparisons], 1)
+        bounds = np.searchsorted(pairs[0], np.arange(len(comparisons)+1))
         for id, regi in enumerate(comparisons) :
-            for jd in xrange(id+1, len(comparisons)) :
+            for jd in pairs[1][bounds[id]:bounds[id+1]] :
                 regj = comparisons[jd]
-                if regi[7] != regj[7] : break
                 si, ei = sorted(regi[8:10])
                 sj, ej = sorted(regj[8:10])
                 s = max(si, sj)
@@ -374,11 +413,12 @@ class last_package(object) :
         comparisons.sort(key=lambda x: x[2] )
         comparisons.sort(key=lambda x: x[1] )
     
+        pairs = overlap_pairs([c[1] for c in comparisons], [min(c[2:4]) for c in comparisons], [max(c[2:4]) for c in comparisons], 1)
+        bounds = np.searchsorted(pairs[0], np.arange(len(comparisons)+1))
         for id, regi in enumerate(comparisons) :
             if len(regi) == 0 : continue
-            for jd in xrange(id+1, len(comparisons)) :
+            for jd in pairs[1][bounds[id]:bounds[id+1]] :
                 regj = comparisons[jd]
-                if regi[1] != regj[1] : break
                 si, ei = sorted(regi[2:4])
                 sj, ej = sorted(regj[2:4])
                 s = max(si, sj)
@@ -470,29 +510,210 @@ class last_package(object) :
                             compare += '{0}:{1}-{2}:{3};'.format(source[id+0], abs(source[id+4]), abs(source[id+5]), source[id+1])
                         fout.write('{0}\trefMapper\tvariation\t{1}\t{2}\t.\t+\t.\t{3}\n'.format(contig, source[2], source[3], '/replace="{0}";/compare="{1}";/origin="{2}"'.format(difference, compare[:-1], origin)))
 
-def lastAgainst(qry_tag, qry_file, refdb, prefix, ref_file, lastal) :
+def lastAgainst(qry_tag, qry_file, refdb, prefix, ref_file, lastal, gff=False) :
     if not os.path.isfile('{0}.{1}.lastal'.format(prefix, qry_tag)) :
         output = last_package.run_lastal(refdb, qry_file, '{0}.{1}.lastal'.format(prefix, qry_tag), lastal )
     else :
         output = '{0}.{1}.lastal'.format(prefix, qry_tag)
     regions, repeats, mutations = last_package.make_alignment( output )
     os.unlink(output)
-    outfile = '{0}.gff.gz'.format(prefix)
-    last_package.write_down(outfile, regions, repeats, mutations, ref_file, qry_file, qry_tag)
+    if gff :
+        last_package.write_down('{0}.gff.gz'.format(prefix), regions, repeats, mutations, ref_file, qry_file, qry_tag)
+    variations = []
+    for contig, variation in sorted(mutations.items()):
+        for site, alters in sorted(variation.items()) :
+            for alter, source in alters.items() :
+                if source[6][0] == '-' :
+                    variations.append([contig, source[2], '.', '+{0}'.format(source[7])])
+                elif source[7][0] == '-' :
+                    variations.append([contig, source[2], source[6], '-{0}'.format(source[6])])
+                else :
+                    variations.append([contig, source[2], source[6], source[7]])
+    outfile = '{0}.aln.npz'.format(prefix)
+    write_summary(outfile, [ r[1:4] for r in regions ], [ r[:3] for r in repeats ], variations)
     return [qry_tag, outfile]
 
+def write_summary(fname, presences, absences, mutations) :
+    '''Store the outcome of one alignment as typed arrays. 
+    presences and absences are [contig, start, end] (1-based, inclusive); mutations are [contig, site, origin, alteration]. 
+    Overlapping presences are merged in the given order, absences are sorted. 
+    Alleles are kept as one byte string, with the origin and alteration of mutation i in alleles[allele_ptr[2i]:allele_ptr[2i+2]]. '''
+    merged = []
+    for n, s, e in presences :
+        if len(merged) == 0 or merged[-1][0] != n or merged[-1][2] < s :
+            merged.append([n, s, e])
+        elif merged[-1][2] < e :
+            merged[-1][2] = e
+    absences = sorted([ list(a) for a in absences ])
+    contigs = sorted(set([p[0] for p in merged] + [a[0] for a in absences] + [m[0] for m in mutations]))
+    cId = { n:id for id, n in enumerate(contigs) }
+    alleles = [ a.encode() for m in mutations for a in m[2:4] ]
+    np.savez_compressed(fname, contigs=np.array(contigs, dtype=str), 
+             presences=np.array([ [cId[n], s, e] for n, s, e in merged ], dtype=np.int32).reshape(-1, 3), 
+             absences=np.array([ [cId[n], s, e] for n, s, e in absences ], dtype=np.int32).reshape(-1, 3), 
+             mut_sites=np.array([ [cId[m[0]], m[1]] for m in mutations ], dtype=np.int32).reshape(-1, 2), 
+             allele_ptr=np.cumsum([0] + [ len(a) for a in alleles ]).astype(np.int64), 
+             alleles=np.frombuffer(b''.join(alleles), dtype=np.uint8))
+    return fname
+
+def read_summary(fname) :
+    '''Load a summary written by write_summary, as numpy arrays. '''
+    with np.load(fname) as summary :
+        return { k:summary[k] for k in summary.files }
+
+def summary_alleles(summary) :
+    '''[origin, alteration] of every mutation in a summary, as strings. '''
+    ptr, alleles = summary['allele_ptr'].tolist(), summary['alleles'].tobytes()
+    texts = [ alleles[s:e].decode() for s, e in zip(ptr[:-1], ptr[1:]) ]
+    return [ texts[i:i+2] for i in range(0, len(texts), 2) ]
+
+
+def encodeSeq(seq) :
+    return np.frombuffer(seq.encode(), dtype=np.uint8)
+
+baseComplement = np.repeat(ord('N'), 256).astype(np.uint8)
+baseComplement[encodeSeq('ACGT')] = encodeSeq('TGCA')
+
+def expand_cigar(cigar, refStart, qryStart, d) :
+    '''Split a CIGAR string into arrays of operations, lengths and the reference/query coordinates where each operation starts. '''
+    ops = np.array(re.findall(r'(\d+)([MID])', cigar))
+    if ops.size == 0 :
+        return np.zeros(0, dtype='U1'), np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    types, lens = ops.T[1], ops.T[0].astype(int)
+    refLens, qryLens = np.where(types == 'I', 0, lens), np.where(types == 'D', 0, lens)
+    return types, lens, refStart + np.cumsum(refLens) - refLens, qryStart + d*(np.cumsum(qryLens) - qryLens)
+
+def map_qry_repeats(cigar, d, qryRepeat) :
+    '''Convert repetitive regions in the query into reference coordinates. '''
+    types, lens, rs, qs = cigar
+    ops = np.where(types != 'D')[0]
+    if len(qryRepeat) == 0 or ops.size == 0 :
+        return []
+    ends = d*(qs[ops] + lens[ops]*d)
+    qryRepeat = np.array(qryRepeat, dtype=int)
+    if d < 0 :
+        qryRepeat = qryRepeat[:, ::-1]
+    k = np.searchsorted(ends, d*qryRepeat, side='left')
+    kept = k.T[1] < ops.size
+    qryRepeat, k = qryRepeat[kept], ops[k[kept]]
+    repeats = np.where(types[k] == 'M', rs[k] + d*(qryRepeat - qs[k]), rs[k])
+    return repeats.tolist()
+
+def extract_variants(cigar, d, ref, qry) :
+    '''Call SNPs and short indels from an alignment. 
+    Aligned bases are expanded from the CIGAR runs and compared as uint8 arrays in one step. 
+    Returns mutations [ref_site, qry_site, ref_base, qry_base], covered and masked reference intervals (half-open). '''
+    types, lens, rs, qs = cigar
+    refSeq, refQual, refCode, refQCode = ref
+    qrySeq, qryQual, qryCode, qryQCode = qry
+    
+    mId = np.where(types == 'M')[0]
+    mLens = lens[mId]
+    offsets = np.arange(np.sum(mLens)) - np.repeat(np.cumsum(mLens) - mLens, mLens)
+    rSite, qSite = np.repeat(rs[mId], mLens) + offsets, np.repeat(qs[mId], mLens) + offsets*d
+    rBase, qBase = refCode[rSite], qryCode[qSite] if d > 0 else baseComplement[qryCode[qSite]]
+    lowQual = (refQCode[rSite] < 43) | (qryQCode[qSite] < 43)
+    isSNP = (rBase != qBase) & (rBase != 78) & (qBase != 78)
+    
+    # SNPs; ordered by (operation, offset) to follow the alignment
+    snpOrder = np.repeat(mId, mLens)[isSNP]
+    mutations = np.empty([np.sum(isSNP), 4], dtype=object)
+    mutations[:, 0], mutations[:, 1] = rSite[isSNP], qSite[isSNP]
+    mutations[:, 2], mutations[:, 3] = rBase[isSNP].view('S1').astype(str), qBase[isSNP].view('S1').astype(str)
+    
+    # short indels
+    indels, indelOrder = [], []
+    for id in np.where(types != 'M')[0] :
+        cl, r0, q0 = lens[id], rs[id], qs[id]
+        if types[id] == 'I' :
+            q = qrySeq[q0:q0+cl] if d < 0 else rc(qrySeq[(q0-cl+1):(q0+1)])
+            q1 = qryQual[q0:q0+cl] if d > 0 else ''.join(reversed(qrySeq[(q0-cl+1):(q0+1)]))
+            if ord(min(list(q1))) >= 43 :
+                indels.append([r0, min(q0, q0+cl*d), '.', '+' + q])
+                indelOrder.append(id)
+        else :
+            r1 = refQual[r0:r0+cl]
+            if ord(min(list(r1))) >= 43 :
+                indels.append([r0, int(q0+0.5*d), '.', '-' + refSeq[r0:r0+cl]])
+                indelOrder.append(id)
+    if len(indels) :
+        mutations = np.vstack([mutations, np.array(indels, dtype=object)])[np.argsort(np.concatenate([snpOrder, indelOrder]), kind='mergesort')]
+
+    covered = np.vstack([rs[mId], rs[mId] + mLens]).T
+    indelSites = rs[types != 'M']
+    masked = np.vstack([np.vstack([rSite[lowQual], rSite[lowQual]+1]).T, np.vstack([indelSites, indelSites+2]).T])
+    return mutations, covered, masked
+
+def fill_intervals(mask, intervals, value) :
+    '''Set half-open [s, e) intervals in a per-site bitmap to value. '''
+    intervals = np.asarray(intervals, dtype=int).reshape(-1, 2)
+    lens = np.maximum(intervals.T[1] - intervals.T[0], 0)
+    sites = np.repeat(intervals.T[0], lens) + (np.arange(np.sum(lens)) - np.repeat(np.cumsum(lens) - lens, lens))
+    mask[sites[(sites >= 0) & (sites < mask.size)]] = value
+    return mask
+
+def mask_runs(mask) :
+    '''Convert a per-site bitmap into runs of non-zero sites as [start, end] (0-based, inclusive). '''
+    flag = np.diff(np.concatenate([[0], (mask > 0).astype(np.int8), [0]]))
+    return np.vstack([np.where(flag > 0)[0], np.where(flag < 0)[0] - 1]).T
+
+def content_key(files, params) :
+    '''md5 of the content of files, together with the parameters that affect their alignment. '''
+    m = hashlib.md5(params.encode())
+    for fname in files :
+        with open(fname, 'rb') as fin :
+            for chunk in iter(lambda : fin.read(1 << 20), b'') :
+                m.update(chunk)
+    return m.hexdigest()
+
+def aligner_params(aligner) :
+    return ' '.join(['last', last_package.lastdb_params, last_package.lastal_params] if isinstance(aligner, list) else ['minimap2', minimap2_index, minimap2_params])
+
+def cache_store(src, dst) :
+    '''Copy a file into the cache. The copy is written under a hidden name and renamed in place, 
+    so that concurrent runs never see a partial file. '''
+    tmp = os.path.join(os.path.dirname(dst), '.{0}.{1}'.format(os.path.basename(dst), os.getpid()))
+    shutil.copyfile(src, tmp)
+    os.rename(tmp, dst)
+
+def restore_gff(src, dst, reference, query, tag) :
+    '''Copy a cached GFF, with its header lines rewritten for the current reference, query and tag. '''
+    header = { '## Reference:':reference, '## Query:':query, '## Tag:':tag }
+    with uopen(src) as fin, uopen(dst, 'w') as fout :
+        for line in fin :
+            if not line.startswith('#') :
+                fout.write(line)
+                break
+            key = line[:line.find(':')+1]
+            fout.write('{0} {1}\n'.format(key, header[key]) if key in header else line)
+        shutil.copyfileobj(fin, fout)
 
 def alignAgainst(data) :
-    prefix, aligner, db, (rtag, reference), (tag, query) = data
+    prefix, aligner, db, (rtag, reference), (tag, query), gff, cache, n_thread = data
+    if cache :
+        key = os.path.join(cache, content_key([reference, query], aligner_params(aligner)))
+        outputs = [ [key + '.aln.npz', prefix + '.aln.npz'] ] + ([ [key + '.gff.gz', prefix + '.gff.gz'] ] if gff else [])
+        if all([ os.path.isfile(src) for src, dst in outputs ]) :
+            shutil.copyfile(*outputs[0])
+            if gff :
+                restore_gff(outputs[1][0], outputs[1][1], reference, query, tag)
+            return [tag, prefix + '.aln.npz']
     if isinstance(aligner, list) :
-        return lastAgainst(tag, query, db, prefix, reference, aligner[1])
+        res = lastAgainst(tag, query, db, prefix, reference, aligner[1], gff)
+    else :
+        res = minimapAgainst(prefix, aligner, db, reference, tag, query, gff, n_thread)
+    if cache and res[1] == prefix + '.aln.npz' :
+        for dst, src in outputs :
+            cache_store(src, dst)
+    return res
+
+def minimapAgainst(prefix, aligner, db, reference, tag, query, gff, n_thread=1) :
     try :
         qrySeq, qryQual = readFastq(query)
     except :
         return [tag, query]
     refSeq, refQual = readFastq(reference)
-    proc = subprocess.Popen('{0} -c -t1 --frag=yes -A1 -B14 -O24,60 -E2,1 -r100 -g1000 -P -N5000 -f1000,5000 -n2 -m50 -s200 -z200 -2K10m --heap-sort=yes --secondary=yes {1} {2}'.format(
-                                aligner, db, query).split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    proc = subprocess.Popen('{0} -t{4} {3} {1} {2}'.format(aligner, db, query, minimap2_params, n_thread).split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
     alignments = []
     for lineId, line in enumerate(proc.stdout) :
         part = line.strip().split('\t')
@@ -504,36 +725,19 @@ def alignAgainst(data) :
         alignments.append(part)
     proc.wait()
     
+    # an alignment is redundant if >=90% of it is covered by a better one, either in the query or in the reference
     deleteChain = {}
-    nItem = len(alignments)
-    
-    alignments.sort(key=lambda x:x[:4])
-    for i1, p1 in enumerate(alignments) :
-        for i2 in xrange(i1+1, nItem) :
-            p2 = alignments[i2]
-            if p1[0] != p2[0] : break
-
-            s, e = max(p1[2], p2[2]), min(p1[3], p2[3])
-            if s > e+10 :
-                break
-            if (e-s) >= 0.9 * (p1[3]-p1[2]) and p2[13] - 0.1 >= p1[13] :
-                deleteChain[p1[12]] = deleteChain.get(p1[12], set([])) | set([p2[12]])
-            if (e-s) >= 0.9 * (p2[3]-p2[2]) and p1[13] - 0.1 >= p2[13] :
-                deleteChain[p2[12]] = deleteChain.get(p2[12], set([])) | set([p1[12]])
-    alignments.sort(key=lambda x:x[5:9])
-    for i1, p1 in enumerate(alignments) :
-        for i2 in xrange(i1+1, nItem) :
-            p2 = alignments[i2]
-            if p1[5] != p2[5] : break
-
-            s, e = max(p1[7], p2[7]), min(p1[8], p2[8])
-            if s > e+10 :
-                break
-            
-            if (e-s) >= 0.9 * (p1[8]-p1[7]) and p2[13] - 0.05 >= p1[13] :
-                deleteChain[p1[12]] = deleteChain.get(p1[12], set([])) | set([p2[12]])
-            if (e-s) >= 0.9 * (p2[8]-p2[7]) and p1[13] - 0.05 >= p2[13] :
-                deleteChain[p2[12]] = deleteChain.get(p2[12], set([])) | set([p1[12]])
+    for cols, diff in (((0, 2, 3), 0.1), ((5, 7, 8), 0.05)) :
+        alignments.sort(key=lambda x:x[cols[0]:cols[2]+1])
+        contigs, starts, ends = [ [p[c] for p in alignments] for c in cols ]
+        i, j = overlap_pairs(contigs, starts, ends, 11)
+        starts, ends = np.array(starts), np.array(ends)
+        identity, ids = np.array([p[13] for p in alignments]), np.array([p[12] for p in alignments])
+        overlap = np.minimum(ends[i], ends[j]) - np.maximum(starts[i], starts[j])
+        for x, y in ((i, j), (j, i)) :
+            redundant = (overlap >= 0.9 * (ends[x]-starts[x])) & (identity[y] - diff >= identity[x])
+            for id, jd in zip(ids[x[redundant]].tolist(), ids[y[redundant]].tolist()) :
+                deleteChain.setdefault(id, set([])).add(jd)
 
     deleted = {}
     for p in sorted(alignments, key=lambda x:x[11], reverse=True) :
@@ -545,34 +749,21 @@ def alignAgainst(data) :
                     break
     alignments = [p for p in alignments if p[12] not in deleted]
     
-    # repeats in qry
-    nItem = len(alignments)
-    alignments.sort(key=lambda x:x[:4])
-    for i1, p1 in enumerate(alignments) :
-        for i2 in xrange(i1+1, nItem) :
-            p2 = alignments[i2]
-            if p1[0] != p2[0] : break
-            s, e = max(p1[2], p2[2]), min(p1[3], p2[3])
-            if e > s :
-                p1[16].append([s, e])
-                p2[16].append([s, e])
-            else :
-                break
-    # repeats in ref
-    alignments.sort(key=lambda x:x[5:9])
-    for i1, p1 in enumerate(alignments) :
-        for i2 in xrange(i1+1, nItem) :
-            p2 = alignments[i2]
-            if p1[5] != p2[5] : break
-            s, e = max(p1[7], p2[7]), min(p1[8], p2[8])
-            if e > s :
-                p1[15].append([s, e])
-                p2[15].append([s, e])
-            else :
-                break
+    # repeats in qry and in ref
+    for cols, rid in (((0, 2, 3), 16), ((5, 7, 8), 15)) :
+        alignments.sort(key=lambda x:x[cols[0]:cols[2]+1])
+        contigs, starts, ends = [ [p[c] for p in alignments] for c in cols ]
+        i, j = overlap_pairs(contigs, starts, ends)
+        for x, y in zip(i.tolist(), j.tolist()) :
+            p1, p2 = alignments[x], alignments[y]
+            s, e = max(starts[x], starts[y]), min(ends[x], ends[y])
+            p1[rid].append([s, e])
+            p2[rid].append([s, e])
     
+    # per-contig bitmaps of masked sites. 1: low quality or close to indels; 2: repetitive
     maskedRegion = {}
     refRepeat = []
+    encoded = {}
     for p in alignments :
         # prepare a unique set of repeat region
         qryRepeat = []
@@ -583,75 +774,19 @@ def alignAgainst(data) :
                     qryRepeat.append(pp)
                 elif pp[1] > qryRepeat[-1][1]:
                     qryRepeat[-1][1] = pp[1]
-        ref = [refSeq[p[5]], refQual[p[5]]]
-        qry = [qrySeq[p[0]], qryQual[p[0]]]
-        cigar = p[-1][5:]
+        for n, seqs in ((p[5], (refSeq, refQual)), (p[0], (qrySeq, qryQual))) :
+            if n not in encoded :
+                encoded[n] = [seqs[0][n], seqs[1][n], encodeSeq(seqs[0][n]), encodeSeq(seqs[1][n])]
+        ref, qry = encoded[p[5]], encoded[p[0]]
         d = 1 if p[4] == '+' else -1
-        if d < 0 :
-            qryRepeat = [[q[1], q[0], -1, -1] for q in qryRepeat]
-        else :
-            qryRepeat = [[q[0], q[1], -1, -1] for q in reversed(qryRepeat)]
-
-        mut = []
-        alnSite = [p[7], p[2] if d > 0 else p[3]-1]
-        for cl, ct in re.findall(r'(\d+)([MID])', cigar) :
-            cl = int(cl)
-            if ct == 'M' :
-                # extract aligned sequences
-                r = ref[0][alnSite[0]:alnSite[0]+cl]
-                r1 = ref[1][alnSite[0]:alnSite[0]+cl]
-                q = qry[0][alnSite[1]:alnSite[1]+cl] if d > 0 else rc(qry[0][(alnSite[1]-cl+1):(alnSite[1]+1)])
-                q1 = qry[1][alnSite[1]:alnSite[1]+cl] if d > 0 else ''.join(reversed(qry[1][(alnSite[1]-cl+1):(alnSite[1]+1)]))
-
-                e =[alnSite[0]+cl, alnSite[1]+cl*d]
-                for qid in xrange(len(qryRepeat)-1, -1, -1) :
-                    qr = qryRepeat[qid]
-                    if d*qr[0] <= d*e[1] :
-                        if qr[2] == -1 :
-                            qr[2] = alnSite[0] + d*(qr[0] - alnSite[1])
-                        if d*qr[1] <= d*e[1] :
-                            qr[3] = alnSite[0] + d*(qr[1] - alnSite[1])
-                            p[15].append(qr[2:])
-                            del qryRepeat[qid]
-                    else :
-                        break
-                for id, (rr, rr1, qq, qq1) in enumerate(np.array([list(r), list(r1), list(q), list(q1)]).T) :
-                    if ord(rr1) < 43 or ord(qq1) < 43 :
-                        maskedRegion[(p[5], alnSite[0]+id)] = 0
-                    if rr != qq and rr != 'N' and qq != 'N' :
-                        mut.append([alnSite[0]+id, alnSite[1]+id*d, rr, qq, p[4]])
-                alnSite = e
-            elif ct == 'I' :
-                q = qry[0][alnSite[1]:alnSite[1]+cl] if d < 0 else rc(qry[0][(alnSite[1]-cl+1):(alnSite[1]+1)] )
-                q1 = qry[1][alnSite[1]:alnSite[1]+cl] if d > 0 else ''.join(reversed(qry[0][(alnSite[1]-cl+1):(alnSite[1]+1)] ))
-                
-                e = alnSite[1] + cl*d
-                for qid in xrange(len(qryRepeat)-1, -1, -1) :
-                    qr = qryRepeat[qid]
-                    if d*qr[0] <= d*e :
-                        if qr[2] == -1 :
-                            qr[2] = alnSite[0]
-                        if d*qr[1] <= d*e :
-                            qr[3] = alnSite[0]
-                            p[15].append(qr[2:])
-                            del qryRepeat[qid]
-                    else :
-                        break
-                
-                if ord(min(list(q1))) >= 43 :
-                    mut.append([alnSite[0], min(alnSite[1], e), '.', '+' + q, p[4]])
-                for site in xrange(alnSite[0], alnSite[0]+2) :
-                    maskedRegion[(p[5], site)] = 0
-                alnSite[1] = e
-            elif ct == 'D' :
-                r = ref[0][alnSite[0]:alnSite[0]+cl]
-                r1 = ref[1][alnSite[0]:alnSite[0]+cl]
-                if ord(min(list(r1))) >= 43 :
-                    mut.append([alnSite[0], int(alnSite[1]+0.5*d), '.', '-' + r, p[4]])
-                for site in xrange(alnSite[0], alnSite[0]+2) :
-                    maskedRegion[(p[5], site)] = 0
-                alnSite[0]+=cl
-        p[14] = mut
+        cigar = expand_cigar(p[-1][5:], p[7], p[2] if d > 0 else p[3]-1, d)
+        
+        p[15].extend(map_qry_repeats(cigar, d, qryRepeat))
+        mut, covered, masked = extract_variants(cigar, d, ref, qry)
+        if p[5] not in maskedRegion :
+            maskedRegion[p[5]] = np.zeros(len(ref[0]), dtype=np.uint8)
+        fill_intervals(maskedRegion[p[5]], masked, 1)
+        p[14] = [ m + [p[4]] for m in mut.tolist() ]
         refRepeat.extend([ [p[5], pp[0], pp[1]] for pp in p[15] ])
 
     repeats = []
@@ -665,28 +800,33 @@ def alignAgainst(data) :
                 repeats[-1][2] = p[2]
 
     for p in repeats :
-        for site in xrange(p[1], p[2]) :
-            maskedRegion[(p[0], site)] = 1
+        maskedRegion[p[0]][p[1]:p[2]] = 2
 
-    repeats = []
-    for cont, site in sorted(maskedRegion) :
-        if len(repeats) == 0 or repeats[-1][0] != cont or repeats[-1][2]+1 < site :
-            repeats.append([cont, site, site])
-        else :
-            repeats[-1][2] = site
+    repeats = [ [cont, s, e] for cont in sorted(maskedRegion) for s, e in mask_runs(maskedRegion[cont]).tolist() ]
   
     mutations = []
     alignments = [aln for aln in alignments if aln[9] >= 100]
     for aln in alignments :
+        mask = maskedRegion[aln[5]]
         for m in aln[14] :
             if len(m[3]) == 1 :
-                if (aln[5], m[0]) not in maskedRegion :
+                if mask[m[0]] == 0 :
                     mutations.append([aln[5], aln[0]] + m)
-            elif maskedRegion.get((aln[5], m[0]), 0) != 1 :
-                if m[3].startswith('-') and maskedRegion.get((aln[5], m[0]+len(m[3])-2), 0) > 0 :
+            elif mask[m[0]] != 2 :
+                if m[3].startswith('-') and mask[m[0]+len(m[3])-2] == 2 :
                     continue
                 mutations.append([aln[5], aln[0]] + m)
-    with uopen(prefix + '.gff.gz', 'w') as fout :
+    for mut in mutations :
+        mut.append(mut[5] if len(mut[5]) <= 26 else '{0}[{1}bps]'.format(mut[5][0], len(mut[5])-1))
+    write_summary(prefix + '.aln.npz', [ [aln[5], aln[7]+1, aln[8]] for aln in alignments ], 
+                  [ [p[0], p[1]+1, p[2]+1] for p in repeats ], 
+                  [ [mut[0], mut[2]+1, mut[4], mut[7]] for mut in mutations ])
+    if gff :
+        write_gff(prefix + '.gff.gz', reference, query, tag, alignments, repeats, mutations)
+    return [tag, prefix + '.aln.npz']
+
+def write_gff(fname, reference, query, tag, alignments, repeats, mutations) :
+    with uopen(fname, 'w') as fout :
         fout.write('##gff-version 3\n')
         fout.write('## Reference: {0}\n'.format(reference))
         fout.write('## Query: {0}\n'.format(query))
@@ -708,189 +848,324 @@ def alignAgainst(data) :
         for mut in mutations :
             e1 = mut[2] if not mut[5].startswith('-') else mut[2] + len(mut[5]) - 2
             e2 = mut[3] if not mut[5].startswith('+') else mut[3] + len(mut[5]) - 2
-            if len(mut[5]) > 26 :
-                mut[5] = '{0}[{1}bps]'.format(mut[5][0], len(mut[5])-1)
-
             fout.write('{0}\trefMapper\tvariation\t{1}\t{2}\t.\t+\t.\t/replace="{7}";/compare="{3}:{4}-{5}:{8}";/origin="{6}"\n'.format(
-                mut[0], mut[2]+1, e1+1, mut[1], mut[3]+1, e2+1, mut[4], mut[5], mut[6]
+                mut[0], mut[2]+1, e1+1, mut[1], mut[3]+1, e2+1, mut[4], mut[7], mut[6]
             ))
+    return fname
 
-    return [tag, prefix + '.gff.gz']
+# columns of the block records: presences and absences are [block, start, end, genome, weight], 
+# snps are [block, site, genome, code] and indels are [block, site, genome, offset, length] of their alleles
+record_types = dict(presences=5, absences=5, snps=4, indels=5)
 
 def readMap(data) :
-    mTag, mFile = data
-    presences, absences, mutations = [], [], []
+    '''Cut the summary of one genome into block records, sorted by block. 
+    Contigs start at block boundaries, from the blocks given in blockBase. Returns the records and the bytes of the indel alleles. '''
+    mTag, mFile, contigs, sizes, blockBase, blockSize, j, w = data
+    summary = read_summary(mFile)
+    cId = np.array([ contigs.get(n, -1) for n in summary['contigs'].tolist() ] + [-1], dtype=np.int64)
     
-    aligns = ['', 0, 0]
-    miss = -1
-    with uopen(mFile) as fin :
-        for line in fin :
-            if line.startswith('##') :
-                if line.startswith('## Reference: ') :
-                    ref = line.split(' ')[-1]
-                elif line.startswith('## Query: ') :
-                    qry = line.split(' ')[-1]
-                    if ref == qry :
-                        miss = -99999999
-            else :
-                break
-    #print(mTag, mFile)
-    with uopen(mFile) as fin :
-        for line in fin :
-            if line.startswith('#') : continue
-            part = line.strip().split('\t')
-            part[3:5] = [int(part[3]), int(part[4])]
-            if part[2] == 'misc_feature' :
-                if len(presences) == 0 or presences[-1][0] != part[0] or presences[-1][2] < part[3] :
-                    presences.append([part[0], part[3], part[4]])
-                elif presences[-1][2] < part[4] :
-                    presences[-1][2] = part[4]
-            elif part[2] == 'unsure' :
-                absences.append([part[0], part[3], part[4], miss])
-            elif part[2] == 'variation' :
-                alt = re.findall(r'replace="([^"]+)"', part[8])
-                ori = re.findall(r'origin="([^"]+)"', part[8])
-                if len(alt) and len(ori) :
-                    mutations.append([mTag, part[0], part[3], ori[0], alt[0]])
-    return presences, sorted(absences), mutations
+    records = {}
+    for key, iv, weight in (('presences', summary['presences'], 1), ('absences', summary['absences'], w)) :
+        c = cId[iv.T[0]]
+        iv, c = iv[c >= 0], c[c >= 0]
+        offset = blockBase[c] * blockSize
+        blocks, pieces = split_blocks(np.vstack([np.maximum(iv.T[1]-1, 0) + offset, np.minimum(iv.T[2], sizes[c]) + offset]).T, blockSize)
+        records[key] = np.vstack([blocks, pieces.T[0], pieces.T[1], np.repeat(j, blocks.size), np.repeat(weight, blocks.size)]).T
+    
+    sites, ptr, alleles = summary['mut_sites'].astype(np.int64), summary['allele_ptr'], summary['alleles']
+    c = cId[sites.T[0]]
+    kept = (c >= 0) & (sites.T[1] >= 1) & (sites.T[1] <= sizes[c])
+    sites, altStarts, altEnds = blockBase[c[kept]] * blockSize + sites[kept, 1] - 1, ptr[1::2][kept], ptr[2::2][kept]
+    isSNP = altEnds - altStarts == 1
+    records['snps'] = np.vstack([sites[isSNP] // blockSize, sites[isSNP] % blockSize, np.repeat(j, np.sum(isSNP)), alleles[altStarts[isSNP]]]).T
+    alleles = [ alleles[s:e].tobytes() for s, e in zip(altStarts[~isSNP].tolist(), altEnds[~isSNP].tolist()) ]
+    lens = np.array([ len(a) for a in alleles ], dtype=np.int64)
+    records['indels'] = np.vstack([sites[~isSNP] // blockSize, sites[~isSNP] % blockSize, np.repeat(j, lens.size), np.cumsum(lens) - lens, lens]).T
+    return { key:r[np.argsort(r.T[0], kind='mergesort')].astype(np.int64).reshape(-1, record_types[key]) for key, r in records.items() }, b''.join(alleles)
 
-def getMatrix(prefix, reference, alignments, lowq_aligns, core, matrixOut, alignmentOut) :
-    refSeq, refQual = readFastq(reference[1])
-    coreSites = { n:np.zeros(len(refSeq[n]), dtype=int) for n in refSeq }
-    matSites = { n:np.zeros(len(refSeq[n]), dtype=int) for n in refSeq }
-    alnId = { aln[0]:id for id, aln in enumerate(alignments+lowq_aligns) }
-    res = pool.map(readMap, alignments+lowq_aligns)
-    res, low_res = res[:len(alignments)], res[len(alignments):]
+def load_records(fname, nCol) :
+    if os.path.getsize(fname) == 0 :
+        return np.zeros([0, nCol], dtype=np.int64)
+    return np.memmap(fname, dtype=np.int64, mode='r').reshape(-1, nCol)
+
+def sort_records(prefix, nCol, counts, chunk=2**22) :
+    '''Stable counting sort of the spilled records in prefix.raw by their blocks, into prefix.npy, a chunk of rows at a time. 
+    The records of block b are rows ptr[b]:ptr[b+1], with ptr saved in prefix.ptr.npy. '''
+    raw = load_records(prefix + '.raw', nCol)
+    ptr = np.concatenate([[0], np.cumsum(counts)])
+    np.save(prefix + '.ptr.npy', ptr)
+    if raw.shape[0] == 0 :
+        np.save(prefix + '.npy', raw)
+        return
+    out = np.lib.format.open_memmap(prefix + '.npy', mode='w+', dtype=np.int64, shape=(raw.shape[0], nCol))
+    fill = ptr[:-1].copy()
+    for s in xrange(0, raw.shape[0], chunk) :
+        r = np.array(raw[s:s+chunk])
+        order = np.argsort(r.T[0], kind='mergesort')
+        blocks = r.T[0][order]
+        out[fill[blocks] + np.arange(blocks.size) - np.searchsorted(blocks, blocks)] = r[order]
+        fill += np.bincount(blocks, minlength=fill.size)
+    out.flush()
+    del out
+
+def write_block_store(store, tasks, nBlock) :
+    '''Spill the block records of the genomes into store one genome at a time, then sort them by block. 
+    Returns the first row of every genome in the spilled (genome-major) records. '''
+    counts = { key:np.zeros(nBlock, dtype=np.int64) for key in record_types }
+    genomeRows = { key:[0] for key in record_types }
+    fouts = { key:open(os.path.join(store, key + '.raw'), 'wb') for key in list(record_types) + ['alleles'] }
+    nAllele = 0
+    for records, alleles in pool.imap(readMap, tasks) :
+        records['indels'].T[3] += nAllele
+        nAllele += len(alleles)
+        fouts['alleles'].write(alleles)
+        for key, r in records.items() :
+            fouts[key].write(r.tobytes())
+            counts[key] += np.bincount(r.T[0], minlength=nBlock)
+            genomeRows[key].append(genomeRows[key][-1] + r.shape[0])
+    for fout in fouts.values() :
+        fout.close()
+    for key, nCol in record_types.items() :
+        sort_records(os.path.join(store, key), nCol, counts[key])
+    return genomeRows
+
+block_stores = {}
+def open_block_store(store) :
+    '''Memory-map the sorted block records in store, once per process. '''
+    if store not in block_stores :
+        block_stores.clear()
+        records = { key:[np.load(os.path.join(store, key + '.npy'), mmap_mode='r'), np.load(os.path.join(store, key + '.ptr.npy'))] for key in record_types }
+        alleles = os.path.join(store, 'alleles.raw')
+        records['alleles'] = np.memmap(alleles, dtype=np.uint8, mode='r') if os.path.getsize(alleles) else np.zeros(0, dtype=np.uint8)
+        block_stores[store] = records
+    return block_stores[store]
+
+def read_block(store, b) :
+    '''Load the presences, absences, snps and indels of block b from the store, without their block column. '''
+    records = open_block_store(store)
+    presences, absences, snps, indels = [ np.array(records[key][0][records[key][1][b]:records[key][1][b+1], 1:]) for key in ('presences', 'absences', 'snps', 'indels') ]
+    alleles = records['alleles']
+    return presences, absences, snps, [ [site, j, alleles[o:o+n].tobytes().decode()] for site, j, o, n in indels.tolist() ]
+
+def split_blocks(intervals, size) :
+    '''Cut [start, end, ...] intervals at block boundaries. Returns block ids and the pieces in block coordinates. '''
+    s, e = intervals.T[0], intervals.T[1]
+    nb = np.where(e > s, (e-1)//size - s//size + 1, 0)
+    idx = np.repeat(np.arange(nb.size), nb)
+    blocks = np.repeat(s//size, nb) + (np.arange(idx.size) - np.repeat(np.cumsum(nb) - nb, nb))
+    pieces = intervals[idx]
+    pieces.T[0] = np.maximum(pieces.T[0], blocks*size) - blocks*size
+    pieces.T[1] = np.minimum(pieces.T[1], (blocks+1)*size) - blocks*size
+    return blocks, pieces
+
+def gzip_member(content) :
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    return compressor.compress(content) + compressor.flush()
+
+def matrix_block(data) :
+    '''Merge all genomes over one block of reference sites as a uint8 sites x genomes array. 
+    Returns the statistics of the block, a gzip member of matrix rows and optionally the aligned sequences. '''
+    contig, b, bs, refCode, store, nGenome, nCore, coreNum, withMatrix, withSeq = data
+    presences, absences, snps, indels = read_block(store, b)
+    nSite = refCode.size
+    
+    # presence: covered by an alignment and not in any uncertain region
+    covers, uncertain, core = np.zeros([nSite+1, nGenome], dtype=np.int32), np.zeros([nSite+1, nGenome], dtype=np.int32), np.zeros(nSite+1, dtype=np.int64)
+    for cnt, (s, e, j, w) in ((covers, presences.T), (uncertain, absences.T)) :
+        np.add.at(cnt, (s, j), 1)
+        np.add.at(cnt, (e, j), -1)
+        inCore = j < nCore
+        np.add.at(core, s[inCore], w[inCore])
+        np.add.at(core, e[inCore], -w[inCore])
+    present = (np.cumsum(covers[:nSite], 0) > 0) & (np.cumsum(uncertain[:nSite], 0) == 0)
+    core = np.cumsum(core[:nSite])
+    del covers, uncertain
+    
+    # SNPs; the last record of a genome in a site wins
+    sites, j, codes = snps.T
+    snpSites, snpIdx = np.unique(sites, return_inverse=True)
+    rows = np.where(present[snpSites], 46, 45).astype(np.uint8)
+    _, last = np.unique((snpIdx * nGenome + j)[::-1], return_index=True)
+    last = sites.size - 1 - last
+    rows[snpIdx[last], j[last]] = codes[last]
+    
+    indelRows = {}
+    for site, j, allele in indels :
+        if site not in indelRows :
+            indelRows[site] = [ '.' if p else '-' for p in present[site] ]
+        indelRows[site][j] = allele
+    indelSites = np.array(sorted(indelRows), dtype=int)
+    
+    isCore = core >= coreNum
+    partial = indelSites[(core[indelSites] >= 1) & ~isCore[indelSites]]
+    core[partial] = 1
+    stats = np.unique(np.maximum(core, 0), return_counts=True)
+    missings = [ [contig, s+bs+1, e+bs+1] for s, e in mask_runs(~isCore).tolist() ]
     
-    matrix = {}
-    for r in (res, low_res) :
-        for presences, absences, mutations in r :
-            for mut in mutations :
-                j = alnId[mut[0]]
-                site = tuple(mut[1:3])
-                if site not in matrix :
-                    matrix[site] = [[], []]
-                    matSites[mut[1]][mut[2]-1] = mut[2]
-                if len(mut[4]) == 1 :
-                    if len(matrix[site][0]) == 0 :
-                        matrix[site][0] = ['-' for id in alnId]
-                    matrix[site][0][j] = mut[4]
+    # SNPs in core genome that are identical in all present genomes are constant sites
+    hasSNP = np.zeros(nSite, dtype=bool)
+    hasSNP[snpSites] = True
+    kept = isCore[snpSites]
+    rows, snpSites = rows[kept], snpSites[kept]
+    rows = np.where(rows == 46, refCode[snpSites][:, np.newaxis], rows).astype(np.uint8)
+    mx = np.where(rows == 45, 0, rows).max(1) if rows.size else np.zeros(0, dtype=np.uint8)
+    constant = (np.where(rows == 45, 255, rows).min(1) == mx) if rows.size else np.zeros(0, dtype=bool)
+    constBases = np.bincount(refCode[isCore & ~hasSNP], minlength=256) + np.bincount(mx[constant], minlength=256)
+    rows, snpSites = rows[~constant], snpSites[~constant]
+    
+    lines = []
+    if rows.size :
+        buf = np.full([rows.shape[0], 2*nGenome], 9, dtype=np.uint8)
+        buf[:, ::2], buf[:, -1] = rows, 10
+        lines = [ [site, 0, buf[i].tobytes()] for i, site in enumerate(snpSites.tolist()) ]
+    lines.extend([ [site, 1, ('\t'.join(indelRows[site]) + '\n').encode()] for site in indelSites[isCore[indelSites]].tolist() ])
+    body = gzip_member(b''.join([ '{0}\t{1}\t'.format(contig, site+bs+1).encode() + line for site, _, line in sorted(lines) ])) if withMatrix else b''
+    
+    return stats, missings, constBases, body, [snpSites + bs, rows] if withSeq else None
+
+def write_alignment(fname, genomes, refSeq, contigs, store, genomeRows, blockBase, blockSize, missings, variable) :
+    '''Write the pseudo-alignment genome by genome. 
+    Each sequence is generated on demand from the reference, the spilled block records of the genome and its column in the variable sites, 
+    using a single buffer per contig. '''
+    groups = [ [load_records(os.path.join(store, key + '.raw'), record_types[key]), genomeRows[key]] for key in ('presences', 'absences') ]
+    with uopen(fname, 'w') as fout :
+        for c, n in enumerate(contigs) :
+            refCode = encodeSeq(refSeq[n])
+            isCore = np.ones(refCode.size, dtype=bool)
+            fill_intervals(isCore, [ [s-1, e] for cont, s, e in missings if cont == n ], False)
+            cSites, cRows = variable[c]
+            seq = np.empty(refCode.size, dtype=np.uint8)
+            if c :
+                fout.write('=\n')
+            for j, (mTag, mFile) in enumerate(genomes) :
+                if j == 0 :
+                    present = isCore
                 else :
-                    if len(matrix[site][1]) == 0 :
-                        matrix[site][1] = ['-' for id in alnId]
-                    matrix[site][1][j] = mut[4]
-    for gid, aln, r in ((0, alignments, res), (1, lowq_aligns, low_res)) :
-        for (mTag, mFile), (presences, absences, mutations) in zip(aln, r) :
-            j = alnId[mTag]
-            for n, s, e in presences :
-                if gid == 0 :
-                    coreSites[n][s-1:e] +=1
-                mutations = matSites[n][s-1:e]
-                for kk in mutations[mutations > 0] :
-                    k = (n, kk)
-                    if len(matrix[k][0]) and matrix[k][0][j] == '-' :
-                        matrix[k][0][j] = '.'
-                    if len(matrix[k][1]) and matrix[k][1][j] == '-' :
-                        matrix[k][1][j] = '.'
-            for n, s, e, m in absences :
-                if gid == 0 :
-                    coreSites[n][s-1:e] -= (1 if mTag not in reference else len(alignments)+1)
-                mutations = matSites[n][s-1:e]
-                for kk in mutations[mutations > 0] :
-                    k = (n, kk)
-                    if len(matrix[k][0]) and matrix[k][0][j] == '.' :
-                        matrix[k][0][j] = '-'
-                    if len(matrix[k][1]) and matrix[k][1][j] == '.' :
-                        matrix[k][1][j] = '-'
+                    cover = []
+                    for iv, rows in groups :
+                        diff = np.zeros(refCode.size + 1, dtype=np.int32)
+                        iv = iv[rows[j]:rows[j+1]]
+                        iv = np.array(iv[np.searchsorted(iv.T[0], blockBase[c]):np.searchsorted(iv.T[0], blockBase[c+1])])
+                        offset = (iv.T[0] - blockBase[c]) * blockSize
+                        np.add.at(diff, iv.T[1] + offset, 1)
+                        np.add.at(diff, iv.T[2] + offset, -1)
+                        cover.append(np.cumsum(diff[:-1]))
+                    present = isCore & (cover[0] > 0) & (cover[1] == 0)
+                seq.fill(45)
+                np.copyto(seq, refCode, where=present)
+                seq[cSites] = cRows[:, j]
+                fout.write('>{0}:{1}\n{2}\n'.format(mTag, n, seq.tobytes().decode()))
+    return fname
+
+def getMatrix(prefix, reference, alignments, lowq_aligns, core, matrixOut, alignmentOut) :
+    refSeq, refQual = readFastq(reference[1])
+    genomes = alignments + lowq_aligns
+    nGenome, nCore = len(genomes), len(alignments)
     coreNum = max(len(alignments) * core, 1)
-    for n in sorted(coreSites) :
-        sites = coreSites[n]
-        for site, num in enumerate(sites) :
-            cSite = (n, site+1)
-            if 1 <= num < coreNum and cSite in matrix and len(matrix[cSite][1]) > 0 :
-                sites[site] = np.sum(matrix[cSite][1] != '-')
-                matrix[cSite][0] = []
+    contigs = sorted(refSeq)
+    cId = { n:id for id, n in enumerate(contigs) }
     
-    pres = np.concatenate(list(coreSites.values()))
-    pres[pres < 0] = 0
-    pres = list(np.unique(pres, return_counts=True))
+    # each block holds at most 16M sites x genomes. Records of all genomes are spilled to a scratch folder and sorted by block, 
+    # so that each block task reads only its own slice
+    blockSize = max(1024, 2**24 // nGenome)
+    sizes = np.array([ len(refSeq[n]) for n in contigs ], dtype=np.int64)
+    blockBase = np.concatenate([[0], np.cumsum((sizes + blockSize - 1) // blockSize)])
+    store = tempfile.mkdtemp(prefix=os.path.basename(prefix)+'.', dir=os.path.dirname(os.path.abspath(prefix)))
+    try :
+        genomeRows = write_block_store(store, [ [mTag, mFile, cId, sizes, blockBase, blockSize, j, -1 if mTag not in reference else -nCore-1] for j, (mTag, mFile) in enumerate(genomes) ], int(blockBase[-1]))
+        def iter_blocks(c, refCode) :
+            for b in xrange(int(blockBase[c]), int(blockBase[c+1])) :
+                bs = (b - int(blockBase[c])) * blockSize
+                yield [contigs[c], b, bs, refCode[bs:bs+blockSize], store, nGenome, nCore, coreNum, matrixOut, alignmentOut]
+        
+        stats, missings, coreBases = {}, [], np.zeros(256, dtype=np.int64)
+        # rows of variable sites are kept on disk for the alignment writer
+        variable = [[] for n in contigs]
+        with open(prefix + '.matrix.tmp', 'wb') as body_out, open(prefix + '.fasta.tmp', 'wb') as row_out :
+            for c, n in enumerate(contigs) :
+                for (values, counts), missing, constBases, body, kept in pool.imap(matrix_block, iter_blocks(c, encodeSeq(refSeq[n]))) :
+                    for v, cnt in zip(values.tolist(), counts.tolist()) :
+                        stats[v] = stats.get(v, 0) + cnt
+                    for m in missing :
+                        if len(missings) and missings[-1][0] == m[0] and missings[-1][2] + 1 >= m[1] :
+                            missings[-1][2] = m[2]
+                        else :
+                            missings.append(m)
+                    coreBases += constBases
+                    body_out.write(body)
+                    if alignmentOut :
+                        variable[c].append(kept[0])
+                        row_out.write(kept[1].tobytes())
     
-    for p, n in zip(*pres) :
-        sys.stderr.write('#{2} {0} {1}\n'.format(p if p >= 1 else 'Repetitive', n, '' if p >= coreNum else '#'))
-
-    missings = []
-    coreBases = {'A':0, 'C':0, 'G':0, 'T':0}
-    for n in sorted(coreSites) :
-        sites = coreSites[n]
-        for site, num in enumerate(sites) :
-            cSite = (n, site+1)
-            if num < coreNum :
-                matrix.pop(cSite, None)
-                if len(missings) == 0 or missings[-1][0] != n or missings[-1][2] + 1 < cSite[1] :
-                    missings.append([n, cSite[1], cSite[1]])
-                else :
-                    missings[-1][2] = cSite[1]
+        for p in sorted(stats) :
+            sys.stderr.write('#{2} {0} {1}\n'.format(p if p >= 1 else 'Repetitive', stats[p], '' if p >= coreNum else '#'))
+
+        outputs = {}
+        if matrixOut :
+            outputs['matrix'] = prefix + '.matrix.gz'
+            header = ['## Constant_bases: {0} {1} {2} {3}\n'.format(*coreBases[encodeSeq('ACGT')])]
+            header.extend([ '## Sequence_length: {0} {1}\n'.format(n, len(refSeq[n])) for n in refSeq ])
+            header.extend([ '## Missing_region: {0} {1} {2}\n'.format(*region) for region in missings ])
+            header.append('\t'.join(['#Seq', '#Site'] + [ mTag for mTag, mFile in genomes ]) + '\n')
+            with open(prefix + '.matrix.gz', 'wb') as fout, open(prefix + '.matrix.tmp', 'rb') as fin :
+                fout.write(gzip_member(''.join(header).encode()))
+                shutil.copyfileobj(fin, fout)
+        os.unlink(prefix + '.matrix.tmp')
+        if alignmentOut :
+            sites = [ np.concatenate(v) for v in variable ]
+            if np.sum([ v.size for v in sites ]) :
+                rows = np.memmap(prefix + '.fasta.tmp', dtype=np.uint8, mode='r').reshape(-1, nGenome)
             else :
-                b = refSeq[n][cSite[1]-1]
-                if cSite in matrix and len(matrix[cSite][0]) :
-                    matrix[cSite][0] = [ (b if s == '.' else s) for s in matrix[cSite][0]]
-                    t = np.unique(matrix[cSite][0])
-                    t = t[t!= '-']
-                    if len(t) == 1 :
-                        coreBases[t[0]] = coreBases.get(t[0], 0) + 1
-                        matrix[cSite][0] = []
-                else :
-                    coreBases[b] = coreBases.get(b, 0) + 1
-
-    outputs = {}
-    if matrixOut :
-        outputs['matrix'] = prefix + '.matrix.gz'
-        with uopen(prefix + '.matrix.gz', 'w') as fout :
-            fout.write('## Constant_bases: {A} {C} {G} {T}\n'.format(**coreBases))
-            for n in refSeq :
-                fout.write('## Sequence_length: {0} {1}\n'.format(n, len(refSeq[n])))
-            for region in missings :
-                fout.write('## Missing_region: {0} {1} {2}\n'.format(*region))
-            fout.write('\t'.join(['#Seq', '#Site'] + [ mTag for mTag, mFile in alignments + lowq_aligns ]) + '\n')
-            for site in sorted(matrix) :
-                bases = matrix[site]
-                if len(bases[0]) :
-                    fout.write('{0}\t{1}\t{2}\n'.format(site[0], site[1], '\t'.join(bases[0])))
-                if len(bases[1]) :
-                    fout.write('{0}\t{1}\t{2}\n'.format(site[0], site[1], '\t'.join(bases[1])))
-    if alignmentOut :
-        outputs['alignment'] = prefix + '.fasta.gz'
-        sequences = []
-        low_seq = []
-        for sequence, aln, r in ((sequences, alignments, res), (low_seq, lowq_aligns, low_res)) :
-            for (mTag, mFile), (presences, absences, mutations) in zip(aln, r) :
-                j = alnId[mTag]
-                seq = { n:['-']*len(s) for n, s in refSeq.items() } if j > 0 else { n:list(s) for n, s in refSeq.items() }
-                if j :
-                    for n, s, e in presences :
-                        seq[n][s-1:e] = refSeq[n][s-1:e]
-                    for n, s, e, c in absences :
-                        seq[n][s-1:e] = '-' * (e-s+1)
-                for n, s, e in missings :
-                    seq[n][s - 1:e] = '-' * (e - s + 1)
-                for site in matrix :
-                    bases = matrix[site]
-                    if len(bases[0]) :
-                        seq[site[0]][site[1]-1] = bases[0][j]
-                sequence.append(seq)
-        with uopen(prefix + '.fasta.gz', 'w') as fout :
-            for id, n in enumerate(sorted(refSeq)) :
-                if id :
-                    fout.write('=\n')
-                for (mTag, mFile), seq in zip(alignments, sequences) :
-                    fout.write('>{0}:{1}\n{2}\n'.format(mTag, n, ''.join(seq[n])))
-                for (mTag, mFile), seq in zip(lowq_aligns, low_seq) :
-                    fout.write('>{0}:{1}\n{2}\n'.format(mTag, n, ''.join(seq[n])))
+                rows = np.zeros([0, nGenome], dtype=np.uint8)
+            bounds = np.cumsum([0] + [ v.size for v in sites ])
+            variable = [ [v, rows[s:e]] for v, s, e in zip(sites, bounds[:-1], bounds[1:]) ]
+            outputs['alignment'] = write_alignment(prefix + '.fasta.gz', genomes, refSeq, contigs, store, genomeRows, blockBase, blockSize, missings, variable)
+            del rows
+        os.unlink(prefix + '.fasta.tmp')
+    finally :
+        shutil.rmtree(store, ignore_errors=True)
     return outputs
 
-def runAlignment(prefix, reference, queries, core, aligner) :
-    #alignments = list(map(alignAgainst, [[prefix +'.' + query[0].rsplit('.', 1)[0] + '.' + str(id+1), aligner, prefix + '.mmi', reference, query] for id, query in enumerate(queries)]))
-    alignments = pool.map(alignAgainst, [[prefix +'.' + query[0].rsplit('.', 1)[0] + '.' + str(id+1), aligner, prefix + '.mmi', reference, query] for id, query in enumerate(queries)])
+def estimate_cost(query, sample=2**20) :
+    '''Rough cost of aligning a genome: its length plus a penalty for every contig. 
+    The length comes from the file size (or the size trailer of a gzip file) and the number of contigs is extrapolated from its first MB. '''
+    try :
+        with open(query, 'rb') as fin :
+            gzipped = fin.read(2) == b'\x1f\x8b'
+            if gzipped :
+                fin.seek(-4, 2)
+                size = int(np.frombuffer(fin.read(4), dtype='<u4')[0])
+            else :
+                size = os.path.getsize(query)
+        with (gzip.open(query, 'rb') if gzipped else open(query, 'rb')) as fin :
+            head = fin.read(sample)
+    except :
+        return 0
+    return size + 10000 * head.count(b'>') * max(size, 1) / max(len(head), 1)
+
+def alignIndexed(data) :
+    return data[0], alignAgainst(data[1])
+
+def runAlignment(prefix, reference, queries, core, aligner, gff=False, cache=None, n_proc=1) :
+    tasks = [[prefix +'.' + query[0].rsplit('.', 1)[0] + '.' + str(id+1), aligner, prefix + '.mmi', reference, query, gff, cache, 1] for id, query in enumerate(queries)]
+    #alignments = list(map(alignAgainst, tasks))
+    # largest genomes first, one thread each. The k-th task from the end gets n_proc // k threads and 
+    # waits until that many are free, so the total never exceeds n_proc
+    costs = pool.map(estimate_cost, [query[1] for query in queries])
+    waiting = sorted(range(len(tasks)), key=lambda i:costs[i])
+    alignments, running, finished = [None] * len(tasks), {}, queue.Queue()
+    while len(waiting) or len(running) :
+        while len(waiting) and n_proc - sum(running.values()) >= max(1, n_proc // len(waiting)) :
+            n_thread = max(1, n_proc // len(waiting))
+            i = waiting.pop()
+            tasks[i][-1] = running[i] = n_thread
+            pool.apply_async(alignIndexed, ([i, tasks[i]], ), callback=finished.put, error_callback=finished.put)
+        res = finished.get()
+        if isinstance(res, BaseException) :
+            raise res
+        i, alignment = res
+        alignments[i] = alignment
+        running.pop(i)
 
     try :
         os.unlink(reference + '.mmi')
@@ -899,9 +1174,9 @@ def runAlignment(prefix, reference, queries, core, aligner) :
     return alignments
 
 
-def prepReference(prefix, ref_tag, reference, aligner, pilercr, trf, **args) :
+def prepReference(prefix, ref_tag, reference, aligner, pilercr, trf, gff=False, cache=None, n_thread=1, **args) :
     def mask_tandem(fasta_file) :
-        cmd = '{0} {1} 2 4 7 80 10 60 2000 -d -h -ngs'.format(trf, fasta_file)
+        cmd = '{0} {1} {2}'.format(trf, fasta_file, trf_params)
         trf_run = subprocess.Popen(cmd.split(), stdout=subprocess.PIPE, universal_newlines=True)
     
         region = []
@@ -933,10 +1208,24 @@ def prepReference(prefix, ref_tag, reference, aligner, pilercr, trf, **args) :
         return region
     # prepare reference
     if reference :
+        refPrefix = prefix +'.' + ref_tag.rsplit('.', 1)[0] + '.0'
+        outputs = ([ [refPrefix + '.gff.gz', '.ref.gff.gz'] ] if gff else []) + [ [refPrefix + '.aln.npz', '.ref.aln.npz'] ]
+        if cache :
+            # the index, the masks and the self-alignment of the reference are reused as a whole. 
+            # the summary is stored last, so its presence means the entry is complete
+            key = os.path.join(cache, content_key([reference], ' '.join([aligner_params(aligner), trf_params, 'pilercr'])))
+            if all([ os.path.isfile(key + suffix) for fname, suffix in outputs ]) :
+                # a LAST database is a set of files; partial copies of other runs are hidden and never matched
+                for fname in (glob.glob(key + '.ref.mmi*') if isinstance(aligner, list) else [key + '.ref.mmi']) :
+                    shutil.copyfile(fname, prefix + fname[len(key)+4:])
+                shutil.copyfile(key + '.ref.aln.npz', refPrefix + '.aln.npz')
+                if gff :
+                    restore_gff(key + '.ref.gff.gz', refPrefix + '.gff.gz', reference, reference, ref_tag)
+                return [ref_tag, refPrefix + '.aln.npz']
         if not isinstance(aligner, list) :
-            subprocess.Popen('{0} -k15 -w5 -d {2}.mmi {1}'.format(aligner, reference, prefix).split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
+            subprocess.Popen('{0} {3} -d {2}.mmi {1}'.format(aligner, reference, prefix, minimap2_index).split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
         else :
-            subprocess.Popen('{0} -cR01 {2}.mmi {1}'.format(aligner[0], reference, prefix).split()).communicate()
+            subprocess.Popen('{0} {3} {2}.mmi {1}'.format(aligner[0], reference, prefix, last_package.lastdb_params).split()).communicate()
         import tempfile
         with tempfile.NamedTemporaryFile(dir='.') as tf :
             seq, _ = readFastq(reference)
@@ -951,12 +1240,23 @@ def prepReference(prefix, ref_tag, reference, aligner, pilercr, trf, **args) :
             #    subprocess.Popen('cp {1} {2}'.format(externals['pigz'], reference, tf_fas), shell=True).communicate()
             repeats = mask_tandem(tf_fas) + mask_crispr(tf_fas, tf.name)
             os.unlink(tf_fas)
-        alignments = alignAgainst([prefix +'.' + ref_tag.rsplit('.', 1)[0] + '.0', aligner, prefix + '.mmi', [ref_tag, reference], [ref_tag, reference]])
-        with uopen(alignments[1], 'a') as fout :
-            for r in repeats :
-                fout.write('{0}\trefMapper\tunsure\t{1}\t{2}\t.\t+\t.\t/inference="repetitive_regions"\n'.format(
-                    r[0], r[1], r[2], 
-                ))
+        alignments = alignAgainst([refPrefix, aligner, prefix + '.mmi', [ref_tag, reference], [ref_tag, reference], gff, cache, n_thread])
+        summary = read_summary(alignments[1])
+        contigs = summary['contigs'].tolist()
+        write_summary(alignments[1], [ [contigs[n], s, e] for n, s, e in summary['presences'].tolist() ], 
+                      [ [contigs[n], s, e] for n, s, e in summary['absences'].tolist() ] + repeats, 
+                      [ [contigs[n], site, ori, alt] for (n, site), (ori, alt) in zip(summary['mut_sites'].tolist(), summary_alleles(summary)) ])
+        if gff :
+            with uopen(refPrefix + '.gff.gz', 'a') as fout :
+                for r in repeats :
+                    fout.write('{0}\trefMapper\tunsure\t{1}\t{2}\t.\t+\t.\t/inference="repetitive_regions"\n'.format(
+                        r[0], r[1], r[2], 
+                    ))
+        if cache :
+            for fname in glob.glob(prefix + '.mmi*') :
+                cache_store(fname, key + '.ref' + fname[len(prefix):])
+            for fname, suffix in outputs :
+                cache_store(fname, key + suffix)
     return alignments
 
 def align(argv) :
@@ -965,9 +1265,11 @@ def align(argv) :
     global pool
     pool = Pool(args.n_proc)
     #print(args.reference)
-    refMask = prepReference(args.prefix, args.reference[0], args.reference[1], args.aligner, **externals)
-    alignments = runAlignment(args.prefix, args.reference, args.queries, args.core, args.aligner)
-    lowq_aligns = runAlignment(args.prefix, args.reference, args.lowq, args.core, args.aligner)
+    if args.cache and not os.path.isdir(args.cache) :
+        os.makedirs(args.cache)
+    refMask = prepReference(args.prefix, args.reference[0], args.reference[1], args.aligner, gff=args.gff, cache=args.cache, n_thread=args.n_proc, **externals)
+    alignments = runAlignment(args.prefix, args.reference, args.queries, args.core, args.aligner, args.gff, args.cache, args.n_proc)
+    lowq_aligns = runAlignment(args.prefix, args.reference, args.lowq, args.core, args.aligner, args.gff, args.cache, args.n_proc)
     alignments = [refMask] + alignments
     outputs = {'mappings': dict(alignments), 'low_qual_map': dict(lowq_aligns)}
     if args.matrix or args.alignment :
@@ -110,5 +110,94 @@ def getClust(prefix, genes, params) :
     
     return '{0}.clust.exemplar'.format(prefix), '{0}.clust.tab'.format(prefix)
 
+class ClustCascade(object) :
+    '''Iterative linclust over a single mmseqs database. 
+    Exemplars of each round are carried forward as a subset of the original database, 
+    so the sequences are only parsed by mmseqs once. '''
+    def __init__(self, prefix, genes, params) :
+        self.prefix, self.genes, self.params = prefix, genes, params
+        self.dirPath = tempfile.mkdtemp(prefix='NS_', dir='.')
+        if not params['translate'] :
+            geneFile = genes
+        else :
+            aa_seqs = transeq(readFasta(genes), frame='1', transl_table='starts')
+            geneFile = os.path.join(self.dirPath, 'seq.aa')
+            with open(geneFile, 'w') as fout :
+                for n, s in aa_seqs :
+                    fout.write('>{0}\n{1}\n'.format(n, s[0]))
+        self.seqDb = os.path.join(self.dirPath, 'seq.db')
+        subprocess.Popen('{0} createdb {2} {1} -v 0'.format(externals['mmseqs'], self.seqDb, geneFile).split()).communicate()
+        # keys follow the order of sequences in the input, which is also the priority for exemplars
+        self.keys = {}
+        with open(self.seqDb + '.lookup') as fin :
+            for line in fin :
+                part = line.strip().split('\t')
+                self.keys[part[1]] = int(part[0])
+        self.currDb, self.nDb = self.seqDb, 0
+    def __enter__(self) :
+        return self
+    def __exit__(self, type, value, traceback) :
+        shutil.rmtree(self.dirPath)
+    def size(self) :
+        return len(self.keys)
+    def _linclust(self, identity) :
+        tmpDb, lcDb, tabFile = [os.path.join(self.dirPath, fn) for fn in ('tmp', 'seq.lc', 'clust.tab')]
+        if os.path.isdir(tmpDb) :
+            shutil.rmtree(tmpDb)
+        os.makedirs(tmpDb)
+        list(map(os.unlink, glob.glob(lcDb + '*')))
+        subprocess.Popen('{0} linclust {1} {2} {3} --min-seq-id {4} -c {5} --threads {6} -v 0'.format( \
+            externals['mmseqs'], self.currDb, lcDb, tmpDb, identity, self.params['coverage'], self.params['n_thread']).split(), stdout=subprocess.PIPE).communicate()
+        subprocess.Popen('{0} createtsv {1} {1} {2} {3}'.format(\
+            externals['mmseqs'], self.currDb, lcDb, tabFile).split(), stdout = subprocess.PIPE).communicate()
+        exemplars, groups = {}, {}
+        with open(tabFile) as fin :
+            for line in fin :
+                part = line.strip().split()
+                groups[part[1]] = part[0]
+                if part[0] not in exemplars or self.keys[part[1]] < self.keys[exemplars[part[0]]] :
+                    exemplars[part[0]] = part[1]
+        return { gene:exemplars[grp] for gene, grp in groups.items() }
+    def _subset(self, genes) :
+        self.nDb += 1
+        listFile, subDb = os.path.join(self.dirPath, 'subset.list'), os.path.join(self.dirPath, 'seq.{0}.db'.format(self.nDb))
+        with open(listFile, 'w') as fout :
+            for key in sorted([self.keys[g] for g in genes]) :
+                fout.write('{0}\n'.format(key))
+        for suffix in ('', '_h') :
+            subprocess.Popen('{0} createsubdb {1} {2}{4} {3}{4} -v 0'.format(\
+                externals['mmseqs'], listFile, self.currDb, subDb, suffix).split(), stdout = subprocess.PIPE).communicate()
+        if self.currDb != self.seqDb :
+            list(map(os.unlink, glob.glob(self.currDb + '*')))
+        self.currDb = subDb
+    def step(self, identity) :
+        '''One round of clustering at the given identity. Returns {gene:exemplar} for all remaining genes. '''
+        groups, nRef = {}, 999999999999999
+        for ite in xrange(3) :
+            grp = self._linclust(identity)
+            for gene, exemplar in grp.items() :
+                groups[gene] = exemplar
+            exemplars = set(grp.values())
+            self._subset(exemplars)
+            if nRef <= len(exemplars) :
+                break
+            nRef = len(exemplars)
+        for gene, grp in groups.items() :
+            g = gene
+            while g != grp :
+                g, grp = grp, groups[grp]
+            groups[gene] = grp
+        self.keys = { g:self.keys[g] for g in exemplars }
+        return groups
+    def write_exemplar(self) :
+        exemplar, toWrite = '{0}.clust.exemplar'.format(self.prefix), False
+        with uopen(self.genes) as fin, open(exemplar, 'w') as fout :
+            for line in fin :
+                if line.startswith('>') :
+                    toWrite = line[1:].strip().split()[0] in self.keys
+                if toWrite :
+                    fout.write(line)
+        return exemplar
+
 if __name__ == '__main__' :
     clust(sys.argv[1:])
@@ -1,17 +1,21 @@
-import os, re, sys, shlex, ete3, tempfile, hashlib
+import os, re, sys, shlex, ete3, tempfile, hashlib, heapq
 from time import time
-import subprocess, numpy as np, pandas as pd, numba as nb
+import subprocess, numpy as np, pandas as pd, numba as nb, scipy.sparse as sp
 from operator import itemgetter
 import zipfile, io
 from copy import deepcopy
-from multiprocessing import Pool, Manager, Process
+from multiprocessing import Pool, Process, Queue
+try :
+    import queue
+except :
+    import Queue as queue
 try:
     from configure import externals, logger, rc, transeq, readFasta, uopen, xrange, asc2int
-    from clust import getClust
+    from clust import ClustCascade
     from uberBlast import uberBlast
 except :
     from .configure import externals, logger, rc, transeq, readFasta, uopen, xrange, asc2int
-    from .clust import getClust
+    from .clust import ClustCascade
     from .uberBlast import uberBlast
 
 params = dict(
@@ -323,49 +327,41 @@ def filt_per_group(data) :
     mat, inparalog, ref, seq_file, global_file, _ = data
     if len(mat) <= 1 or (np.min(mat[:, 3]) >= 9800 and not inparalog) :
         return [mat]
-    global_differences = dict(np.load(global_file, allow_pickle=True))
     nMat = mat.shape[0]
     with MapBsn(seq_file) as conn :
         seqs = np.array([ conn.get(int(id/1000))[id%1000] for id in mat.T[5].tolist() ])
     seqs = np.array([45, 65, 67, 71, 84], dtype=np.uint8)[decodeSeq(seqs)][:, :len(ref)]
     seqs[in1d(seqs, [65, 67, 71, 84], invert=True).reshape(seqs.shape)] = 0
     
+    gd_mean, gd_sigma = get_global_pairs(load_global(global_file), mat.T[1][:, np.newaxis], mat.T[1][np.newaxis, :])
+    sameGenome = (mat.T[1][:, np.newaxis] == mat.T[1][np.newaxis, :])
+    
     if mat.shape[0] >= 5 and not inparalog :
         diffX = compare_seqX(seqs, np.zeros(shape=[seqs.shape[0], seqs.shape[0], 2], dtype=int)).astype(float)
         isDiv = False
         for i1 in (0, mat.shape[0]-1) :
-            m1 = mat[i1]
-            for i2, m2 in enumerate(mat) :
-                if i1 != i2 :
-                    mut, aln = diffX[i1, i2]
-                    if aln >= params['match_frag_len'] :
-                        gd = (np.max([params['self_id'], 2.0/aln]), 0.) if m1[1] == m2[1] else global_differences.get(tuple(sorted([m1[1], m2[1]])), (0.5, 0.6))
-                        dX = mut/aln/(gd[0]*np.exp(gd[1]*np.sqrt(params['allowed_sigma'])))
-                    else :
-                        dX = 2
-                    if dX >= 1 :
-                        isDiv = True
-                        break
-            if isDiv :
+            mut, aln = diffX[i1].T
+            gm = np.where(sameGenome[i1], np.maximum(params['self_id'], 2.0/aln), gd_mean[i1])
+            gs = np.where(sameGenome[i1], 0., gd_sigma[i1])
+            dX = np.where(aln >= params['match_frag_len'], mut/aln/(gm*np.exp(gs*np.sqrt(params['allowed_sigma']))), 2.)
+            dX[i1] = 0.
+            if np.any(dX >= 1) :
+                isDiv = True
                 break
         if not isDiv :
             return [mat]
     
     diff = compare_seq(seqs, np.zeros(shape=[seqs.shape[0], seqs.shape[0], 2], dtype=int)).astype(float)
     distances = np.zeros(shape=[mat.shape[0], mat.shape[0], 2], dtype=float)
-    for i1, m1 in enumerate(mat) :
-        for i2 in xrange(i1+1, nMat) :
-            m2 = mat[i2]
-            mut, aln = diff[i1, i2]
-            
-            if aln >= params['match_frag_len'] :
-                gd = (np.max([params['self_id'], 2.0/aln]), 0.) if m1[1] == m2[1] else global_differences.get(tuple(sorted([m1[1], m2[1]])), (0.5, 0.6))
-                distances[i1, i2, :] = [(mut/aln/(gd[0]*np.exp(gd[1]*params['allowed_sigma'])))/gd[0], 1/gd[0]]
-            else :
-                gd = (np.max([params['self_id'], 2.0/params['match_frag_len']]), 0.) if m1[1] == m2[1] else global_differences.get(tuple(sorted([m1[1], m2[1]])), (0.5, 0.6))
-                distances[i1, i2, :] = [2./gd[0], 1/gd[0]]
-                diff[i1, i2] = [1, 2]
-            distances[i2, i1, :] = distances[i1, i2, :]
+    i1, i2 = np.triu_indices(nMat, 1)
+    mut, aln = diff[i1, i2].T
+    shortAln = aln < params['match_frag_len']
+    gm = np.where(sameGenome[i1, i2], np.maximum(params['self_id'], 2.0/np.where(shortAln, params['match_frag_len'], aln)), gd_mean[i1, i2])
+    gs = np.where(sameGenome[i1, i2], 0., gd_sigma[i1, i2])
+    distances[i1, i2, 0] = np.where(shortAln, 2./gm, (mut/aln/(gm*np.exp(gs*params['allowed_sigma'])))/gm)
+    distances[i1, i2, 1] = 1./gm
+    distances[i2, i1, :] = distances[i1, i2, :]
+    diff[i1[shortAln], i2[shortAln]] = [1, 2]
     
     if np.any(distances[:, :, 0] > distances[:, :, 1]) :
         groups = []
@@ -471,29 +467,53 @@ def filt_per_group(data) :
     else :
         return [mat]
 
-def get_gene(allScores, priorities, ortho_groups, cnt=1) :
-    ranking = {gene:priorities.get(gene)[0] for gene in allScores.keys() if gene in priorities}
-    if len(ranking) > 0 :
-        min_rank = min(ranking.values())
-        scores = { gene:allScores[gene] for gene, r in ranking.items() if r == min_rank }
-    else :
-        min_rank = -1
-        scores = {}
-    
-    genes, all_useds = [], set([])
-    nGene = len(scores)
-    for id, (gene, score) in enumerate(sorted(scores.items(), key=itemgetter(1), reverse=True)) :
+class ScoreQueue(dict) :
+    '''Gene scores indexed by a priority queue of (rank, -score, gene). 
+    Entries are not removed when a score changes; outdated ones are skipped when they reach the top. '''
+    def __init__(self, scores, priorities) :
+        dict.__init__(self)
+        self.priorities, self.heap, self.ranks = priorities, [], {}
+        for gene, score in scores.items() :
+            self[gene] = score
+    def __setitem__(self, gene, score) :
+        if gene in self.priorities :
+            rank = self.priorities[gene][0]
+            if rank not in self.ranks :
+                self.ranks[rank] = set([])
+            self.ranks[rank].add(gene)
+            heapq.heappush(self.heap, (rank, -score, gene))
+        dict.__setitem__(self, gene, score)
+    def pop(self, gene, *default) :
+        if gene in self.priorities and self.priorities[gene][0] in self.ranks :
+            self.ranks[self.priorities[gene][0]].discard(gene)
+        return dict.pop(self, gene, *default)
+
+def get_gene(scores, partners, cnt=1) :
+    genes, all_useds, popped = [], set([]), {}
+    min_rank = None
+    while len(scores.heap) :
+        rank, score, gene = scores.heap[0]
+        if min_rank is not None and rank != min_rank :
+            break
+        heapq.heappop(scores.heap)
+        score = -score
+        if gene in popped or gene not in scores or scores[gene] != score :
+            continue
+        min_rank, popped[gene] = rank, score
         if score <= 0 : break
-        if gene not in all_useds or nGene < 2*cnt :
+        if gene not in all_useds or len(scores.ranks[min_rank]) < 2*cnt :
             genes.append([gene, score, min_rank])
             if len(genes) >= cnt :
                 break
-            all_useds.update(set(ortho_groups[ortho_groups.T[0] == int(gene), 1]))
+            if int(gene) in scores :
+                all_useds.update(partners.get(int(gene), []))
     
     if len(genes) <= 0 :
-        for gene in scores :
-            allScores.pop(gene)
+        for gene in list(scores.ranks.get(min_rank, [])) :
+            scores.pop(gene)
         return []
+    for gene, score in popped.items() :
+        heapq.heappush(scores.heap, (min_rank, -score, gene))
     return genes
 
 def load_conflict(data) :
@@ -517,14 +537,17 @@ def filt_genes(prefix, groups, ortho_groups, global_file, cfl_file, priorities,
     clust_ref = { int(n):s for n, s in readFasta(params['clust']).items()}
     
     used, pangenome, panList = {}, {}, {}
+    scores = ScoreQueue(scores, priorities)
+    ortho_groups = ortho_groups[np.argsort(ortho_groups.T[0], kind='mergesort')]
+    partners = np.unique(ortho_groups.T[0], return_index=True)
+    partners = dict(zip(partners[0], np.split(ortho_groups.T[1], partners[1][1:])))
     
     while len(scores) > 0 :
         # get top 100 genes
         times = []
         times.append(time())
         
-        ortho_groups = ortho_groups[np.all(in1d(ortho_groups, list(scores.keys())).reshape(ortho_groups.shape), 1)]
-        genes = get_gene(scores, priorities, ortho_groups, cnt=100)
+        genes = get_gene(scores, partners, cnt=100)
         if len(genes) <= 0 :
             continue
         to_run, (min_score, min_rank) = [], genes[-1][1:]
@@ -600,8 +623,8 @@ def filt_genes(prefix, groups, ortho_groups, global_file, cfl_file, priorities,
                         ng = np.round(gene + 0.001*(id+2), 3)
                         new_groups[ng] = matches
                         conflicts[ng] = { mid:cfl.pop(mid, {}) for mid in matches.T[5] }
-                        scores[ng] = np.sum(np.abs(matches[np.unique(matches.T[1], return_index=True)[1]].T[2]))
                         priorities[ng] = priorities[gene][:]
+                        scores[ng] = np.sum(np.abs(matches[np.unique(matches.T[1], return_index=True)[1]].T[2]))
         else :
             for gene, score in genes.items() :
                 if gene not in new_groups :
@@ -628,11 +651,13 @@ def filt_genes(prefix, groups, ortho_groups, global_file, cfl_file, priorities,
                 matches = new_groups.get(gene)
                 scores[gene] = np.sum(np.abs(matches[np.unique(matches.T[1], return_index=True)[1]].T[2]))
 
-        while len(genes) :
-            tmp = [ [scores[gene], gene] for gene in genes ]
-            score, gene = max(tmp)
+        candidates = [ (-scores[gene], -gene) for gene in genes ]
+        heapq.heapify(candidates)
+        while len(candidates) :
+            score, gene = -candidates[0][0], -candidates[0][1]
             if score < min_score :
                 break
+            heapq.heappop(candidates)
             mat = new_groups.pop(gene)
             x = encodes[int(gene)] + '/' + str(int(1000*(gene - int(gene)) + 0.5)) if isinstance(gene, float) else encodes[gene]
             # third, check its overlapping again
@@ -685,6 +710,7 @@ def filt_genes(prefix, groups, ortho_groups, global_file, cfl_file, priorities,
                 pangene = superR[0]
             elif paralog :
                 new_groups[gene] = mat
+                heapq.heappush(candidates, (-score, -gene))
                 continue
             else :
                 pangene = gene
@@ -700,10 +726,11 @@ def filt_genes(prefix, groups, ortho_groups, global_file, cfl_file, priorities,
             gene_name = encodes[int(gene)] + '/' + str(int(1000*(gene - int(gene)) + 0.5)) if isinstance(gene, float) else encodes[gene]
             if len(pangenome) % 50 == 0 :
                 logger('{4} / {5}: pan gene "{3}" : "{0}" picked from rank {1} and score {2}'.format(encodes[mat[0][0]], min_rank, score/10000., pangene_name, len(pangenome), len(scores)+len(pangenome)))
-            mat_out.append([pangene_name, gene_name, min_rank, mat])
+            # only (genome, group id) pairs are queued; the writer reads the matches from the mat store
+            put_result([pangene_name, gene_name, min_rank, mat[:, [1, 5]]])
         times.append(time())
         logger('Time consumption: {0}'.format(' '.join([str(times[i] - times[i-1]) for i in np.arange(1, len(times))])))
-    mat_out.append([0, 0, 0, []])
+    put_result([0, 0, 0, []])
     return 
 
 def load_priority(priority_list, genes, encodes) :
@@ -1003,8 +1030,9 @@ def determineGroup(gIden, global_differences, min_iden, nSigma) :
         if m1[1] >= (min_iden-0.02)*10000 :
             m2 = gIden[i1+1:][ingroup[gIden[i1+1:, 2]] != True]
             if m2.size :
-                gs = np.vectorize(lambda g1, g2: (params['self_id'], 0.) if g1 == g2 else global_differences.get(tuple(sorted([g1, g2])), (0.5, 0.6) ))(m2.T[0], m1[0])
-                sc = (1.-m2.T[1].astype(float)/m1[1])/(gs[0]*np.exp(nSigma*gs[1]))
+                gm, gs = get_global_pairs(global_differences, m2.T[0], m1[0])
+                gm[m2.T[0] == m1[0]], gs[m2.T[0] == m1[0]] = params['self_id'], 0.
+                sc = (1.-m2.T[1].astype(float)/m1[1])/(gm*np.exp(nSigma*gs))
                 ingroup[m2[sc < 1, 2].astype(int)] = True
             else :
                 break
@@ -1015,7 +1043,7 @@ def determineGroup(gIden, global_differences, min_iden, nSigma) :
 def initializing2(data) :
     bsn_file, genes, global_file = data
 
-    global_differences = dict(np.load(global_file, allow_pickle=True))
+    global_differences = load_global(global_file)
     outputs = []
     with MapBsn(bsn_file+'.tab.npz') as conn :
         for gene in genes :
@@ -1052,59 +1080,42 @@ def initializing(bsn_file, global_file) :
 
 
 def ite_synteny_resolver(data) :
-    grp_tag, orthologs, neighbors, nNeighbor = data
-    ids = np.where(orthologs.T[0] == grp_tag)[0]
-    genomes, co_genomes = np.unique(orthologs[ids, 1], return_inverse=True)
+    grp_tag, ids, genomes, neighbor_groups, nNeighbor = data
+    genomes, co_genomes = np.unique(genomes, return_inverse=True)
     if genomes.size == 1 :
         return [grp_tag, None]
 
-    distances, conflicts, inConflicts = [], {}, {}
-    for m, i in enumerate(ids) :
-        for n in np.arange(m+1, ids.size) :
-            j = ids[n]
-            ni, nj = np.array(list(neighbors[i]), dtype=int), np.array(list(neighbors[j]), dtype=int)
-            oi, oj = np.unique(orthologs[ni, 0]), np.unique(orthologs[nj, 0])
-            ois, ojs = np.min([6, oi.size]), np.min([6, oj.size])
-            s = 3*(oi.size + oj.size - np.unique(np.concatenate([oi, oj])).size) + np.max([6-ois, 6-ojs, 0]) + 1
-            d = 3*nNeighbor - s
-            distances.append([d, co_genomes[m] != co_genomes[n], i, j])
-            if co_genomes[m] == co_genomes[n] and d > 0 :
-                conflicts[(i, j)] = conflicts[(j, i)] = 1
-                inConflicts[i] = inConflicts[j] = 1
-
-    if conflicts :
-        distances.sort()
-        groups, tags = { id:[[id], []] if id in inConflicts else [[], [id]] for id in ids }, { id:id for id in ids }
-        for idx, (d, _, i, j) in enumerate(distances) :
+    # shared[m, n] : No. of orthologous groups in the neighborhoods of both ids[m] and ids[n]
+    shared = (neighbor_groups * neighbor_groups.T).toarray()
+    nGroups = np.minimum(np.diag(shared), 6)
+    m, n = np.triu_indices(ids.size, 1)
+    d = 3*nNeighbor - (3*shared[m, n] + 6 - np.minimum(nGroups[m], nGroups[n]) + 1)
+    diffGenome = co_genomes[m] != co_genomes[n]
+    conflicts = np.zeros([ids.size, ids.size], dtype=bool)
+    conflicts[m[~diffGenome & (d > 0)], n[~diffGenome & (d > 0)]] = True
+    conflicts |= conflicts.T
+
+    if np.any(conflicts) :
+        order = np.lexsort([n, m, diffGenome, d])
+        m, n = m[order], n[order]
+        inConflicts = np.any(conflicts, 1)
+        groups, tags = { id:[[id], []] if inConflicts[id] else [[], [id]] for id in np.arange(ids.size) }, np.arange(ids.size)
+        for idx, (i, j) in enumerate(zip(m, n)) :
             if tags[i] == tags[j] : continue
-            if (i, j) in conflicts :
-                distances = distances[idx:]
+            if conflicts[i, j] :
+                m, n = m[idx:], n[idx:]
                 break
             ti, tj = tags[i], tags[j]
-            skip = False
-            for m in groups[ti][0] :
-                for n in groups[tj][0] :
-                    if (m, n) in conflicts :
-                        skip = True
-                        break
-                if skip :
-                    break
-
-            if not skip :
+            if not np.any(conflicts[np.ix_(groups[ti][0], groups[tj][0])]) :
                 gg = groups.pop(tj)
-                for g in gg[0] :
-                    tags[g] = tags[i]
-                for g in gg[1] :
-                    tags[g] = tags[i]
+                tags[gg[0] + gg[1]] = ti
                 groups[ti][0].extend(gg[0])
                 groups[ti][1].extend(gg[1])
-        diffs = {}
-        for d, _, i, j in distances :
-            if (i, j) in conflicts :
-                diffs[tags[j]] = diffs[tags[i]] = 1
+        inConflicts = conflicts[m, n]
+        diffs = set(tags[m[inConflicts]]) | set(tags[n[inConflicts]])
 
         if len(diffs) >= len(groups) :
-            return [grp_tag, { id:grp[0]+grp[1] for id, grp in groups.items() }]
+            return [grp_tag, { ids[id]:ids[grp[0]+grp[1]].tolist() for id, grp in groups.items() }]
         else :
             return [grp_tag, None]
     return [None, None]
@@ -1112,31 +1123,39 @@ def ite_synteny_resolver(data) :
 def synteny_resolver(prefix, prediction, nNeighbor = 2) :
     prediction = pd.read_csv(prediction, sep='\t', header=None)
     prediction = prediction.assign(s=np.min([prediction[9], prediction[10]], 0)).sort_values(by=[5, 's']).drop('s', axis=1).values
-    neighbors = [ set([]) for i in np.arange(np.max(prediction.T[2])+1) ]
+    nId = np.max(prediction.T[2])+1
     orthologs = np.vstack([['', ''], np.copy(prediction[:, [0,3]])])
     orthologs[prediction.T[2].astype(int)] = prediction[:, [0,3]]
-    orthologs = orthologs[:len(neighbors)]
+    orthologs = orthologs[:nId]
     orthologs2 = np.unique(orthologs, return_inverse=True)[1].reshape([-1, 2])
     
     orth_cnt = dict(zip(*(np.unique(orthologs2.T[0], return_counts=True))))
     
-    for pId, predict in enumerate(prediction) :
-        nId = np.concatenate([np.arange(pId-1, max(pId-4, -1), -1), np.arange(pId+1, min(pId+4, prediction.shape[0]))])
-        nbs = {neighbor[2] for neighbor in prediction[nId] if neighbor[5] == predict[5]} - set([predict[2]])
-        neighbors[predict[2]].update(nbs)
+    # sparse gene x orthologous group incidences of up to 3 neighbors in each direction
+    pIds, contigs = prediction.T[2].astype(int), prediction.T[5]
+    src, tgt = [], []
+    for offset in np.arange(1, 4) :
+        for i1, i2 in ((pIds[:-offset], pIds[offset:]), (pIds[offset:], pIds[:-offset])) :
+            kept = (contigs[:-offset] == contigs[offset:]) & (i1 != i2)
+            src.append(i1[kept])
+            tgt.append(i2[kept])
+    src, tgt = np.concatenate(src), np.concatenate(tgt)
+    neighbor_groups = sp.csr_matrix((np.ones(src.size, dtype=np.int32), (src, orthologs2[tgt, 0])), shape=(nId, np.max(orthologs2.T[0])+1))
+    neighbor_groups.data[:] = 1
+
     paralog_groups = np.unique(orthologs2, axis=0, return_counts=True)
     paralog_groups = np.unique(paralog_groups[0][paralog_groups[1]>1, 0])
+    
+    grp_order = np.argsort(orthologs2.T[0], kind='mergesort')
+    grp_ids = dict(zip(orthologs2[grp_order[np.concatenate([[0], np.where(np.diff(orthologs2[grp_order, 0]))[0]+1])], 0], \
+                       np.split(grp_order, np.where(np.diff(orthologs2[grp_order, 0]))[0]+1)))
 
-    #toDel = []
-    #outs = list(map(ite_synteny_resolver, [ [grp_tag, orthologs2, neighbors, nNeighbor] for grp_tag in paralog_groups ]))
-    outs = pool2.map(ite_synteny_resolver, [ [grp_tag, orthologs2, neighbors, nNeighbor] for grp_tag in sorted(paralog_groups, key=lambda p:orth_cnt.get(p, 0)) ])
+    #outs = list(map(ite_synteny_resolver, [ [grp_tag, grp_ids[grp_tag], orthologs2[grp_ids[grp_tag], 1], neighbor_groups[grp_ids[grp_tag]], nNeighbor] for grp_tag in paralog_groups ]))
+    outs = pool2.map(ite_synteny_resolver, [ [grp_tag, grp_ids[grp_tag], orthologs2[grp_ids[grp_tag], 1], neighbor_groups[grp_ids[grp_tag]], nNeighbor] for grp_tag in sorted(paralog_groups, key=lambda p:orth_cnt.get(p, 0)) ])
     for grp_tag, groups in outs :
         if groups is not None :
             for id, (t, i) in enumerate(sorted(groups.items())) :
                 orthologs[i, 0] = orthologs[i[0], 0] + '#{0}'.format(id)
-        #if grp_tag is not None :
-            #toDel.append(grp_tag)
-    #paralog_groups = paralog_groups[in1d(paralog_groups, toDel, invert=True)]
             
     prediction.T[0] = orthologs[prediction.T[2].astype(int), 0]
     prediction = pd.DataFrame(prediction).sort_values(by=[0, 2, 7])
@@ -1527,42 +1546,59 @@ def get_global_difference(geneGroups, cluFile, bsnFile, geneInGenomes, nGene = 1
     selectedClu = clu[in1d(clu.T[0], selectedGenes)]
     selectedBsn = bsn[in1d(bsn.T[0], selectedGenes)]
     # get global
-    global_differences = {}
+    genomes = np.unique(list(geneInGenomes.values()))
+    nGenome = genomes.size
+    # running count, sum and sum of squares of log-differences for every genome pair, in float64 to keep the variance accurate
+    stats = np.zeros([3, nGenome, nGenome], dtype=np.float64)
+    def add_pairs(rr, qq, i, skipSelf) :
+        g1 = np.searchsorted(genomes, [geneInGenomes[r2] for r2 in rr])
+        g2 = np.searchsorted(genomes, [geneInGenomes[q2] for q2 in qq])
+        g1, g2 = np.repeat(g1, g2.size), np.tile(g2, g1.size)
+        if skipSelf :
+            g1, g2 = g1[g1 != g2], g2[g1 != g2]
+        d = np.log(1.005-i/10000.)
+        for x, y in ((g1, g2), (g2[g1 != g2], g1[g1 != g2])) :
+            np.add.at(stats[0], (x, y), 1.)
+            np.add.at(stats[1], (x, y), d)
+            np.add.at(stats[2], (x, y), d*d)
     geneGroups = {}
     
     for r, q, i in selectedClu :
         rr = geneGroups.get(r, [r])
         qq = geneGroups.pop(q, [q])
-        for r2 in rr :
-            g1 = geneInGenomes[r2]
-            for q2 in qq :
-                g2 = geneInGenomes[q2]
-                key = tuple(sorted([g1, g2]))
-                if key in global_differences :
-                    global_differences[key].append(i)
-                else :
-                    global_differences[key] = [i]
+        add_pairs(rr, qq, i, False)
         geneGroups[r] = rr + qq
     for r, q, i in selectedBsn :
         rr = geneGroups.get(r, [r])
         qq = geneGroups.pop(q, [q])
-        for r2 in rr :
-            g1 = geneInGenomes[r2]
-            for q2 in qq :
-                g2 = geneInGenomes[q2]
-                if g1 != g2 : 
-                    key = tuple(sorted([g1, g2]))
-                    if key in global_differences :
-                        global_differences[key].append(i)
-                    else :
-                        global_differences[key] = [i]
-    for pair, data in global_differences.items() :
-        diff = np.log(1.005-np.array(data)/10000.)
-        mean_diff2 = np.mean(diff)
-        mean_diff = min(max(mean_diff2, np.log(0.02)), np.log(0.5))
-        sigma = min(max(np.sqrt(np.mean((diff - mean_diff2)**2)), np.log(1.6)), np.log(2.4))
-        global_differences[pair] = (np.exp(mean_diff), sigma)
-    return pd.DataFrame(list(global_differences.items())).values
+        add_pairs(rr, qq, i, True)
+    
+    global_differences = np.zeros([2, nGenome, nGenome], dtype=np.float32)
+    global_differences[0], global_differences[1] = 0.5, 0.6
+    observed = stats[0] > 0
+    cnt, mean_diff2 = stats[0][observed], stats[1][observed]/stats[0][observed]
+    mean_diff = np.minimum(np.maximum(mean_diff2, np.log(0.02)), np.log(0.5))
+    sigma = np.minimum(np.maximum(np.sqrt(np.maximum(stats[2][observed]/cnt - mean_diff2**2, 0.)), np.log(1.6)), np.log(2.4))
+    global_differences[0][observed], global_differences[1][observed] = np.exp(mean_diff), sigma
+    return genomes, global_differences
+
+def save_global(fname, global_differences) :
+    genomes, global_differences = global_differences
+    np.save(fname, global_differences)
+    np.save(fname.rsplit('.', 1)[0] + '.genomes.npy', genomes)
+    return fname
+
+def load_global(fname) :
+    return np.load(fname.rsplit('.', 1)[0] + '.genomes.npy'), np.load(fname, mmap_mode='r')
+
+def get_global_pairs(global_differences, g1, g2) :
+    genomes, global_differences = global_differences
+    g1, g2 = np.broadcast_arrays(np.asarray(g1), np.asarray(g2))
+    i1, i2 = np.searchsorted(genomes, g1) % genomes.size, np.searchsorted(genomes, g2) % genomes.size
+    diff = np.asarray(global_differences[:, i1, i2], dtype=float)
+    unknown = (genomes[i1] != g1) | (genomes[i2] != g2)
+    diff[0][unknown], diff[1][unknown] = 0.5, 0.6
+    return diff[0], diff[1]
 
 def add_args(a) :
     import argparse
@@ -1590,6 +1626,8 @@ EToKi.py ortho
 
     parser.add_argument('--clust_identity', help='minimum identities of mmseqs clusters. Default: 0.9', default=0.9, type=float)
     parser.add_argument('--clust_match_prop', help='minimum matches in mmseqs clusters. Default: 0.9', default=0.9, type=float)
+    parser.add_argument('--clust_step', help='decrease of identities between iterative mmseqs clusterings. Default: 0.01', default=0.01, type=float)
+    parser.add_argument('--clust_adaptive', help='enlarge the identity step (up to 0.05) when an iteration merges few exemplars. Default: False', default=False, action='store_true')
 
     parser.add_argument('--nucl', dest='noDiamond', help='disable Diamond search. Fast but less sensitive when nucleotide identities < 0.9', default=False, action='store_true')
     parser.add_argument('--match_identity', help='minimum identities in BLAST search. Default: 0.5', default=0.5, type=float)
@@ -1651,20 +1689,24 @@ def encodeNames(genomes, genes, geneFiles, prefix, labelFile=None) :
     return genomes, genes, labels, labelFile
 
 def iterClust(prefix, genes, geneGroup, params) :
-    identity_target = params['identity']
-    g = genes
-    iterIden = np.round(np.arange(1., identity_target-0.005, -0.01), 5)
-    #np.power(params['coverage'], 0.5**np.arange(iterIden.size-1, -1, -1))
-    for iden in iterIden :
-        params.update({'identity':iden, 'coverage':np.round(params['coverage'], 2)})
-        iden2 = min(1., iden+0.005)
-        g, clust = getClust(prefix, g, params)
-        exemplarNames = readFasta(g, headOnly=True)
-        gp = pd.read_csv(clust, sep='\t').values
-        logger('Iterative clustering. {0} exemplars left with identity = {1}'.format(len(exemplarNames), iden))
-        for g1, g2 in gp[gp.T[0]!=gp.T[1]] :
-            r, q = (g1, g2) if str(g1) in exemplarNames else (g2, g1)
-            geneGroup.append([r, q, int(iden2*10000)])
+    identity_target, step = params['identity'], params.get('step', 0.01)
+    params.update({'coverage':np.round(params['coverage'], 2)})
+    with ClustCascade(prefix, genes, params) as cascade :
+        iden, nExemplar = 1., cascade.size()
+        while True :
+            iden2 = min(1., iden+0.005)
+            groups = cascade.step(iden)
+            logger('Iterative clustering. {0} exemplars left with identity = {1}'.format(cascade.size(), iden))
+            for q, r in groups.items() :
+                if q != r :
+                    geneGroup.append([int(r), int(q), int(iden2*10000)])
+            if iden <= identity_target + 0.005 :
+                break
+            # adaptive schedule: take larger steps while few exemplars are merged in each round
+            if params.get('adaptive', False) :
+                step = min(step*2, 0.05) if cascade.size() >= 0.99 * nExemplar else params.get('step', 0.01)
+            iden, nExemplar = max(identity_target, np.round(iden - step, 5)), cascade.size()
+        g = cascade.write_exemplar()
     np.save('{0}.clust.npy'.format(prefix), np.array(geneGroup, dtype=int))
     return g
 
@@ -1674,40 +1716,44 @@ def async_writeOut(mat_out, matFile, outFile, labelFile) :
     outPos = np.ones(16, dtype=bool)
     outPos[[0,3,4,5,10,15]] = False
     
-    mat_id, group_id = 0, 0
-    mat_conn = None
-    import time
-    with open(outFile, 'w') as fout :
+    group_id = 0
+    p = [-1, None]
+    with open(outFile, 'w') as fout, MapBsn(matFile) as mat_conn :
         while True :
-            while mat_id < len(mat_out) :
-                if not mat_conn :
-                    mat_conn = MapBsn(matFile)
-                mat_id2 = min(len(mat_out), mat_id + 1000)
-                mat_out2 = mat_out[mat_id:mat_id2]
-                for i in range(mat_id, mat_id2) :
-                    mat_out[i] = None
-                gids = {grp[5]:None for pangene, gene, min_rank, mat in mat_out2 for grp in mat}
-                p = [-1, None]
-                for gid in sorted(gids) :
-                    if p[0] != int(gid/1000) :
-                        p = [int(gid/1000), mat_conn.get(int(gid/1000))]
-                    gids[gid] = p[1][gid%1000]
-                mat_id = mat_id2
-                for pangene, gene, min_rank, mat in mat_out2 :
-                    if len(mat) == 0 :
-                        return
-                    for grp in mat :
-                        group_id += 1
-                        m = gids[int(grp[5])]
-                        m.T[1] = encodes[m.T[1].astype(int)]
-                        for g in m :
-                            gg = g[outPos].astype(str).tolist()
-                            fout.write('{0}\t{1}\t{2}\t{3}\t{4}\t{5}\n'.format(pangene, min_rank, group_id, encodes[grp[1]], gene, '\t'.join(gg)))
-                    del mat
-            time.sleep(1)
+            # block for the next result, then drain whatever else is ready
+            mat_out2 = [mat_out.get()]
+            while len(mat_out2) < 1000 :
+                try :
+                    mat_out2.append(mat_out.get_nowait())
+                except queue.Empty :
+                    break
+            gids = {grp[1]:None for pangene, gene, min_rank, mat in mat_out2 for grp in mat}
+            for gid in sorted(gids) :
+                if p[0] != int(gid/1000) :
+                    p = [int(gid/1000), mat_conn.get(int(gid/1000))]
+                gids[gid] = p[1][gid%1000]
+            for pangene, gene, min_rank, mat in mat_out2 :
+                if len(mat) == 0 :
+                    return
+                for grp in mat :
+                    group_id += 1
+                    m = gids[int(grp[1])]
+                    m.T[1] = encodes[m.T[1].astype(int)]
+                    for g in m :
+                        gg = g[outPos].astype(str).tolist()
+                        fout.write('{0}\t{1}\t{2}\t{3}\t{4}\t{5}\n'.format(pangene, min_rank, group_id, encodes[grp[0]], gene, '\t'.join(gg)))
     return
 
-pool, pool2, mat_out = None, None, None
+def put_result(item, timeout=10) :
+    '''queue a result for async_writeOut. Raises if the writer has died, instead of blocking on the full queue forever'''
+    while True :
+        try :
+            return mat_out.put(item, timeout=timeout)
+        except queue.Full :
+            if not writeProcess.is_alive() :
+                raise ValueError('Output writer stopped with exit code {0}'.format(writeProcess.exitcode))
+
+pool, pool2, mat_out, writeProcess = None, None, None, None
 def ortho(args) :
     global params
     params.update(add_args(args).__dict__)
@@ -1749,7 +1795,7 @@ def ortho(args) :
             genes.clear()
             del genes
             logger('Run MMSeqs linclust to get exemplar sequences. Params: {0} identities and {1} align ratio'.format(params['clust_identity'], params['clust_match_prop']))
-            params['clust'] = iterClust(params['prefix'], params['genes'], groups, dict(identity=params['clust_identity'], coverage=params['clust_match_prop'], n_thread=params['n_thread'], translate=False))
+            params['clust'] = iterClust(params['prefix'], params['genes'], groups, dict(identity=params['clust_identity'], coverage=params['clust_match_prop'], n_thread=params['n_thread'], translate=False, step=params['clust_step'], adaptive=params['clust_adaptive']))
         
         if params.get('self_bsn', None) is None :
             params['self_bsn'] = params['prefix']+'.self_bsn.npy'
@@ -1759,7 +1805,7 @@ def ortho(args) :
 
         if params.get('global', None) is None :
             params['global'] = params['prefix']+'.global.npy'
-            np.save(params['global'], \
+            save_global(params['global'], \
                     get_global_difference(get_gene_group(params['clust'], params['self_bsn']), \
                                           params['clust'], params['self_bsn'], geneInGenomes, nGene=1000) )
             
@@ -1771,14 +1817,16 @@ def ortho(args) :
         pool.close()
         pool.join()
         
-        global mat_out
-        mat_out = Manager().list([])
+        global mat_out, writeProcess
+        mat_out = Queue(maxsize=2000)
         writeProcess = Process(target=async_writeOut, args=(mat_out, params['map_bsn']+'.mat.npz', params['prediction'], labelFile))
         writeProcess.start()
         gene_scores = initializing(params['map_bsn'], params.get('global', None))
         with MapBsn(params['map_bsn']+'.tab.npz') as tab_conn :
             filt_genes(params['prefix'], tab_conn, np.load(params['self_bsn'], allow_pickle=True), params['global'], params['map_bsn']+'.conflicts.npz', priorities, gene_scores, encodes)
         writeProcess.join()
+        if writeProcess.exitcode :
+            raise ValueError('Output writer stopped with exit code {0}'.format(writeProcess.exitcode))
     else :
         if params.get('clust', None) :
             genes = { int(n):s for n, s in readFasta(params['clust']).items()}
@@ -1,10 +1,12 @@
 from ete3 import Tree
-import sys, numpy as np, os, glob, re, argparse, resource
+import sys, numpy as np, os, glob, re, argparse, resource, shutil, tempfile
 from subprocess import Popen, PIPE
 from multiprocessing import Pool
 from time import sleep
+from collections import OrderedDict
 import random
 import pandas as pd
+from numba import jit
 
 rint = random.randint(0, 262144)
 
@@ -15,26 +17,46 @@ except :
 
 raxml = externals['raxml']
 
-def fillMissingSeq(seqs, block_id) :
-    check = False
-    for s in seqs :
-        if len(s) > 2 :
-            s[2] = ''.join(s[2]).upper()
-            check = True
-    if not check :
-        return False
-    alnSize = max([ len(s[2]) for s in seqs ])
-    for s in seqs :
-        if len(s) == 1 :
-            s.extend(['s{0}'.format(block_id), ''])
-        s[2] += '-' * (alnSize - len(s[2]))
-    return True
-    
-
 def xFasta2Matrix(prefix, fasta_file, core=0.95) :
+    global pool
+    if not pool :
+        pool = Pool(5)
+    # ACGT in either case are kept, all other characters are missing
+    base_codes = np.full(256, 45, dtype=np.uint8)
+    for b in b'ACGT' :
+        base_codes[b] = base_codes[b+32] = b
+
     seqs = []
-    snp_data = []
+    snp_data, tasks = [], []
     nameMap = {}
+    def add_block(seqs) :
+        if not np.any([ len(s) > 2 for s in seqs ]) :
+            return 0
+        contName = seqs[0][1] if len(seqs[0]) > 2 else 's{0}'.format(len(snp_data))
+        seqs = [ ''.join(s[2]).encode() if len(s) > 2 else b'' for s in seqs ]
+        alnSize = max([ len(s) for s in seqs ])
+        mat = np.full([len(seqs), alnSize], 45, dtype=np.uint8)
+        for id, s in enumerate(seqs) :
+            mat[id, :len(s)] = base_codes[np.frombuffer(s, dtype=np.uint8)]
+        snp_data.append([contName, alnSize, np.zeros(4), [], []])
+        seg = max(1, 2**23 // len(seqs))
+        for s in range(0, alnSize, seg) :
+            tasks.append([prefix, len(tasks), len(snp_data)-1, mat[:, s:s+seg], s, core])
+        return mat.size
+    def run_tasks() :
+        for block_id, const_sites, missing, npz in pool.imap(parse_snps, tasks) :
+            snp = snp_data[block_id]
+            snp[2] += const_sites
+            for s, e in missing :
+                if len(snp[3]) and snp[3][-1][1] + 1 == s :
+                    snp[3][-1][1] = e
+                else :
+                    snp[3].append([s, e])
+            snp[4].append(npz)
+        del tasks[:]
+
+    # blocks are parsed in workers once about 2**27 bases are loaded
+    n_base = 0
     with uopen(fasta_file) as fin :
         for line in fin :
             if line.startswith('>') :
@@ -48,13 +70,15 @@ def xFasta2Matrix(prefix, fasta_file, core=0.95) :
                     seqId = nameMap[seqName] = len(seqs)
                     seqs.append([seqName, contName, []])
             elif line.startswith('=') :
-                if fillMissingSeq(seqs, len(snp_data)) :
-                    snp_data.append(parse_snps(prefix, len(snp_data), seqs, core))
+                n_base += add_block(seqs)
+                if n_base >= 2**27 :
+                    run_tasks()
+                    n_base = 0
                 seqs = [ [n] for n,i in sorted(nameMap.items(), key=lambda x:x[1]) ]
             else :
-                seqs[seqId][2].extend(line.strip().split())
-    if fillMissingSeq(seqs, len(snp_data)) :
-        snp_data.append(parse_snps(prefix, len(snp_data), seqs, core))
+                seqs[seqId][2].append(''.join(line.split()))
+    add_block(seqs)
+    run_tasks()
     
     const_sites = np.sum([ snp[2] for snp in snp_data ], axis=0)
     names = [n for n,i in sorted(nameMap.items(), key=lambda x:x[1])]
@@ -67,72 +91,40 @@ def xFasta2Matrix(prefix, fasta_file, core=0.95) :
                 fout.write('## Missing_region: {0} {1} {2}\n'.format(snp[0], s, e))
         fout.write('#seq\t#site\t' + '\t'.join(names) + '\n')
         for snp in snp_data :
-            d = np.load(snp[4])
-            sites, sv = d['sites'], d['snps']
-            for s in sites :
-                fout.write('{0}\t{1}\t{2}\n'.format(snp[0], s[0], '\t'.join(sv[s[1]].astype(str))))
-            os.unlink(snp[4])
+            for npz in snp[4] :
+                with np.load(npz) as d :
+                    sites, sv = d['sites'], d['snps']
+                # genomes that only appear in later blocks are missing here
+                texts = np.full([sv.shape[0], 2*len(names)], 9, dtype=np.uint8)
+                texts[:, ::2], texts[:, -1] = 45, 10
+                texts[:, :2*sv.shape[1]:2] = sv
+                texts = texts.tobytes().decode('latin-1')
+                texts = [ texts[i:i+2*len(names)] for i in range(0, len(texts), 2*len(names)) ]
+                fout.write(''.join([ '{0}\t{1}\t{2}'.format(snp[0], s, texts[i]) for s, i in sites.tolist() ]))
+                os.unlink(npz)
     return prefix+'.matrix.gz'
     
-def parse_snps(prefix, id, seq, core=0.95) :
-    missing = []
-    snps, sites ={}, []
-
-    const_sites = {
-        b'A' : 0., b'C' : 0.,
-        b'G' : 0., b'T' : 0.,
-    }
-    type_id = 0
-
-    contName = seq[0][1]
-    seqs = np.array([ (re.sub(r'[^ACGT]', r'-', s[2].upper())) for s in seq ], dtype='c', order='F')
-
-    for ref_site, bases in enumerate(seqs.T) :
-        b_key = tuple(bases)
-        if b_key in snps :
-            s = snps[b_key]
-            if s[0] == -2 :
-                missing.append(ref_site+1)
-            elif s[0] == -1 :
-                const_sites[s[2]] += s[3]
-            else :
-                s[1] += 1
-                sites.append([ref_site+1, s[0]])
-            continue
-        
-        types, counts = np.unique(bases, return_counts=True)
-        pType = (types != b'-')
-        types, counts = types[pType], counts[pType]
-        countSum = np.sum(counts)/bases.size
-
-        if types.size > 0 and countSum >= core :
-            if types.size == 1 :
-                snps[b_key] = [-1, 0., types[0], 1]  #countSum]
-                const_sites[types[0]] += 1  #countSum
-            else :
-                snps[b_key] = [type_id, 1.]
-                sites.append([ref_site+1, type_id])
-                type_id += 1
-        else :
-            snps[b_key] = [-2]
-            missing.append(ref_site+1)
-    if len(missing) : 
-        missing2 = [[missing[0], missing[0]]]
-        for m in missing[1:] :
-            if missing2[-1][1] +1 == m :
-                missing2[-1][1] = m
-            else :
-                missing2.append([m, m])
-        missing = []
-        del missing
-    else :
-        missing2 = []
-    snps = np.array([ k for k,v in sorted([[k,v] for k,v in snps.items() if v[0]>=0], key=lambda v:v[1][0]) ])
-    #snps = pd.DataFrame([ [k, v[1]] for k,v in sorted([[k,v] for k,v in snps.items() if v[0]>=0], key=lambda v:v[1][0]) ]).values
-    const_sites = np.array([const_sites[b'A'],const_sites[b'C'],const_sites[b'G'],const_sites[b'T']])
-    outputs = dict(sites = np.array(sites), snps = snps)
+def parse_snps(data) :
+    '''constant bases, missing regions and variable patterns of a segment (taxa x columns) of an alignment block'''
+    prefix, id, block_id, seqs, offset, core = data
+    counts = np.array([ np.sum(seqs == b, 0) for b in b'ACGT' ])
+    n_type = np.sum(counts > 0, 0)
+    present = (n_type > 0) & (np.sum(counts, 0)/seqs.shape[0] >= core)
+    const_sites = np.sum(counts[:, present & (n_type == 1)] > 0, 1).astype(float)
+
+    missing = np.diff(np.concatenate([[0], (~present).astype(int), [0]]))
+    missing = np.array([np.where(missing == 1)[0] + offset + 1, np.where(missing == -1)[0] + offset]).T.tolist()
+
+    # variable columns are deduplicated over their bytes; pattern ids follow the first appearance
+    variable = np.where(present & (n_type > 1))[0]
+    cols = np.ascontiguousarray(seqs[:, variable].T)
+    _, first, inv = np.unique(cols.view(np.dtype((np.void, max(cols.shape[1], 1)))).ravel(), return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    type_ids = np.zeros(order.size, dtype=int)
+    type_ids[order] = np.arange(order.size)
+    outputs = dict(sites = np.array([variable + offset + 1, type_ids[inv.ravel()]], dtype=np.int64).T, snps = cols[first[order]])
     np.savez_compressed('{0}.{1}.npz'.format(prefix, id), **outputs)
-    return contName, seqs.shape[1], const_sites, missing2, '{0}.{1}.npz'.format(prefix, id)
+    return block_id, const_sites, missing, '{0}.{1}.npz'.format(prefix, id)
 
 def write_phylip(prefix, names, snps) :
     invariants = {65:0, 67:0, 71:0, 84:0, 45:0}
@@ -156,7 +148,7 @@ def write_phylip(prefix, names, snps) :
         asc_file = prefix + '.asc'
         constant_file = prefix + '.constant'
         with open(asc_file, 'w') as fout :
-            fout.write('[asc~{0}], ASC_DNA,p1=1-{1}\n'.format(constant_file,n_seq))
+            fout.write('[asc~{0}], ASC_DNA,p1=1-{1}\n'.format(os.path.abspath(constant_file),n_seq))
         with open(constant_file, 'w') as fout :
             fout.write(' '.join([str(int(x+0.5)) for y,x in sorted(invariants.items())[1:]]) + '\n')
     else :
@@ -177,9 +169,9 @@ def write_phylips(prefix, names, snps, n_split=4) :
             snp = snps[snp_idx[idx]]
             if snp[3] == 0 and snp[2][0] in invariants :
                 invariants[ snp[2][0] ] += snp_weight[idx]
+        var_sites &= np.array([ snps[idx][2][0] in invariants for idx in snp_idx ], dtype=bool)
         weights = snp_weight[var_sites]
-        snp_array = np.array([ snps[idx][2] for idx in snp_idx[var_sites] \
-                               if snps[idx][2][0] in invariants ], dtype=np.uint8).T
+        snp_array = np.array([ snps[idx][2] for idx in snp_idx[var_sites] ], dtype=np.uint8).T
 
         with open(pp+'.phy.weight', 'w') as fout :
             fout.write(' '.join([str(x) for x in weights]))
@@ -195,7 +187,7 @@ def write_phylips(prefix, names, snps, n_split=4) :
             asc_file = pp + '.asc'
             constant_file = pp + '.constant'
             with open(asc_file, 'w') as fout :
-                fout.write('[asc~{0}], ASC_DNA,p1=1-{1}\n'.format(constant_file,n_seq))
+                fout.write('[asc~{0}], ASC_DNA,p1=1-{1}\n'.format(os.path.abspath(constant_file),n_seq))
             with open(constant_file, 'w') as fout :
                 fout.write(' '.join([str(int(x+0.5)) for y,x in sorted(invariants.items())[1:]]) + '\n')
         else :
@@ -204,24 +196,62 @@ def write_phylips(prefix, names, snps, n_split=4) :
         outputs.append([pp+'.phy' , pp + '.phy.weight', asc_file, invariants])
     return outputs
 
+def threads_for(n_pattern, n_proc, min_thread=2) :
+    '''threads for a tree inference over n_pattern alignment patterns: one per ~1000 patterns, within [min_thread, n_proc].
+    RAxML-PTHREADS needs at least 2'''
+    return int(max(min_thread, min(n_proc, np.ceil(n_pattern/1000.))))
+
+def scratch_folder(prefix) :
+    return tempfile.mkdtemp(prefix=os.path.basename(prefix)+'.', dir=os.path.dirname(os.path.abspath(prefix)))
+
+def run_jobs(jobs, n_proc) :
+    '''run external jobs [cmd, n_thread, folder] concurrently, each within its own folder,
+    keeping the sum of their threads within n_proc (a larger job runs alone)'''
+    running, pending = [], list(jobs)
+    while pending or running :
+        for job in list(pending) :
+            if not running or sum([ j[1] for j, p in running ]) + job[1] <= n_proc :
+                pending.remove(job)
+                with open(os.path.join(job[2], 'log'), 'a') as log :
+                    running.append([job, Popen(job[0].split(), cwd=job[2], stdout=log, stderr=log)])
+        finished = [ r for r in running if r[1].poll() is not None ]
+        if finished :
+            running = [ r for r in running if r[1].returncode is None ]
+            for job, p in finished :
+                if p.returncode != 0 :
+                    for j, p2 in running :
+                        p2.kill()
+                    with open(os.path.join(job[2], 'log')) as fin :
+                        logger('{0}\n{1}'.format(job[0], fin.read()))
+                    raise ValueError('Job failed with exit code {0}. See log above from {1}'.format(p.returncode, job[2]))
+        else :
+            sleep(0.2)
+    return [ job[2] for job in jobs ]
+
 def run_rescale(prefix, tree, data, n_proc=5):
     branches = {}
     cnt = 0
+    name, tree_file, jobs = os.path.basename(prefix), os.path.abspath(tree), []
     for phy, weights, asc, invariants in data :
         cnt += sum(invariants.values())
-        for fname in glob.glob('RAxML_*.{0}'.format(prefix)):
-            os.unlink(fname)
+        n_thread = threads_for(invariants[-1], n_proc)
         if asc is None:
-            cmd = '{0} -m GTR{4} -n {1} -t {7} -f e -D -s {2} -a {3} -T {5} -p {6} --no-bfgs'.format(raxml, prefix, phy,
-                                                                                              weights, 'GAMMA', n_proc,
-                                                                                              rint, tree)
+            cmd = '{0} -m GTR{4} -n {1} -t {7} -f e -D -s {2} -a {3} -T {5} -p {6} --no-bfgs'.format(raxml, name, os.path.abspath(phy),
+                                                                                              os.path.abspath(weights), 'GAMMA', n_thread,
+                                                                                              rint, tree_file)
         else:
             cmd = '{0} -m ASC_GTR{5} -n {1} -t {8} -f e -D -s {2} -a {3} -T {6} -p {7} --asc-corr stamatakis --no-bfgs -q {4}'.format(
-                    raxml, prefix, phy, weights, asc, 'GAMMA', n_proc, rint, tree)
-        run = Popen(cmd.split())
-        run.communicate()
-
-        tre = Tree('RAxML_result.{0}'.format(prefix), format=0)
+                    raxml, name, os.path.abspath(phy), os.path.abspath(weights), os.path.abspath(asc), 'GAMMA', n_thread, rint, tree_file)
+        jobs.append([cmd, n_thread, scratch_folder(prefix)])
+    try :
+        # partitions are independent, so they run together in separate folders
+        folders = run_jobs(jobs, n_proc)
+        trees = [ Tree(os.path.join(folder, 'RAxML_result.{0}'.format(name)), format=0) for folder in folders ]
+    finally :
+        for job in jobs :
+            shutil.rmtree(job[2], ignore_errors=True)
+
+    for (phy, weights, asc, invariants), tre in zip(data, trees) :
         with open(phy+'.subtree', 'w') as fout :
             fout.write(tre.write(format=0)+'\n')
         for node in tre.get_descendants('postorder'):
@@ -235,7 +265,7 @@ def run_rescale(prefix, tree, data, n_proc=5):
             else :
                 branches[key].append(node.dist)
 
-        for fn in glob.glob('RAxML_*.{0}'.format(prefix)) + [phy, phy+'.reduced', weights, asc]:
+        for fn in [phy, phy+'.reduced', weights, asc]:
             try:
                 os.unlink(fn)
             except:
@@ -265,35 +295,43 @@ def run_rescale(prefix, tree, data, n_proc=5):
 
 
 def run_raxml(prefix, phy, weights, asc, model='CAT', n_proc=5, invariants=None) :
-    for fname in glob.glob('RAxML_*.{0}'.format(prefix)) :
-        os.unlink(fname)
+    name, folder = os.path.basename(prefix), scratch_folder(prefix)
+    n_thread = threads_for(invariants[-1], n_proc)
+    phy_file, weight_file, asc_file = [ os.path.abspath(fn) if fn else fn for fn in (phy, weights, asc) ]
     if asc is None :
         if model == 'CAT' :
-            cmd = '{0} -m GTR{4} -n {1} -f D -D -V -s {2} -a {3} -T {5} --no-bfgs -p {6}'.format(raxml, prefix, phy, weights, model, n_proc, rint)
+            cmd = '{0} -m GTR{4} -n {1} -f D -D -V -s {2} -a {3} -T {5} --no-bfgs -p {6}'.format(raxml, name, phy_file, weight_file, model, n_thread, rint)
         else :
-            cmd = '{0} -m GTR{4} -n {1} -f D -D -s {2} -a {3} -T {5} -p {6} --no-bfgs'.format(raxml, prefix, phy, weights, model, n_proc, rint)
+            cmd = '{0} -m GTR{4} -n {1} -f D -D -s {2} -a {3} -T {5} -p {6} --no-bfgs'.format(raxml, name, phy_file, weight_file, model, n_thread, rint)
     else :
         if model == 'CAT' :
-            cmd = '{0} -m ASC_GTR{5} -n {1} -f D -D --no-bfgs -V -s {2} -a {3} -T {6} -p {7} --asc-corr=stamatakis -q {4}'.format(raxml, prefix, phy, weights, asc, model, n_proc, rint)
+            cmd = '{0} -m ASC_GTR{5} -n {1} -f D -D --no-bfgs -V -s {2} -a {3} -T {6} -p {7} --asc-corr=stamatakis -q {4}'.format(raxml, name, phy_file, weight_file, asc_file, model, n_thread, rint)
         else :
-            cmd = '{0} -m ASC_GTR{5} -n {1} -f D -D --no-bfgs -s {2} -a {3} -T {6} -p {7} --asc-corr=stamatakis -q {4}'.format(raxml, prefix, phy, weights, asc, model, n_proc, rint)
-    run = Popen(cmd.split())
-    run.communicate()
-    if model == 'CAT' and not os.path.isfile('RAxML_bestTree.{0}'.format(prefix)) :
-        return run_raxml(prefix, phy, weights, asc, 'GAMMA', n_proc, invariants)
-    
-    cnt = sum(invariants.values())
-    cmd = '{0} -m GTRCAT -n 2.{1} -f b -z RAxML_rellBootstrap.{1} -t RAxML_bestTree.{1}'.format(raxml, prefix)
-    Popen(cmd.split()).communicate()
-    fname = '{0}.unrooted.nwk'.format(prefix)
-    tre = Tree('RAxML_bipartitions.2.{0}'.format(prefix), format=0)
-    
+            cmd = '{0} -m ASC_GTR{5} -n {1} -f D -D --no-bfgs -s {2} -a {3} -T {6} -p {7} --asc-corr=stamatakis -q {4}'.format(raxml, name, phy_file, weight_file, asc_file, model, n_thread, rint)
+    try :
+        try :
+            run_jobs([[cmd, n_thread, folder]], n_proc)
+        except ValueError :
+            if model != 'CAT' :
+                raise
+        if model == 'CAT' and not os.path.isfile(os.path.join(folder, 'RAxML_bestTree.{0}'.format(name))) :
+            shutil.rmtree(folder)
+            return run_raxml(prefix, phy, weights, asc, 'GAMMA', n_proc, invariants)
+
+        cnt = sum(invariants.values())
+        cmd = '{0} -m GTRCAT -n 2.{1} -f b -z RAxML_rellBootstrap.{1} -t RAxML_bestTree.{1}'.format(raxml, name)
+        run_jobs([[cmd, 1, folder]], n_proc)
+        fname = '{0}.unrooted.nwk'.format(prefix)
+        tre = Tree(os.path.join(folder, 'RAxML_bipartitions.2.{0}'.format(name)), format=0)
+    finally :
+        shutil.rmtree(folder, ignore_errors=True)
+
     for node in tre.traverse() :
         if -0.5 < node.dist * cnt < 0.5 :
             node.dist = 0.0
     tre.write(outfile=fname, format=0)
-    
-    for fn in glob.glob('RAxML_*.{0}'.format(prefix)) + [phy, phy+'.reduced', weights, asc] :
+
+    for fn in [phy, phy+'.reduced', weights, asc] :
         try:
             os.unlink(fn)
         except :
@@ -315,6 +353,30 @@ def get_root(prefix, tree_file) :
     tree.write(outfile='{0}.rooted.nwk'.format(prefix), format=1)
     return '{0}.rooted.nwk'.format(prefix)
 
+def recode_sites(mat) :
+    '''recode a block of matrix rows (sites x taxa) into uint8 patterns.
+    returns the mask of variable sites, their patterns and the allele labels of re-coded sites'''
+    n_site, n_tax = mat.shape
+    inv, vocab = pd.factorize(mat.ravel(), sort=True)
+    inv, vocab = inv.reshape(mat.shape), np.array(vocab, dtype=str)
+    gap = (vocab == '-')
+    special = np.array([v == '.' or len(v) > 1 for v in vocab], dtype=bool)
+    code = np.array([ord(v) if len(v) == 1 else 0 for v in vocab], dtype=np.uint8)
+
+    presence = np.zeros([n_site, vocab.size], dtype=bool)
+    presence[np.repeat(np.arange(n_site), n_tax), inv.ravel()] = True
+    presence[:, gap] = False
+    rank = np.cumsum(presence, 1, dtype=np.int32)
+    variable = (rank[:, -1] >= 2) if vocab.size else np.zeros(n_site, dtype=bool)
+
+    # sites with '.' or multi-base alleles are re-coded as '-' = 0 and alleles ranked from 1
+    bases = code[inv]
+    labels = {}
+    for r in np.where(variable & presence[:, special].any(1))[0] :
+        bases[r] = rank[r, inv[r]] * (~gap[inv[r]])
+        labels[r] = np.array(['-'] + vocab[presence[r]].tolist())
+    return variable, bases[variable], labels
+
 def read_matrix(fname) :
     invariant = []
     seqLens, missing = [], []
@@ -339,47 +401,64 @@ def read_matrix(fname) :
                 break
             else :
                 part = np.array(line.strip().split('\t'))
-                cols = np.ones(part.shape, dtype=bool)
-                cols[:2] = False
-                w_cols = np.char.startswith(part, '#!W')
+                cols = np.arange(2, part.size)
+                w_cols = np.array([], dtype=int)
                 names = part[cols]
                 break
-        
-        bases, weights, sites = [], [], []
-        for mat in pd.read_csv(fin, header=None, sep='\t', usecols=cols.tolist() + w_cols.tolist() + [0,1], chunksize=10000, engine='c', dtype=str, low_memory=False, na_filter=False) :
-            mat = mat.values
-            logger('{0}\t{1}\t{2}\t{3}'.format(\
-                mat[0, 0], mat[0, 1], \
-                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, len(sites) ))
-
-            for m in mat :
-                btype, bidx = np.unique(['-'] + m[cols].tolist(), return_inverse=True)
-                if btype.size <= 2 :
-                    continue
-                sites.append([m[0], int(m[1]), 1, np.array([])])
-                weights.append(m[w_cols].astype(float).prod() if w_cols.size else 1.)
-                if '.' in btype or max(map(len, btype)) > 1 :
-                    missing_val = np.where(btype == '-')[0][0]
-                    bidx[bidx == missing_val] = 45
-                    bidx[bidx < missing_val] += 1
-                    bidx[bidx == 45] = 0
-                    sites[-1][3] = np.array(['-']+btype[btype != '-'].tolist())
-                    sites[-1][2] = 2
-                    bases.append(bidx[1:])
-                else :
-                    bases.append(np.array(list(map(ord, btype)), dtype=np.uint8)[bidx[1:]])
 
-    bases, weights, sites = np.vstack(bases), np.array(weights), np.array(sites, dtype=object)
-    indices = np.lexsort(bases.T)
-    snps = []
-
-    for idx in indices :
-        s, b, w = sites[idx], bases[idx], weights[idx]
-        if not snps or np.any(b != snps[-1][2]) :
-            snps.append([ len(snps), w, b, s[2] ])
-        else :
-            snps[-1][1] += w
-        s[2] = snps[-1][0]
+        # only unique patterns are kept; they are found through the bytes of packed rows
+        pattern_ids, patterns, weights, types = {}, [], [], []
+        seqs, positions, site_ids, labels = [], [], [], {}
+        n_site = 0
+        chunksize = max(1024, 2**24 // max(names.size, 1))
+        for mat in pd.read_csv(fin, header=None, sep='\t', usecols=sorted(cols.tolist() + w_cols.tolist() + [0,1]), chunksize=chunksize, engine='c', dtype=str, low_memory=False, na_filter=False) :
+            logger('{0}\t{1}\t{2}\t{3}'.format(\
+                mat.iat[0, 0], mat.iat[0, 1], \
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, n_site ))
+            variable, bases, lab = recode_sites(mat[cols].values)
+            if bases.shape[0] == 0 :
+                continue
+            w = mat[w_cols].values[variable].astype(float).prod(1) if w_cols.size else np.ones(bases.shape[0])
+            vidx = np.cumsum(variable) - 1
+            coded = np.zeros(bases.shape[0], dtype=bool)
+            for r, l in lab.items() :
+                coded[vidx[r]] = True
+                labels[n_site + vidx[r]] = l
+
+            keys = np.ascontiguousarray(bases).view(np.dtype((np.void, bases.shape[1]))).ravel()
+            _, first, inv = np.unique(keys, return_index=True, return_inverse=True)
+            inv = inv.ravel()
+            chunk_w = np.bincount(inv, weights=w)
+            ids = np.zeros(first.size, dtype=int)
+            for i, f in enumerate(first) :
+                k = keys[f].tobytes()
+                if k not in pattern_ids :
+                    pattern_ids[k] = len(patterns)
+                    patterns.append(bases[f])
+                    weights.append(0.)
+                    types.append(2 if coded[f] else 1)
+                ids[i] = pattern_ids[k]
+                weights[ids[i]] += chunk_w[i]
+            seqs.append(mat[0].values[variable])
+            positions.append(mat[1].values[variable].astype(int))
+            site_ids.append(ids[inv])
+            n_site += inv.size
+
+    # number patterns in the lexicographic order of their columns
+    patterns = np.array(patterns, dtype=np.uint8).reshape([-1, names.size])
+    order = np.lexsort(patterns.T)
+    rank = np.zeros(order.size, dtype=int)
+    rank[order] = np.arange(order.size)
+    snps = [ [id, weights[o], patterns[o], types[o]] for id, o in enumerate(order) ]
+
+    sites = np.empty([n_site, 4], dtype=object)
+    if n_site :
+        sites[:, 0] = np.concatenate(seqs).tolist()
+        sites[:, 1] = np.concatenate(positions).tolist()
+        sites[:, 2] = rank[np.concatenate(site_ids)].tolist()
+    sites[:, 3].fill(np.array([]))
+    for i, l in labels.items() :
+        sites[i, 3] = l
 
     for inv in invariant.items() :
         b_key = np.array([inv[0]] * len(names), dtype=np.uint8)
@@ -388,6 +467,91 @@ def read_matrix(fname) :
         snp[1] = np.ceil(snp[1])
     return names, sites, np.array(snps, dtype=object), np.array(seqLens, dtype=object), np.array(missing, dtype=object)
 
+def source_key(fname) :
+    stat = os.stat(fname)
+    return '{0}:{1}:{2}'.format(os.path.abspath(fname), stat.st_size, stat.st_mtime_ns)
+
+def save_store(store, arrays, sites, seqLens, missing, **meta) :
+    '''write arrays (as memory-mappable .npy) with sites, sequence lengths and missing regions into a store folder'''
+    tmp = '{0}.{1}'.format(store, os.getpid())
+    if os.path.isdir(tmp) :
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    contigs = pd.factorize(np.concatenate([sites.T[0] if len(sites) else [], [s[0] for s in seqLens], [m[0] for m in missing]]).astype(str))
+    contig_ids = dict(zip(contigs[1], range(contigs[1].size)))
+
+    for key, array in arrays.items() :
+        np.save(os.path.join(tmp, key + '.npy'), array)
+    np.save(os.path.join(tmp, 'sites.npy'), np.array([contigs[0][:len(sites)], sites.T[1] if len(sites) else [], sites.T[2] if len(sites) else []], dtype=np.int64).T)
+    label_sites = np.array([i for i, s in enumerate(sites) if len(s) > 3 and len(s[3])], dtype=np.int64)
+    np.savez(os.path.join(tmp, 'meta.npz'), contigs=np.asarray(contigs[1]).astype(str), \
+             seq_lens=np.array([[contig_ids[n], l] for n, l in seqLens], dtype=np.int64).reshape([-1, 2]), \
+             missing=np.array([[contig_ids[n], s, e] for n, s, e in missing], dtype=np.int64).reshape([-1, 3]), \
+             label_sites=label_sites, label_values=np.array(['\t'.join(sites[i][3]) for i in label_sites], dtype=str), **meta)
+    if os.path.isdir(store) :
+        shutil.rmtree(store)
+    os.rename(tmp, store)
+    return store
+
+def load_store(store, source=None) :
+    '''arrays (memory-mapped), sites, seqLens, missing and metadata of a store folder.
+    None if it is absent or was built from another source'''
+    if not os.path.isfile(os.path.join(store, 'meta.npz')) :
+        return None
+    with np.load(os.path.join(store, 'meta.npz')) as meta :
+        meta = { k:meta[k] for k in meta.files }
+    if source is not None and str(meta.get('source', '')) != source :
+        return None
+    arrays = { os.path.basename(fn)[:-4]:np.load(fn, mmap_mode='r') for fn in glob.glob(os.path.join(store, '*.npy')) }
+    site_arr = arrays.pop('sites')
+    contigs = meta['contigs'].tolist()
+
+    sites = np.empty([site_arr.shape[0], 4], dtype=object)
+    sites[:, 0] = np.array(contigs, dtype=object)[site_arr[:, 0]].tolist()
+    sites[:, 1] = site_arr[:, 1].tolist()
+    sites[:, 2] = site_arr[:, 2].tolist()
+    sites[:, 3].fill(np.array([]))
+    for i, l in zip(meta['label_sites'], meta['label_values']) :
+        sites[i, 3] = np.array(l.split('\t'))
+    seqLens = np.array([[contigs[n], l] for n, l in meta['seq_lens'].tolist()], dtype=object)
+    missing = np.array([[contigs[n], s, e] for n, s, e in meta['missing'].tolist()], dtype=object)
+    return meta, arrays, sites, seqLens, missing
+
+def write_patterns(store, names, sites, snps, seqLens, missing, source='') :
+    '''save the outputs of read_matrix into a store folder'''
+    invariants = { snp[2][0]:snp[1] for snp in snps if snp[3] == 0 }
+    return save_store(store, dict(patterns=np.array([snp[2] for snp in snps], dtype=np.uint8).reshape([-1, len(names)])), \
+                      sites, seqLens, missing, source=source, taxa=names, \
+                      weights=np.array([snp[1] for snp in snps], dtype=float), types=np.array([snp[3] for snp in snps], dtype=np.int8), \
+                      invariants=np.array([invariants.get(b, 0.) for b in (65, 67, 71, 84)]))
+
+def read_patterns(store, source=None) :
+    '''load a pattern store as the outputs of read_matrix; None if it is absent or was built from another source'''
+    data = load_store(store, source)
+    if data is None :
+        return None
+    meta, arrays, sites, seqLens, missing = data
+    patterns = arrays['patterns']
+    snps = np.empty([patterns.shape[0], 4], dtype=object)
+    snps[:, 0] = np.arange(patterns.shape[0]).tolist()
+    snps[:, 1] = list(meta['weights'])
+    snps[:, 3] = meta['types'].tolist()
+    for id, p in enumerate(patterns) :
+        snps[id, 2] = p
+    return meta['taxa'], sites, snps, seqLens, missing
+
+def load_matrix(fname, store=None) :
+    '''read_matrix through a pattern store, which is reused as long as the matrix is unchanged'''
+    if store :
+        data = read_patterns(store, source_key(fname))
+        if data is not None :
+            logger('Reuse site patterns in {0}'.format(store))
+            return data
+    data = read_matrix(fname)
+    if store :
+        write_patterns(store, *data, source=source_key(fname))
+    return data
+
 def read_ancestor(fname, names, snps) :
     snp_array = np.array([snp[2] for snp in snps]).T
     branches = names[:]
@@ -399,52 +563,110 @@ def read_ancestor(fname, names, snps) :
     return dict(zip(branches, snp_array)), [n[0] for n in snps]
 
 def get_mut(final_tree, names, states, sites) :
-    mutations = {}
-    branches = []
+    '''mutations on branches as rows of [node, seq, site, homoplasy, mutation], sorted.
+    states are patterns x nodes, sites are [seq, site, pattern_id(, allele labels)]'''
     name_ids = { n:id for id, n in enumerate(names) }
     if final_tree.name == '' :
         root = {n:1 for n in names}
         for n in final_tree.traverse() : root.pop(n.name, None)
         if len(root) == 1 :
             final_tree.name = list(root.keys())[0]
-    states = states.T
-    for node in final_tree.iter_descendants('postorder') :
-        for id, (m, n) in enumerate(zip(states[name_ids[node.name]], states[name_ids[node.up.name]])) :
-            #m, n = chr(m), chr(n)
-            if m != n and m not in (0, 45) and n not in (0, 45) :
-                if id not in mutations :
-                    mutations[id] = []
-                mutations[id].append([node.name, (n,m)])
-    outputs = []
-    for c, p, i, l in sites :
-        m = mutations.get(i, [])
-        len_m = {}
-        for mut in m :
-            s = tuple(sorted([mut[1][0], mut[1][-1]]))
-            mut.append(s)
-            len_m[s] = len_m.get(s, 0) + 1
-        if l.size == 0 :
-            for mut in m :
-                outputs.append([mut[0], c, p, len_m[mut[-1]], '{0}->{1}'.format(chr(mut[1][0]), chr(mut[1][1]))])
-        else :
-            for mut in m :
-                outputs.append([mut[0], c, p, len_m[mut[-1]], '{0}->{1}'.format(l[mut[1][0]], l[mut[1][1]])])
-    return sorted(outputs)
+    nodes = list(final_tree.iter_descendants('postorder'))
+    children = np.array([ name_ids[node.name] for node in nodes ], dtype=int)
+    parents = np.array([ name_ids[node.up.name] for node in nodes ], dtype=int)
+
+    # branch x pattern comparisons over blocks of patterns, then homoplasy counts over the unordered allele pairs of each pattern
+    states = np.asarray(states)
+    blockSize = max(1, 2**22 // max(children.size, 1))
+    pat_ids, br_ids, m, n = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    for bs in range(0, states.shape[0], blockSize) :
+        mb, nb = states[bs:bs+blockSize][:, children], states[bs:bs+blockSize][:, parents]
+        p, b = np.where((mb != nb) & (mb != 0) & (mb != 45) & (nb != 0) & (nb != 45))
+        pat_ids.append(p + bs)
+        br_ids.append(b)
+        m.append(mb[p, b].astype(np.int64))
+        n.append(nb[p, b].astype(np.int64))
+    pat_ids, br_ids, m, n = [ np.concatenate(x) for x in (pat_ids, br_ids, m, n) ]
+    bases = np.unique(np.concatenate([m, n]))
+    mc, nc, n_base = np.searchsorted(bases, m), np.searchsorted(bases, n), max(bases.size, 1)
+    _, pair_ids, pair_cnts = np.unique((pat_ids * n_base + np.minimum(mc, nc)) * n_base + np.maximum(mc, nc), return_inverse=True, return_counts=True)
+    homoplasy = pair_cnts[pair_ids]
+
+    # expand each pattern-level mutation to all sites of the pattern
+    sites = np.asarray(sites, dtype=object).reshape([len(sites), -1])
+    site_pats = sites[:, 2].astype(int)
+    site_order = np.argsort(site_pats, kind='stable')
+    n_sites = np.bincount(site_pats, minlength=states.shape[0])
+    site_starts = np.cumsum(n_sites) - n_sites
+    rep = n_sites[pat_ids]
+    mut_idx = np.repeat(np.arange(pat_ids.size), rep)
+    site_idx = site_order[site_starts[pat_ids][mut_idx] + np.arange(mut_idx.size) - np.repeat(np.cumsum(rep) - rep, rep)]
+
+    mut_types, mut_type_ids = np.unique(nc * n_base + mc, return_inverse=True)
+    mut_strs = np.array([ '{0}->{1}'.format(chr(bases[x // n_base]), chr(bases[x % n_base])) for x in mut_types ], dtype=object)
+    alleles = mut_strs[mut_type_ids[mut_idx]]
+    if sites.shape[1] > 3 :
+        for i in np.where([ len(l) > 0 for l in sites[site_idx, 3] ])[0] :
+            l, j = sites[site_idx[i], 3], mut_idx[i]
+            alleles[i] = '{0}->{1}'.format(l[n[j]], l[m[j]])
+
+    node_names = np.array(names, dtype=object)[children[br_ids[mut_idx]]]
+    seqs, positions, homoplasy = sites[site_idx, 0], sites[site_idx, 1].astype(int), homoplasy[mut_idx]
+    order = np.lexsort([ pd.factorize(alleles, sort=True)[0], homoplasy, positions, \
+                         pd.factorize(seqs, sort=True)[0], pd.factorize(node_names, sort=True)[0] ])
+    outputs = np.empty([order.size, 5], dtype=object)
+    outputs[:, 0], outputs[:, 1] = node_names[order], seqs[order]
+    outputs[:, 2], outputs[:, 3] = positions[order].tolist(), homoplasy[order].tolist()
+    outputs[:, 4] = alleles[order]
+    return outputs
+
+def write_mutations(fname, mutations, seqLens, missing) :
+    with uopen(fname, 'w') as fout :
+        for sl in seqLens :
+            fout.write('## Sequence_length: {0} {1}\n'.format(*sl))
+        for ms in missing :
+            fout.write('## Missing_region: {0} {1} {2}\n'.format(*ms))
+        fout.write('#Node\t#Seq\t#Site\t#Homoplasy\t#Mutation\n')
+        pd.DataFrame(mutations).to_csv(fout, sep='\t', header=False, index=False)
+    return fname
+
+def write_mutation_npz(fname, mutations, seqLens, missing) :
+    '''mutations in a binary form that RecHMM reads directly'''
+    br_ids, branches = pd.factorize(mutations[:, 0].astype(str))
+    seq_ids, contigs = pd.factorize(np.concatenate([[sl[0] for sl in seqLens], mutations[:, 1]]).astype(str))
+    contig_ids = dict(zip(contigs, range(len(contigs))))
+    np.savez_compressed(fname, branches=np.asarray(branches, dtype=str), contigs=np.asarray(contigs, dtype=str), \
+        seq_lens=np.array([ sl[1] for sl in seqLens ], dtype=np.int64), \
+        missing=np.array([ [contig_ids.get(ms[0], -1), ms[1], ms[2]] for ms in missing ], dtype=np.int64).reshape([-1, 3]), \
+        mutations=np.array([ br_ids, seq_ids[len(seqLens):], mutations[:, 2], mutations[:, 3] ], dtype=np.int64).T, \
+        alleles=mutations[:, 4].astype(str))
+    return fname
 
 def write_states(fname, names, states, sites, seqLens, missing) :
+    # text of each pattern is formatted once and shared by all its sites
+    states = np.asarray(states).astype(np.uint8)
+    texts = np.full([states.shape[0], 2*states.shape[1]], 9, dtype=np.uint8)
+    texts[:, ::2], texts[:, -1] = states, 10
+    texts = texts.tobytes().decode('latin-1')
+    texts = [ texts[i:i+2*states.shape[1]] for i in range(0, len(texts), 2*states.shape[1]) ]
     with uopen(fname, 'w') as fout :
         for sl in seqLens :
             fout.write('## Sequence_length: {0} {1}\n'.format(*sl))
         for ms in missing :
             fout.write('## Missing_region: {0} {1} {2}\n'.format(*ms))
         fout.write('#Seq\t#Site\t' + '\t'.join(names) + '\n')
-        for site in sites :
-            if len(site[3]) == 0 :
-                fout.write('{0}\t{1}\t{2}\n'.format(site[0], site[1], '\t'.join(np.frompyfunc(chr, 1, 1)(states[site[2]])) ))
-            else :
-                fout.write('{0}\t{1}\t{2}\n'.format(site[0], site[1], '\t'.join( site[3][states[site[2]]] ) ))
-
-def write_ancestral_proportion(fname, names, states, sites, seqLens, missing) :
+        for i in range(0, len(sites), 100000) :
+            fout.write(''.join([ '{0}\t{1}\t{2}'.format(site[0], site[1], texts[site[2]]) if len(site) < 4 or len(site[3]) == 0 else \
+                                 '{0}\t{1}\t{2}\n'.format(site[0], site[1], '\t'.join( site[3][states[site[2]]] )) for site in sites[i:i+100000] ]))
+
+def proportion_text(names, tag, state, labels=None) :
+    '''lines of a pattern in write_ancestral_proportion, with \\x00 in place of the site'''
+    tag = [ chr(t) for t in tag ] if labels is None else [ labels[t] for t in tag ]
+    return ''.join([ '\x00{0}\t{1}\n'.format(n, '\t'.join([ '{0}:{1:.5f}'.format(t, s) for t, s in zip(tag, ss)])) for n, ss in zip(names, state) ])
+
+def write_ancestral_proportion(fname, names, states, sites, seqLens, missing, cache_size=2**27) :
+    # texts of recently used patterns are kept, up to cache_size characters in total
+    texts, cached = OrderedDict(), 0
     with uopen(fname, 'w') as fout :
         for sl in seqLens :
             fout.write('## Sequence_length: {0} {1}\n'.format(*sl))
@@ -453,16 +675,36 @@ def write_ancestral_proportion(fname, names, states, sites, seqLens, missing) :
         
         fout.write('#Seq\t#Site\t#Type:Proportion\n')
         for c, p, i, l in sites :
-            tag, state = states[i]
             if l.size == 0 :
-                for n, ss in zip(names, state) :
-                    fout.write( '{0}\t{1}\t{2}\t{3}\n'.format(c, p, n, '\t'.join([ '{0}:{1:.5f}'.format(chr(t), s) for t, s in zip(tag, ss)]) ))
+                if i in texts :
+                    texts.move_to_end(i)
+                else :
+                    texts[i] = proportion_text(names, *states[i])
+                    cached += len(texts[i])
+                    while cached > cache_size and len(texts) > 1 :
+                        cached -= len(texts.popitem(last=False)[1])
+                fout.write(texts[i].replace('\x00', '{0}\t{1}\t'.format(c, p)))
             else :
-                for n, ss in zip(names, state) :
-                    fout.write( '{0}\t{1}\t{2}\t{3}\n'.format(c, p, n, '\t'.join([ '{0}:{1:.5f}'.format(l[t], s) for t, s in zip(tag, ss)]) ))
-                
+                fout.write(proportion_text(names, states[i][0], states[i][1], l).replace('\x00', '{0}\t{1}\t'.format(c, p)))
+
+def write_state_store(store, names, states, sites, seqLens, missing) :
+    '''binary counterpart of write_states (Viterbi states) or write_ancestral_proportion (list of [tags, proportions])'''
+    if isinstance(states, list) :
+        n_tag = max([ len(tag) for tag, state in states ] + [1])
+        tags = np.zeros([len(states), n_tag], dtype=np.uint8)
+        proportions = np.zeros([len(states), len(names), n_tag], dtype=np.float16)
+        for id, (tag, state) in enumerate(states) :
+            tags[id, :len(tag)] = tag
+            proportions[id, :, :len(tag)] = state[:, :len(tag)]
+        arrays = dict(tags=tags, proportions=proportions)
+    else :
+        arrays = dict(states=np.asarray(states, dtype=np.uint8))
+    return save_store(store, arrays, sites, seqLens, missing, nodes=np.array(names, dtype=str))
 
 def read_states(fname) :
+    if os.path.isdir(fname) :
+        meta, arrays, sites, seqLens, missing = load_store(fname)
+        return meta['nodes'].tolist(), arrays['states'], sites
     names, ss, sites = [], {}, []
     with uopen(fname) as fin :
         for line in fin :
@@ -508,11 +750,14 @@ snp2mut: phylogeny,ancestral''', default='aln2phy')
     parser.add_argument('--alignment', '-m', help='aligned sequences in either fasta format or Xmfa format. Required for "matrix" task.', default='')
     parser.add_argument('--snp', '-s', help='SNP matrix in specified format. Required for "phylogeny" and "ancestral" if alignment is not given', default='')
     parser.add_argument('--tree', '-z', help='phylogenetic tree. Required for "ancestral" task', default='')
-    parser.add_argument('--ancestral', '-a', help='Inferred ancestral states in a specified format. Required for "mutation" task', default='')
+    parser.add_argument('--ancestral', '-a', help='Inferred ancestral states, either the <prefix>.ancestral_states.gz text or the <prefix>.ancestral_states folder. Required for "mutation" task', default='')
     parser.add_argument('--core', '-c', help='Core genome proportion. Default: 0.95', type=float, default=0.95)
     parser.add_argument('--nj', help='use rapidNJ instead of RAxML-ng.', default=False, action='store_true')
+    parser.add_argument('--fastnj', help='build a quick NJ tree from weighted SNP distances in-process, without RAxML or rapidNJ.', default=False, action='store_true')
     parser.add_argument('--ng', help='[expired]', default=True, action='store_true')
     parser.add_argument('--raxml', help='use RAxML instead of RAxML-ng', default=False, action='store_true')
+    parser.add_argument('--npz', help='also write mutations in a binary npz that RecHMM reads directly.', default=False, action='store_true')
+    parser.add_argument('--store', help='keep binary stores: the site patterns of the matrix in <prefix>.patterns, reused by later runs on the same matrix, and the ancestral states in <prefix>.ancestral_states (or .ancestral_proportion), which "-a" reads directly.', default=False, action='store_true')
     parser.add_argument('--n_proc', '-n', help='Number of processes. Default: 7. ', type=int, default=7)
 
     args = parser.parse_args(a)
@@ -526,64 +771,78 @@ snp2mut: phylogeny,ancestral''', default='aln2phy')
     return args
 
 def infer_ancestral2(data) :
-    state, branches, n_node, infer = data
-    state[state == 45] = 0
-    transitions = {}
-    tag, code = np.unique(state, return_inverse=True)
-    n_state = tag.size
-    missing = np.where(tag == 0)[0]
-    if missing.size > 0 :
-        tag, n_state = tag[tag != 0], n_state - 1
-        code[code == missing[0]] = -1
-        code[code > missing[0]] -= 1
-    if len(tag) == 0 :
-        tag = np.array([45])
-    if np.sum(np.in1d(tag, [65, 67, 71, 84])) == n_state :
-        n_state = 4
-
-    if n_state not in transitions :
-        transitions[n_state] = np.zeros(shape=[n_node, n_state, n_state])
-        for tr, (s, t, v) in zip(transitions[n_state], branches) :
-            tr.fill((1.0-v)/n_state)
-            np.fill_diagonal(tr, (1.+(n_state-1.)*v)/n_state)
-
-    transition = transitions[n_state]
-
-    if infer == 'margin' :
-        alpha = np.ones(shape=[n_node, n_state])/n_state
-        alpha[code >= 0] = 0
-        alpha[code >= 0, code[code >= 0]] = 1
-        beta = np.ones(alpha.shape)
-        for (s, t, v), tr in zip(branches, transition) :
-            alpha[t] = alpha[t]/np.sum(alpha[t])
-            if s :
-                beta[t] = np.dot(alpha[t], tr)
-                alpha[s] *= beta[t]
-
-        for (s, t, v), tr in reversed(list(zip(branches, transition))) :
-            if s :
-                alpha[t] *= np.dot(alpha[s]/beta[t], tr)
-        return [tag, alpha]
-    else :
-        pt = np.log(transition)
-        ids = np.arange(n_state)
-        alpha = np.zeros(shape=[n_node, n_state, n_state])
-        path = np.zeros(shape=[n_node, n_state], dtype=int)
-        alpha[code >= 0] = -9999
-        alpha[code >= 0, :, code[code >=0]] = 0
-
-        for (s, t, v), tr in zip(branches, pt) :
-            x = alpha[t] + tr
-            path[t] = np.argmax(x, 1)
-            alpha[s] += x[ids, path[t]]
-
-        r = np.zeros(shape=[n_node], dtype=int)
-        for s, t, v in reversed(branches) :
-            if not s :
-                r[t] = np.argmax(alpha[t, 0])
-            else :
-                r[t] = path[t][r[s]]
-        return tag[r]
+    '''ancestral states of a block of patterns (patterns x nodes), evaluated together as (nodes x patterns x states) tensors'''
+    states, branches, n_node, infer = data
+    states = np.array(states, dtype=np.uint8)
+    states[states == 45] = 0
+    n_pat = states.shape[0]
+    parents = np.array([ -1 if s is None else s for s, t, v in branches ], dtype=int)
+    children = np.array([ t for s, t, v in branches ], dtype=int)
+    v = np.array([ v for s, t, v in branches ], dtype=float)
+
+    # per pattern: its tags (observed bases), node codes into the tags and the number of states
+    presence = np.zeros([n_pat, 256], dtype=bool)
+    presence[np.repeat(np.arange(n_pat), n_node), states.ravel()] = True
+    presence[:, 0] = False
+    rank = np.cumsum(presence, 1) - 1
+    codes = rank[np.arange(n_pat)[:, None], states]
+    codes[states == 0] = -1
+    non_acgt = np.ones(256, dtype=bool)
+    non_acgt[[0, 65, 67, 71, 84]] = False
+    n_states = np.where(presence[:, non_acgt].any(1), presence.sum(1), 4)
+    tag_rows, tag_vals = np.where(presence)
+
+    outputs = np.zeros([n_pat, n_node], dtype=np.uint8) if infer != 'margin' else [None] * n_pat
+    for n_state in np.unique(n_states) :
+        idx = np.where(n_states == n_state)[0]
+        code = codes[idx].T
+        obs_node, obs_pat = np.where(code >= 0)
+        obs_code = code[obs_node, obs_pat]
+        transition = np.empty([v.size, n_state, n_state])
+        transition[:] = ((1.0-v)/n_state)[:, None, None]
+        transition[:, np.arange(n_state), np.arange(n_state)] = ((1.+(n_state-1.)*v)/n_state)[:, None]
+
+        if infer == 'margin' :
+            alpha = np.ones(shape=[n_node, idx.size, n_state])/n_state
+            alpha[obs_node, obs_pat] = 0
+            alpha[obs_node, obs_pat, obs_code] = 1
+            beta = np.ones(alpha.shape)
+            for s, t, tr in zip(parents, children, transition) :
+                alpha[t] /= np.sum(alpha[t], 1, keepdims=True)
+                if s >= 0 :
+                    beta[t] = np.dot(alpha[t], tr)
+                    alpha[s] *= beta[t]
+            for s, t, tr in zip(parents[::-1], children[::-1], transition[::-1]) :
+                if s >= 0 :
+                    alpha[t] *= np.dot(alpha[s]/beta[t], tr)
+            for p, i in enumerate(idx) :
+                tag = tag_vals[tag_rows == i].astype(np.uint8)
+                outputs[i] = [tag if tag.size else np.array([45], dtype=np.uint8), alpha[:, p].copy()]
+        else :
+            pt = np.log(transition)
+            alpha = np.zeros(shape=[n_node, idx.size, n_state])
+            path = np.zeros(shape=[n_node, idx.size, n_state], dtype=np.uint8)
+            alpha[obs_node, obs_pat] = -9999
+            alpha[obs_node, obs_pat, obs_code] = 0
+            for s, t, tr in zip(parents, children, pt) :
+                x = alpha[t][:, None, :] + tr
+                path[t] = np.argmax(x, 2)
+                if s >= 0 :
+                    alpha[s] += np.max(x, 2)
+                else :
+                    root = alpha[t] + np.max(x, 2)
+            r = np.zeros(shape=[n_node, idx.size], dtype=int)
+            pat_ids = np.arange(idx.size)
+            for s, t in zip(parents[::-1], children[::-1]) :
+                if s < 0 :
+                    r[t] = np.argmax(root, 1)
+                else :
+                    r[t] = path[t][pat_ids, r[s]]
+            tags = np.full([idx.size, n_state], 45, dtype=np.uint8)
+            in_block = np.isin(tag_rows, idx)
+            tags[np.searchsorted(idx, tag_rows[in_block]), rank[tag_rows[in_block], tag_vals[in_block]]] = tag_vals[in_block]
+            outputs[idx] = tags[pat_ids, r].T
+    return outputs
 
 def infer_ancestral(tree, names, snps, sites, infer='margin', rescale=1.0) :
     global pool
@@ -624,11 +883,13 @@ def infer_ancestral(tree, names, snps, sites, infer='margin', rescale=1.0) :
         else :
             branches.append([ None, node_names[branch.name], 1e-8 ])
 
+    # patterns are sent in blocks that keep each (nodes x patterns x states) tensor around 2**22 cells
+    block = max(1, min(2**20 // n_node, -(-states.shape[0] // 32)))
     def prep(states) :
-        for state in states :
-            yield [state, branches, n_node, infer]
-    states = pool.imap(infer_ancestral2, prep(states), chunksize=100)
-    return tree, [ k for k, v in sorted(node_names.items(), key=lambda x:x[1])], np.array(list(states), dtype=np.uint8) if infer =='viterbi' else list(states)
+        for i in range(0, states.shape[0], block) :
+            yield [states[i:i+block], branches, n_node, infer]
+    states = pool.imap(infer_ancestral2, prep(states))
+    return tree, [ k for k, v in sorted(node_names.items(), key=lambda x:x[1])], np.vstack(list(states)) if infer =='viterbi' else [ s for ss in states for s in ss ]
 
 def write_fasta(prefix, names, snps) :
     invariants = {65:0, 67:0, 71:0, 84:0, 45:0}
@@ -662,14 +923,190 @@ def run_rapidnj(prefix, fastafile, invariants) :
     return fname
 
 
-def run_raxml_ng(prefix, fastafile, invariants, n_start) :
+try :
+    popcount = np.bitwise_count
+except :
+    bit_counts = np.array([bin(x).count('1') for x in range(256)], dtype=np.uint8)
+    def popcount(x) :
+        return bit_counts[x.view(np.uint8)].reshape(x.shape + (8,)).sum(-1)
+
+def pack_snps(names, snps) :
+    invariants = {65:0, 67:0, 71:0, 84:0, 45:0}
+    for snp in snps :
+        if snp[3] == 0 and snp[2][0] in invariants :
+            invariants[ snp[2][0] ] += snp[1]
+    snp2 = [ snp for snp in snps if snp[3] == 1 and snp[2][0] in invariants ]
+    invariants[-1] = np.sum([ snp[1] for snp in snp2 ])
+    if not len(snp2) :
+        return np.zeros([3, len(names), 0], dtype=np.uint64), np.zeros(0), invariants
+
+    # presence, high and low bits of ACGT; one plane per bit of the pattern weights
+    codes = np.full(256, 4, dtype=np.uint8)
+    codes[[65, 67, 71, 84]] = [0, 1, 2, 3]
+    mat = codes[np.array([ snp[2] for snp in snp2 ]).T]
+    weights = np.array([ snp[1] for snp in snp2 ]).astype(int)
+    planes = np.array([ mat < 4, (mat & 2) > 0, (mat & 1) > 0 ])
+    bits, word_wt = [], []
+    for k in range(int(weights.max()).bit_length()) :
+        cols = (weights >> k) & 1 > 0
+        if cols.sum() :
+            b = np.packbits(planes[:, :, cols], axis=2, bitorder='little')
+            b = np.pad(b, [[0, 0], [0, 0], [0, -b.shape[2] % 8]]).view(np.uint64)
+            bits.append(b)
+            word_wt.append(np.repeat(float(1 << k), b.shape[2]))
+    return np.concatenate(bits, axis=2), np.concatenate(word_wt), invariants
+
+def snp_dist_rows(data) :
+    fname, start, end = data
+    bits = np.load(fname, mmap_mode='r')
+    word_wt = np.load(fname[:-4] + '.weight.npy')
+    pres, hi, lo = bits
+    chunk = max(1, 2**22 // max(1, bits.shape[2]))
+    dist = np.zeros([end - start, bits.shape[1]])
+    for i in range(start, end) :
+        p, h, l = np.asarray(pres[i]), np.asarray(hi[i]), np.asarray(lo[i])
+        for s in range(0, i, chunk) :
+            e = min(i, s + chunk)
+            diff = ((hi[s:e] ^ h) | (lo[s:e] ^ l)) & pres[s:e] & p
+            dist[i - start, s:e] = popcount(diff).dot(word_wt)
+    return start, dist
+
+def snp_distance(prefix, names, snps) :
+    global pool
+    if not pool :
+        pool = Pool(5)
+    bits, word_wt, invariants = pack_snps(names, snps)
+    n_tax = len(names)
+    folder = scratch_folder(prefix)
+    fname = os.path.join(folder, 'bits.npy')
+    np.save(fname, bits)
+    np.save(fname[:-4] + '.weight.npy', word_wt)
+    del bits
+
+    # row blocks of similar numbers of pairs
+    pairs = np.cumsum(np.arange(n_tax))
+    n_block = min(n_tax, 64)
+    ends = np.unique(np.minimum(np.searchsorted(pairs, np.linspace(0, pairs[-1], n_block+1)[1:]) + 1, n_tax))
+    dist = np.zeros([n_tax, n_tax])
+    for start, d in pool.imap_unordered(snp_dist_rows, [ [fname, s, e] for s, e in zip(np.concatenate([[0], ends[:-1]]), ends) ]) :
+        dist[start:start+d.shape[0]] = d
+    shutil.rmtree(folder)
+    dist += dist.T
+    return dist, invariants
+
+@jit(nopython=True)
+def rapid_nj(D) :
+    n = D.shape[0]
+    rsum = np.zeros(n)
+    for i in range(n) :
+        rsum[i] = np.sum(D[i])
+    alive = np.ones(n, dtype=np.bool_)
+    born = np.zeros(n, dtype=np.int64)
+    built = np.zeros(n, dtype=np.int64)
+    head = np.zeros(n, dtype=np.int64)
+    size = np.zeros(n, dtype=np.int64)
+    order = np.empty((n, n), dtype=np.int32)
+    for i in range(n) :
+        k = 0
+        for x in np.argsort(D[i]) :
+            if x != i :
+                order[i, k] = x
+                k += 1
+        size[i] = k
+    joins = np.zeros((n-1, 2), dtype=np.int64)
+    lens = np.zeros((n-1, 2))
+    u = np.zeros(n)
+    m = n
+    for t in range(1, n-2) :
+        u_max, r0 = -np.inf, -1
+        for x in range(n) :
+            if alive[x] :
+                u[x] = rsum[x]/(m-2)
+                if u[x] > u_max :
+                    u_max, r0 = u[x], x
+        # scan rows of sorted distances, stopping once the bound exceeds the best Q
+        q_min, bi, bj = np.inf, -1, -1
+        for rr in range(-1, n) :
+            r = r0 if rr < 0 else rr
+            if rr >= 0 and (r == r0 or not alive[r]) :
+                continue
+            h = head[r]
+            while h < size[r] and not (alive[order[r, h]] and born[order[r, h]] <= built[r]) :
+                h += 1
+            head[r] = h
+            for c in range(h, size[r]) :
+                j = order[r, c]
+                if not alive[j] or born[j] > built[r] :
+                    continue
+                if D[r, j] - u[r] - u_max > q_min :
+                    break
+                q = D[r, j] - u[r] - u[j]
+                if q < q_min :
+                    q_min, bi, bj = q, r, j
+        d = D[bi, bj]
+        li = 0.5*d + 0.5*(u[bi] - u[bj])
+        joins[t-1] = bi, bj
+        lens[t-1] = li, d - li
+        alive[bj] = False
+        m -= 1
+        rs = 0.
+        for x in range(n) :
+            if alive[x] and x != bi :
+                dk = 0.5*(D[bi, x] + D[bj, x] - d)
+                rsum[x] += dk - D[bi, x] - D[bj, x]
+                D[bi, x] = D[x, bi] = dk
+                rs += dk
+        rsum[bi] = rs
+        born[bi] = built[bi] = t
+        others = np.where(alive)[0]
+        others = others[others != bi]
+        order[bi, :others.size] = others[np.argsort(D[bi, others])]
+        size[bi], head[bi] = others.size, 0
+    others = np.where(alive)[0]
+    a, b, c = others[0], others[1], others[2]
+    joins[n-3] = a, b
+    lens[n-3] = 0.5*(D[a, b] + D[a, c] - D[b, c]), 0.5*(D[a, b] + D[b, c] - D[a, c])
+    joins[n-2] = a, c
+    lens[n-2] = 0., 0.5*(D[a, c] + D[b, c] - D[a, b])
+    return joins, lens
+
+def run_fastnj(prefix, names, snps) :
+    dist, invariants = snp_distance(prefix, names, snps)
+    cnt = max(sum(invariants.values()), 1)
+    joins, lens = rapid_nj(dist)
+    del dist
+
+    nodes = [ Tree(name=n) for n in names ]
+    tre = Tree()
+    for (i, j), (li, lj) in zip(joins[:-2], lens[:-2]) :
+        node = Tree()
+        node.add_child(nodes[i], dist=li)
+        node.add_child(nodes[j], dist=lj)
+        nodes[i] = node
+    (a, b), (_, c) = joins[-2], joins[-1]
+    for n, d in zip((a, b, c), (lens[-2][0], lens[-2][1], lens[-1][1])) :
+        tre.add_child(nodes[n], dist=d)
+    for node in tre.traverse() :
+        node.dist = 0.0 if node.dist < 0.5 else node.dist / cnt
+
+    fname = '{0}.unrooted.nwk'.format(prefix)
+    tre.write(outfile=fname, format=5)
+    return fname
+
+
+def run_raxml_ng(prefix, fastafile, invariants, n_start, n_proc=8) :
     cnt = sum(invariants.values())
     inv = [invariants[65], invariants[67], invariants[71], invariants[84], ]
-    cmd = '{raxml_ng} --thread 8 --redo --force --msa {0} --precision 8 --model GTR+G+ASC_STAM{{{1}}} --blmin 1e-8 --blopt nr_safe --tree pars{{{2}}}'.format(fastafile, '/'.join([str(int(x+0.5)) for x in inv]), n_start, **externals)
-    run = Popen(cmd.split(), universal_newlines=True)
-    run.communicate()
-    tre = Tree(fastafile+'.raxml.bestTree', format=0)
-    
+    folder, n_thread = scratch_folder(prefix), threads_for(invariants[-1], n_proc, 1)
+    cmd = '{raxml_ng} --thread {3} --redo --force --msa {0} --prefix {4} --precision 8 --model GTR+G+ASC_STAM{{{1}}} --blmin 1e-8 --blopt nr_safe --tree pars{{{2}}}'.format(os.path.abspath(fastafile), '/'.join([str(int(x+0.5)) for x in inv]), n_start, n_thread, os.path.join(folder, os.path.basename(fastafile)), **externals)
+    try :
+        run_jobs([[cmd, n_thread, folder]], n_proc)
+        tre = Tree(os.path.join(folder, os.path.basename(fastafile)+'.raxml.bestTree'), format=0)
+        for fn in glob.glob(os.path.join(folder, '*.raxml.*')) :
+            shutil.move(fn, os.path.join(os.path.dirname(os.path.abspath(fastafile)), os.path.basename(fn)))
+    finally :
+        shutil.rmtree(folder, ignore_errors=True)
+
     fname = '{0}.unrooted.nwk'.format(prefix)
     for node in tre.traverse() :
         if -0.5 < node.dist * cnt < 0.5 :
@@ -689,14 +1126,16 @@ def phylo(args) :
         sleep(1)
     if 'rescale' in args.tasks or 'phylogeny' in args.tasks or 'ancestral' in args.tasks or 'ancestral_proportion' in args.tasks or 'mutation' in args.tasks :
         assert os.path.isfile( args.snp )
-        names, sites, snps, seqLens, missing = read_matrix(args.snp)
+        names, sites, snps, seqLens, missing = load_matrix(args.snp, args.prefix + '.patterns' if args.store else None)
         if len(names) < 4 :
             raise ValueError('Taxa too few.')
 
     # build tree
     if 'phylogeny' in args.tasks :
         args.tree = args.prefix+'.tre'
-        if not args.nj and args.raxml :
+        if args.fastnj :
+            args.tree = run_fastnj(args.tree, names, snps)
+        elif not args.nj and args.raxml :
             phy, weights, asc, invariants = write_phylip(args.tree, names, snps)
             if phy != '' :
                 args.tree = run_raxml(args.tree, phy, weights, asc, 'CAT', args.n_proc, invariants)
@@ -706,7 +1145,7 @@ def phylo(args) :
         else :
             fastafile, invariants = write_fasta(args.tree, names, snps)
             if not args.nj :
-                args.tree = run_raxml_ng(args.tree, fastafile, invariants, args.ng)
+                args.tree = run_raxml_ng(args.tree, fastafile, invariants, args.ng, args.n_proc)
             else :
                 args.tree = run_rapidnj(args.tree, fastafile, invariants)
         args.tree = get_root(args.prefix, args.tree)
@@ -723,6 +1162,8 @@ def phylo(args) :
     if 'ancestral' in args.tasks :
         final_tree, node_names, states = infer_ancestral(args.tree, names, snps, sites, infer='viterbi')
         final_tree.write(format=1, outfile=args.prefix + '.labelled.nwk')
+        if args.store :
+            write_state_store(args.prefix+'.ancestral_states', node_names, states, sites, seqLens, missing)
         write_states(args.prefix+'.ancestral_states.gz', node_names, states, sites, seqLens, missing)
     elif 'mutation' in args.tasks :
         final_tree = Tree(args.tree, format=1)
@@ -731,19 +1172,15 @@ def phylo(args) :
     if 'ancestral_proportion' in args.tasks :
         final_tree, node_names, states = infer_ancestral(args.tree, names, snps, sites, infer='margin')
         final_tree.write(format=1, outfile=args.prefix + '.labelled.nwk')
+        if args.store :
+            write_state_store(args.prefix+'.ancestral_proportion', node_names, states, sites, seqLens, missing)
         write_ancestral_proportion(args.prefix+'.ancestral_proportion.gz', node_names, states, sites, seqLens, missing)
 
     if 'mutation' in args.tasks :
         mutations = get_mut(final_tree, node_names, states, sites)
-        with uopen(args.prefix + '.mutations.gz', 'w') as fout :
-            for sl in seqLens :
-                fout.write('## Sequence_length: {0} {1}\n'.format(*sl))
-            for ms in missing :
-                fout.write('## Missing_region: {0} {1} {2}\n'.format(*ms))
-            
-            fout.write('#Node\t#Seq\t#Site\t#Homoplasy\t#Mutation\n')
-            for mut in mutations :
-                fout.write('\t'.join([str(m) for m in mut]) + '\n')
+        write_mutations(args.prefix + '.mutations.gz', mutations, seqLens, missing)
+        if args.npz :
+            write_mutation_npz(args.prefix + '.mutations.npz', mutations, seqLens, missing)
 
 pool = None
 if __name__ == '__main__' :